@@ -14,23 +14,21 @@
 
 from django.conf.urls import patterns, url
 from django.contrib import admin
+from django.core.servers.basehttp import FileWrapper
 from django.core.urlresolvers import reverse
-from django.http import Http404, HttpResponse
+from django.http import Http404, HttpResponse, HttpResponseServerError
 from django.shortcuts import get_object_or_404
+from django.utils.cache import patch_cache_control
 from django.utils.translation import ugettext_lazy as _
 
-# ================
-# external imports
-# ================
-
-from PIL import Image
-
 # ===============
 # project imports
 # ===============
 
+from crowd.exceptions import MergeError
 from crowd.models.assignment import Assignment
 from crowd.models.assignment import AssignmentSession
+from crowd.models.assignment import AssignmentSlot
 from helpers import decorators as h_decs
 from helpers.django_related import templates as h_tmpl
 
@@ -52,10 +50,14 @@ class AssignmentAdmin(admin.ModelAdmin):
     ordering = ('-id',)
     actions = ('_mark_as_workable_action', '_mark_as_non_workable_action')
 
+    # the merges are requested by version (see _versioned_result), so they
+    # can be cached for long
+    MERGE_CACHE_MAX_AGE = 365 * 24 * 60 * 60
+
     fieldsets = (
         (None, {
             'fields': ('id', ('_large_preview', 'workable'), '_seg_prob',
-                       '_sessions', '_pre_seg', '_result')
+                       '_sessions', '_pre_seg', '_versioned_result')
         }),
         (_('Stats'), {
             'fields': ('_n_sessions_until_conclusion', '_n_active_sessions',
@@ -63,9 +65,9 @@ class AssignmentAdmin(admin.ModelAdmin):
         })
         )
     readonly_fields = ('id', '_large_preview', '_seg_prob', '_sessions',
-                       '_result', '_pre_seg', '_n_sessions_until_conclusion',
-                       '_n_active_sessions', '_n_skipped_sessions',
-                       '_n_sessions_w_result')
+                       '_versioned_result', '_pre_seg',
+                       '_n_sessions_until_conclusion', '_n_active_sessions',
+                       '_n_skipped_sessions', '_n_sessions_w_result')
 
     # ================
     # auxiliary fields
@@ -93,7 +95,7 @@ class AssignmentAdmin(admin.ModelAdmin):
 
     @h_decs.annotate(short_description=_('sessions'), allow_tags=True)
     def _sessions(self, obj):
-        n_sessions = obj.sessions.count()
+        n_sessions = obj.n_sessions
         if n_sessions > 0:
             chg_lst_url = reverse('admin:crowd_assignmentsession_changelist')
             chg_lst_url = '%s?assignment__id__exact=%d' % (chg_lst_url, obj.pk)
@@ -109,13 +111,12 @@ class AssignmentAdmin(admin.ModelAdmin):
                     {'target': '_blank'})
         return _('N/A')
 
-    @h_decs.annotate(short_description=_('result'), allow_tags=True)
-    def _result(self, obj):
+    def _render_result(self, obj, query=''):
         if obj.has_results > 0:
             url = reverse('admin:crowd_assignment_mergeresults_overlay',
-                args=(obj.pk,))
+                args=(obj.pk,)) + query
             url_wo_overlay = reverse('admin:crowd_assignment_mergeresults',
-                args=(obj.pk,))
+                args=(obj.pk,)) + query
             link = h_tmpl.render_link(url, _('Merge from %d session(s)') %
                                            obj.n_sessions_w_result,
                     {'target': '_blank'})
@@ -124,6 +125,19 @@ class AssignmentAdmin(admin.ModelAdmin):
             return '%s (%s)' % (link, link_wo_overlay)
         return _('N/A')
 
+    @h_decs.annotate(short_description=_('result'), allow_tags=True)
+    def _result(self, obj):
+        return self._render_result(obj)
+
+    @h_decs.annotate(short_description=_('result'), allow_tags=True)
+    def _versioned_result(self, obj):
+        # the version makes browsers fetch it again once it changes. It's
+        # only computed in the change view, as it queries the sessions
+        if obj.has_results > 0:
+            return self._render_result(obj,
+                '?v=%s' % obj.get_merge_artifacts().version)
+        return self._render_result(obj)
+
     @h_decs.annotate(short_description=_('preview'), allow_tags=True)
     def _large_preview(self, obj):
         return h_tmpl.render_linked_img(obj.tile.url,
@@ -152,10 +166,12 @@ class AssignmentAdmin(admin.ModelAdmin):
     @h_decs.annotate(short_description=_('Mark as workable'))
     def _mark_as_workable_action(self, request, queryset):
         queryset.update(workable=True)
+        AssignmentSlot.objects.adjust(queryset)
 
     @h_decs.annotate(short_description=_('Mark as non-workable'))
     def _mark_as_non_workable_action(self, request, queryset):
         queryset.update(workable=False)
+        AssignmentSlot.objects.adjust(queryset)
 
     # ============
     # custom views
@@ -163,20 +179,20 @@ class AssignmentAdmin(admin.ModelAdmin):
 
     def _merge_results_view(self, request, pk, overlay=False):
         assignment = get_object_or_404(Assignment, pk=pk)
-        merge = assignment.merge_results()
-        if merge:
-            if overlay:
-                tile = Image.open(assignment.tile.path).convert('RGBA')
-                i0 = (tile.size[0] - merge.size[0]) / 2
-                i1 = i0 + merge.size[0]
-                ret = tile.crop((i0, i0, i1, i1))
-                ret.paste((255, 0, 0), None, merge)
-            else:
-                ret = merge
-            response = HttpResponse(content_type='image/png')
-            ret.save(response, format='PNG')
-            return response
-        raise Http404
+        try:
+            version, path = assignment.get_merge_file(overlay)
+        except MergeError, e:
+            return HttpResponseServerError(unicode(e),
+                content_type='text/plain')
+        if path is None:
+            raise Http404
+
+        response = HttpResponse(FileWrapper(open(path, 'rb')),
+            content_type='image/png')
+        if version is not None and request.GET.get('v') == version:
+            patch_cache_control(response, private=True,
+                max_age=self.MERGE_CACHE_MAX_AGE)
+        return response
 
     # ==================
     # overridden methods
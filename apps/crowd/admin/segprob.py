@@ -14,9 +14,12 @@
 
 from django.conf.urls import patterns, url
 from django.contrib import admin, messages
+from django.core.servers.basehttp import FileWrapper
 from django.core.urlresolvers import reverse
 from django.http import HttpResponseRedirect, HttpResponse, Http404
 from django.shortcuts import get_object_or_404
+from django.utils import simplejson
+from django.utils.cache import patch_cache_control
 from django.utils.html import escape, linebreaks
 from django.utils.translation import ugettext_lazy as _
 
@@ -26,11 +29,10 @@ from django.utils.translation import ugettext_lazy as _
 
 from crowd.models.segprob import SegmentationProblem
 from crowd.models.segprob import SegmentationProblemDetails
+from crowd.tasks import CreateAssignmentsTask, MergeAssignmentsTask
 from helpers import decorators as h_decs
 from helpers.django_related import templates as h_tmpl
 
-from PIL import Image
-
 
 # =================================================
 # Admin configuration for SegmentationProblem model
@@ -58,6 +60,10 @@ class SegmentationProblemAdmin(admin.ModelAdmin):
     ordering = ('-id',)
     actions = ('_create_assignments_action', '_clear_assignments_action', '_publish_action', '_unpublish_action')
 
+    # the merges are requested by version (see _result), so they can be
+    # cached for long
+    MERGE_CACHE_MAX_AGE = 365 * 24 * 60 * 60
+
     fieldsets = (
         (None, {
             'fields': ('id', '_large_preview', '_task')
@@ -117,6 +123,10 @@ class SegmentationProblemAdmin(admin.ModelAdmin):
             clear_link = h_tmpl.render_link(clear_url, _('clear'))
 
             return '%s (%s)' % (chg_lst_link, clear_link)
+        elif obj.has_details and CreateAssignmentsTask.is_running(obj.pk):
+            return h_tmpl.render_link(
+                reverse('admin:crowd_segmentationproblem_assignmentsprogress',
+                    args=(obj.pk,)), _('Being created'), {'target': '_blank'})
         elif obj.has_details:
             return h_tmpl.render_link(
                 reverse('admin:crowd_segmentationproblem_createassignments',
@@ -127,12 +137,16 @@ class SegmentationProblemAdmin(admin.ModelAdmin):
     @h_decs.annotate(short_description=_('result'), allow_tags=True)
     def _result(self, obj):
         if obj.has_assignments:
+            # the version makes browsers fetch it again once it changes. It
+            # queries every session of the segmentation problem, so this
+            # must be kept out of list_display
+            query = '?v=%s' % obj.get_merge_artifacts().version
             url = reverse(
                 'admin:crowd_segmentationproblem_mergeassignments_overlay',
-                args=(obj.pk,))
+                args=(obj.pk,)) + query
             url_wo_overlay = reverse(
                 'admin:crowd_segmentationproblem_mergeassignments',
-                args=(obj.pk,))
+                args=(obj.pk,)) + query
             link = h_tmpl.render_link(url, _('Merge assignments'),
                 {'target': '_blank'})
             link_wo_overlay = h_tmpl.render_link(url_wo_overlay,
@@ -159,16 +173,22 @@ class SegmentationProblemAdmin(admin.ModelAdmin):
                 messages.warning(request, _('Seg. prob. %(id)d has '
                                             'assignments already.') % {
                     'id': p.id})
+            elif p.has_details and CreateAssignmentsTask.is_running(p.id):
+                messages.warning(request, _('Assignments for seg. prob. '
+                                            '%(id)d are being created '
+                                            'already.') % {'id': p.id})
             elif p.has_details:
-                p.create_assignments()
-                if p.has_assignments:
-                    messages.success(request, _('Assignments for seg. prob. '
-                                                '%(id)d were created.') % {
-                        'id': p.id})
+                # the assignments are created asynchronously because it may
+                # take minutes for large images
+                if CreateAssignmentsTask.schedule(p.id) is None:
+                    # scheduled meanwhile
+                    messages.warning(request, _('Assignments for seg. prob. '
+                                                '%(id)d are being created '
+                                                'already.') % {'id': p.id})
                 else:
-                    messages.error(request, _('Internal error during '
-                                              'assignments creation for seg. '
-                                              'prob. %(id)d.') % {'id': p.id})
+                    messages.info(request, _('Creation of assignments for '
+                                             'seg. prob. %(id)d was '
+                                             'scheduled.') % {'id': p.id})
             else:
                 messages.warning(request, _('Details for seg. prob. %(id)d '
                                             'are lacking.') % {'id': p.id})
@@ -176,8 +196,16 @@ class SegmentationProblemAdmin(admin.ModelAdmin):
     @h_decs.annotate(short_description=_('Clear assignments'))
     def _clear_assignments_action(self, request, queryset):
         for p in queryset:
-            if p.has_assignments:
-                p.clear_assignments()
+            if not CreateAssignmentsTask.lock(p.id):
+                messages.warning(request, _('Assignments for seg. prob. '
+                                            '%(id)d are being created, so '
+                                            'they can\'t be cleared.') % {
+                    'id': p.id})
+            elif p.has_assignments:
+                try:
+                    p.clear_assignments()
+                finally:
+                    CreateAssignmentsTask.unlock(p.id)
                 if p.has_assignments:
                     messages.error(request, _('Internal error during '
                                               'assignments clearing for seg. '
@@ -187,6 +215,7 @@ class SegmentationProblemAdmin(admin.ModelAdmin):
                                                 '%(id)d were cleared.') % {
                         'id': p.id})
             else:
+                CreateAssignmentsTask.unlock(p.id)
                 messages.warning(request, _('Seg. prob. %(id)d doesn\'t '
                                             'have any assignment.') % {
                     'id': p.id})
@@ -212,19 +241,29 @@ class SegmentationProblemAdmin(admin.ModelAdmin):
         return HttpResponseRedirect(request.GET.get('next',
             reverse('admin:crowd_segmentationproblem_change', args=(pk,))))
 
+    def _assignments_progress_view(self, request, pk):
+        seg_prob = get_object_or_404(SegmentationProblem, pk=pk)
+        ret = CreateAssignmentsTask.get_progress(seg_prob.pk)
+        ret['hasAssignments'] = seg_prob.has_assignments
+        return HttpResponse(simplejson.dumps(ret),
+            mimetype='application/json')
+
     def _merge_assignments_view(self, request, pk, overlay=False):
         seg_prob = get_object_or_404(SegmentationProblem, pk=pk)
-        merge = seg_prob.merge_assignments()
-        if merge:
-            if overlay:
-                ret = Image.open(seg_prob.image.path).convert('RGBA')
-                ret.paste((255, 0, 0), None, merge)
-            else:
-                ret = merge
-            response = HttpResponse(content_type='image/png')
-            ret.save(response, format='PNG')
-            return response
-        raise Http404
+        # the merge forks a pool of processes, so it's built out of the
+        # request, meanwhile serving the one stored last
+        version, path = seg_prob.get_merge_file(overlay, build=False)
+        if version is None:
+            MergeAssignmentsTask.schedule(seg_prob.pk)
+        if path is None:
+            raise Http404
+
+        response = HttpResponse(FileWrapper(open(path, 'rb')),
+            content_type='image/png')
+        if version is not None and request.GET.get('v') == version:
+            patch_cache_control(response, private=True,
+                max_age=self.MERGE_CACHE_MAX_AGE)
+        return response
 
     # ==================
     # overridden methods
@@ -236,6 +275,8 @@ class SegmentationProblemAdmin(admin.ModelAdmin):
     def get_urls(self):
         assignments_handling_view = self.admin_site.admin_view(
             self._assignments_handling_view)
+        assignments_progress_view = self.admin_site.admin_view(
+            self._assignments_progress_view)
         merge_assignments_view = self.admin_site.admin_view(
             self._merge_assignments_view)
 
@@ -246,6 +287,9 @@ class SegmentationProblemAdmin(admin.ModelAdmin):
             url(r'^(?P<pk>\d+)/clear_assignments/$',
                 assignments_handling_view, {'create': False},
                 name='crowd_segmentationproblem_clearassignments'),
+            url(r'^(?P<pk>\d+)/create_assignments/progress/$',
+                assignments_progress_view,
+                name='crowd_segmentationproblem_assignmentsprogress'),
 
             url(r'^(?P<pk>\d+)/merge_assignments/overlay/$',
                 merge_assignments_view, {'overlay': True},
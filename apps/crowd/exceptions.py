@@ -2,6 +2,15 @@ class RankingError(Exception):
     pass
 
 
+class AssignmentsCreationError(Exception):
+    def __init__(self, seg_prob_id):
+        self.seg_prob_id = seg_prob_id
+
+    def __str__(self):
+        return "The assignments for segmentation problem {0} could not be " \
+               "created.".format(self.seg_prob_id)
+
+
 class RedisError(Exception):
     pass
 
@@ -11,4 +20,13 @@ class EmptyKeyError(RedisError):
         self.keyname = keyname
 
     def __str__(self):
-        return "The key '{0}' is empty.".format(self.keyname)
\ No newline at end of file
+        return "The key '{0}' is empty.".format(self.keyname)
+
+class MergeError(Exception):
+    def __init__(self, session_id, reason):
+        self.session_id = session_id
+        self.reason = reason
+
+    def __str__(self):
+        return "The result of assignment session {0} could not be " \
+               "merged: {1}".format(self.session_id, self.reason)
@@ -0,0 +1,8 @@
+###############################################################################
+## Center for Advanced Computing Research
+## California Institute of Technology
+##
+## Management package for crowd app.
+##
+## Copyright 2012 Rafael Barreto <barreto@cacr.caltech.edu>
+###############################################################################
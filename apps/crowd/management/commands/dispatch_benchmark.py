@@ -0,0 +1,116 @@
+###############################################################################
+## Center for Advanced Computing Research
+## California Institute of Technology
+##
+## Benchmark of the allocation of sessions to concurrent workers.
+##
+## Copyright 2012 Rafael Barreto <barreto@cacr.caltech.edu>
+###############################################################################
+
+
+# =====================
+# Python stdlib imports
+# =====================
+
+import threading
+import time
+from optparse import make_option
+
+# ==============
+# Django imports
+# ==============
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+# ===============
+# project imports
+# ===============
+
+from crowd.models.assignment import Assignment
+from crowd.models.assignment import AssignmentSession
+from crowd.models.assignment import AssignmentSlot
+
+
+class Command(BaseCommand):
+    help = 'Simulates many workers asking for sessions at the same time and ' \
+           'reports the allocation latency and how many sessions exceeded ' \
+           'the results needed by their assignments. It creates (and ' \
+           'deletes) its own workers and sessions, so it only runs against ' \
+           'a copy of the database, confirmed by --yes-this-is-a-copy.'
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', default=50,
+            help='number of concurrent workers'),
+        make_option('--rounds', type='int', default=3,
+            help='number of times every worker asks for a session'),
+        make_option('--yes-this-is-a-copy', action='store_true',
+            dest='is_a_copy', default=False,
+            help='confirms the database is a copy it can write to'),
+        )
+
+    USERNAME_PREFIX = 'dispatch_benchmark_'
+
+    def _allocate(self, worker, start, timings, errors):
+        start.wait()
+        try:
+            t0 = time.time()
+            AssignmentSession.objects.get_by_worker(worker)
+            timings.append(time.time() - t0)
+        except Exception, e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    def _count_over_allocated(self, workers):
+        ret = 0
+        for a in Assignment.objects.filter(
+                sessions__worker__in=workers).distinct():
+            ret += max(0, a.n_active_sessions - a.n_sessions_until_conclusion)
+        return ret
+
+    def _clean_up(self, workers):
+        # the sessions are deleted one by one, so that the counters of their
+        # assignments follow (see crowd.models.signals), and the slots held
+        # are freed, as deleting the workers would delete them along
+        for s in AssignmentSession.objects.filter(worker__in=workers):
+            s.delete()
+        AssignmentSlot.objects.filter(worker__in=workers).update(worker=None,
+            expiration_deadline=None)
+        User.objects.filter(pk__in=[w.pk for w in workers]).delete()
+
+    def handle(self, *args, **options):
+        if not options['is_a_copy']:
+            raise CommandError('it writes to the database, so run it against '
+                               'a copy with --yes-this-is-a-copy')
+
+        workers = [User.objects.create_user('%s%d' % (self.USERNAME_PREFIX,
+            i)) for i in xrange(options['workers'])]
+        try:
+            for round in xrange(1, options['rounds'] + 1):
+                start = threading.Event()
+                timings, errors = [], []
+                threads = [threading.Thread(target=self._allocate,
+                    args=(w, start, timings, errors)) for w in workers]
+                for t in threads:
+                    t.start()
+                start.set()
+                for t in threads:
+                    t.join()
+
+                timings.sort()
+                self.stdout.write('round %d: %d session(s), %d error(s), '
+                                  'mean %.4fs, p95 %.4fs, %d session(s) over '
+                                  'the results needed\n' % (round,
+                    len(timings), len(errors),
+                    sum(timings) / max(1, len(timings)),
+                    timings[int(0.95 * (len(timings) - 1))] if timings else 0,
+                    self._count_over_allocated(workers)))
+
+                # skip every session, so the next round competes again
+                for s in AssignmentSession.objects.filter(worker__in=workers,
+                        close_time__isnull=True):
+                    s.close()
+                    s.save()
+        finally:
+            self._clean_up(workers)
@@ -0,0 +1,100 @@
+###############################################################################
+## Center for Advanced Computing Research
+## California Institute of Technology
+##
+## Benchmark of the experimental NumPy LiveVessel costs against golden files.
+##
+## Copyright 2012 Rafael Barreto <barreto@cacr.caltech.edu>
+###############################################################################
+
+
+# =====================
+# Python stdlib imports
+# =====================
+
+import time
+from optparse import make_option
+
+try:
+    from cStringIO import StringIO
+except:
+    from StringIO import StringIO
+
+# ==============
+# Django imports
+# ==============
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# ================
+# external imports
+# ================
+
+import numpy
+from PIL import Image
+
+# ===============
+# project imports
+# ===============
+
+from crowd.processing import costs
+from crowd.processing.preprocess import parse_preprocess_data
+from crowd.processing.preprocess import read_preprocess_file
+from crowd.processing.preprocess import write_preprocess_file
+
+
+class Command(BaseCommand):
+    args = '<tile> [<golden .xz preprocess file>]'
+    help = 'Times the experimental NumPy LiveVessel costs of a tile and ' \
+           'compares them with a preprocess file produced by the MATLAB ' \
+           '\'offline\' script.'
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', type='int', default=5,
+            help='number of timed runs'),
+        )
+
+    def handle(self, *args, **options):
+        if not 1 <= len(args) <= 2:
+            raise CommandError('Usage: livevessel_benchmark %s' % self.args)
+        if options['repeat'] < 1:
+            raise CommandError('--repeat must be at least 1')
+
+        img = Image.open(args[0])
+        img.load()
+
+        golden = None
+        if len(args) == 2:
+            golden = read_preprocess_file(args[1])
+
+        scales = golden.scales if golden else getattr(settings,
+            'CROWD_LIVEVESSEL_SCALES', costs.DEFAULT_SCALES)
+
+        timings = []
+        for _ in xrange(options['repeat']):
+            t0 = time.time()
+            output = StringIO()
+            write_preprocess_file(output, costs.compute_costs(img, scales),
+                scales)
+            timings.append(time.time() - t0)
+        self.stdout.write('%dx%d tile, %d scale(s): best %.4fs, mean %.4fs '
+                          'over %d run(s)\n' % (img.size[0], img.size[1],
+                                                len(scales), min(timings),
+                                                sum(timings) / len(timings),
+                                                len(timings)))
+
+        if golden is None:
+            return
+
+        data = parse_preprocess_data(output.getvalue())
+        if data.planes.shape != golden.planes.shape:
+            raise CommandError('layout mismatch: %s costs instead of %s' % (
+                'x'.join(map(str, data.planes.shape)),
+                'x'.join(map(str, golden.planes.shape))))
+
+        for scale, plane, golden_plane in zip(scales, data.planes,
+                golden.planes):
+            diff = numpy.abs(plane.astype(numpy.int16) -
+                             golden_plane.astype(numpy.int16))
+            self.stdout.write('scale %g: mean abs. diff. %.2f, max. abs. '
+                              'diff. %d\n' % (scale, diff.mean(), diff.max()))
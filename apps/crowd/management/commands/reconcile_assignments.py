@@ -0,0 +1,57 @@
+###############################################################################
+## Center for Advanced Computing Research
+## California Institute of Technology
+##
+## Repair of the session counters and dispatch slots of assignments.
+##
+## Copyright 2012 Rafael Barreto <barreto@cacr.caltech.edu>
+###############################################################################
+
+
+# =====================
+# Python stdlib imports
+# =====================
+
+from optparse import make_option
+
+# ==============
+# Django imports
+# ==============
+
+from django.core.management.base import BaseCommand, CommandError
+
+# ===============
+# project imports
+# ===============
+
+from crowd.models.assignment import Assignment
+from crowd.models.assignment import AssignmentSession
+from crowd.models.segprob import SegmentationProblem
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the session counters and the dispatch slots of the ' \
+           'assignments from their sessions.'
+    option_list = BaseCommand.option_list + (
+        make_option('--seg-prob', type='int', dest='seg_prob',
+            help='only the assignments of this segmentation problem'),
+        )
+
+    def handle(self, *args, **options):
+        assignments = Assignment.objects
+        if options['seg_prob'] is not None:
+            try:
+                assignments = SegmentationProblem.objects.get(
+                    pk=options['seg_prob']).assignments
+            except SegmentationProblem.DoesNotExist:
+                raise CommandError('seg. prob. %d does not exist' %
+                                   options['seg_prob'])
+
+        n_closed = AssignmentSession.objects.close_expired()
+        n_fixed = assignments.update_session_counters()
+        assignments.sync_slots()
+
+        self.stdout.write('%d expired session(s) closed, %d assignment(s) '
+                          'with wrong session counters, slots of %d '
+                          'assignment(s) rebuilt\n' % (n_closed, n_fixed,
+                                                       assignments.count()))
@@ -10,6 +10,7 @@
 
 from crowd.models import assignment
 from crowd.models import exceptions
+from crowd.models import indexes
 from crowd.models import segprob
 from crowd.models import signals
 from crowd.models import task
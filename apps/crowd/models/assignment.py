@@ -12,10 +12,13 @@
 # Python stdlib imports
 # =====================
 
+import collections
 import datetime
 import os
 import math
 
+from decimal import Decimal
+
 try:
     from cStringIO import StringIO
 except:
@@ -25,10 +28,11 @@ except:
 # Django imports
 # ==============
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 from django.core.files.base import ContentFile
-from django.db import models
+from django.db import models, transaction
 from django.db.models.expressions import F
 from django.db.models.query_utils import Q
 from django.utils import timezone
@@ -49,10 +53,12 @@ import externals
 
 from crowd.models.exceptions import InvalidStateError
 from crowd.models.segprob import SegmentationProblem
+from crowd.processing.merge import MergeArtifacts, VoteAccumulator
+from crowd.processing.results import process_result
 from helpers import decorators as h_decs
-from helpers import dip as h_dip
 from helpers.django_related.models import get_db_datetime_now,\
     get_db_column, CountIf
+from profiles.models import WorkerProfile
 
 
 class AssignmentManager(models.Manager):
@@ -62,60 +68,116 @@ class AssignmentManager(models.Manager):
     def get_available(self):
         """
         This method returns the available assignments
-        
+
         Available assignments satisfy the following condition: n_active_sessions < n_sessions_until_conclusion
-        """  
-              
-        active_cond = '(%(expiration_deadline)s >= "%(now)s" AND '\
-                      '%(close_time)s IS NULL)' % {
-                          'expiration_deadline': get_db_column(
-                              AssignmentSession,
-                              'expiration_deadline'),
-                          'now': get_db_datetime_now(self.db),
-                          'close_time': get_db_column(AssignmentSession,
-                              'close_time')
-                      }
-                      
-        w_result = "%(result)s <> ''" % {'result': get_db_column(AssignmentSession, 'result')}      
-        
-        not_concluded_assigns = self.get_public().filter(concluded=False)
-        
-        #Annotate with active_sess and w_result_sess
-        annotated_assigns = not_concluded_assigns.annotate(
-            active_sess=CountIf('sessions', condition=active_cond), 
-            w_result_sess=CountIf('sessions', condition=w_result)).select_related(
-            'seg_prob__details__min_results_per_assignment')
-            
-        #Filter n_active_sessions < n_sessions_until_conclusion
-        available_assigns = annotated_assigns.filter(
-            active_sess__lt=F('seg_prob__details__min_results_per_assignment') - F('w_result_sess'))
-    
-        return available_assigns
+
+        The sessions that expired while open count as active until the
+        sweeper closes them (see AssignmentSessionManager.close_expired).
+        """
+
+        return self.get_public().filter(concluded=False,
+            open_sessions_count__lt=F(
+                'seg_prob__details__min_results_per_assignment') -
+                                    F('sessions_w_result_count'))
 
     def enforce_concluded(self):
         self.update(concluded=False)
-        has_result_cond = '(%(result)s <> "")' % {
-            'result': get_db_column(AssignmentSession, 'result')
-        }
-        active_cond = '(%(expiration_deadline)s >= "%(now)s" AND '\
-                      '%(close_time)s IS NULL)' % {
-                          'expiration_deadline': get_db_column(
-                              AssignmentSession,
-                              'expiration_deadline'),
-                          'now': get_db_datetime_now(self.db),
-                          'close_time': get_db_column(AssignmentSession,
-                              'close_time')
-                      }
-        valid_sessions_cond = '(%s OR %s)' % (has_result_cond, active_cond)
-
-        concluded = self.get_public().annotate(n_sessions=CountIf('sessions',
-            condition=valid_sessions_cond)).select_related(
-            'seg_prob__details__min_results_per_assignment').filter(
-            n_sessions__ge=F('seg_prob__details__min_results_per_assignment'))
+        # sessions w/ result + active sessions >= min. results
+        concluded = self.get_public().filter(
+            open_sessions_count__gte=F(
+                'seg_prob__details__min_results_per_assignment') -
+                                     F('sessions_w_result_count'))
         for a in concluded:
             a.concluded = True
             a.save()
 
+    @h_decs.annotate(alters_data=True)
+    def move_session_count(self, assignment_id, source=None, target=None,
+                           n=1):
+        """
+        Moves 'n' sessions of an assignment from the session counter 'source'
+        to the session counter 'target' (see Assignment.SESSION_COUNTERS).
+        'source' is None for new sessions and 'target' for deleted ones.
+
+        The counters are changed by a single UPDATE, so concurrent changes
+        don't get lost.
+        """
+
+        updates = {}
+        if target is not None:
+            updates[target] = F(target) + n
+        if source is not None:
+            updated = self.filter(pk=assignment_id, **{source + '__gte': n})\
+                .update(**dict(updates, **{source: F(source) - n}))
+            if updated or not updates:
+                return
+        # the source counter drifted (see update_session_counters)
+        self.filter(pk=assignment_id).update(**updates)
+
+    @h_decs.annotate(alters_data=True)
+    def update_session_counters(self):
+        """
+        Recomputes the session counters of these assignments from their
+        sessions, repairing any drift. Returns the number of assignments
+        whose counters were wrong.
+        """
+
+        columns = dict((f, get_db_column(AssignmentSession, f)) for f in
+                       ('close_time', 'expiration_deadline', 'has_result'))
+        conditions = {
+            'open_sessions_count': '(%(close_time)s IS NULL)',
+            'sessions_w_result_count': '(%(has_result)s = 1)',
+            'skipped_sessions_count': '(%(close_time)s IS NOT NULL AND '
+                                      '%(close_time)s <= '
+                                      '%(expiration_deadline)s AND '
+                                      '%(has_result)s = 0)',
+            'expired_sessions_count': '(%(close_time)s IS NOT NULL AND '
+                                      '%(close_time)s > '
+                                      '%(expiration_deadline)s)'
+        }
+
+        annotated = self.annotate(**dict(('actual_' + c, CountIf('sessions',
+            condition=conditions[c] % columns)) for c in
+                                         Assignment.SESSION_COUNTERS))
+        n_fixed = 0
+        for a in annotated:
+            actual = dict((counter, getattr(a, 'actual_' + counter)) for
+                          counter in Assignment.SESSION_COUNTERS)
+            if any(getattr(a, c) != v for c, v in actual.iteritems()):
+                self.filter(pk=a.pk).update(**actual)
+                n_fixed += 1
+        return n_fixed
+
+    def get_pending_scoring(self):
+        """Concluded assignments with sessions whose accuracy wasn't
+        computed yet (see Assignment.score_sessions)."""
+        return self.filter(concluded=True, sessions__has_result=True,
+            sessions__stats__mileage__isnull=False,
+            sessions__stats__accuracy__isnull=True).distinct()
+
+    def get_merge_jobs(self, output_dir):
+        """
+        Returns the jobs merging the results of these assignments (see
+        crowd.processing.merge.merge_all), along with their assignments, for
+        those with results. The merges are written under 'output_dir'.
+        """
+
+        assignments = self.filter(sessions_w_result_count__gt=0)
+        results = collections.defaultdict(dict)
+        for s in AssignmentSession.objects.get_w_result().filter(
+                assignment__in=assignments).only('assignment', 'result'):
+            results[s.assignment_id][s.pk] = s.result.path
+
+        alpha = getattr(settings, 'CROWD_MERGE_ALPHA', 2.0)
+        return [(a, (a.pk, a.get_votes().path, results[a.pk], alpha,
+                     os.path.join(output_dir, '%d.png' % a.pk)))
+                for a in assignments.select_related('seg_prob')]
+
+    def sync_slots(self):
+        """Rebuilds the dispatch slots of these assignments (see
+        AssignmentSlot)."""
+        AssignmentSlot.objects.rebuild(self.all())
+
 
 
 class Assignment(models.Model):
@@ -128,6 +190,20 @@ class Assignment(models.Model):
         'medium': (100, 100),
         'large': (150, 150)
     }
+
+    # counters of the sessions of an assignment in each state, maintained
+    # along with the sessions (see AssignmentSession.counter_name)
+    SESSION_COUNTERS = ('open_sessions_count', 'sessions_w_result_count',
+                        'skipped_sessions_count', 'expired_sessions_count')
+
+    # the running count of the results of an assignment (see get_votes),
+    # under the assignments root of its segmentation problem
+    VOTES_FILENAME = '%d_votes.npz'
+
+    # where the outputs of the merges are stored (see get_merge_file), under
+    # the assignments root of the segmentation problem
+    MERGES_DIRNAME = 'merges'
+
     # ===============
     # private methods
     # ===============
@@ -154,6 +230,8 @@ class Assignment(models.Model):
     tile = externals.thumbs.ImageWithThumbsField(_('tile'),
         upload_to=_img_upload_to_fun, sizes=THUMB_SIZES.values(),
         editable=False)
+    # the part of the image covered by the tile, border included (the part
+    # the tile is responsible for is the one without the border)
     tile_bbox_x0 = models.PositiveIntegerField(
         _('tile bbox.x0'), editable=False)
     tile_bbox_y0 = models.PositiveIntegerField(
@@ -174,6 +252,15 @@ class Assignment(models.Model):
     concluded = models.BooleanField(_('concluded?'), default=False,
         editable=False)
 
+    open_sessions_count = models.PositiveIntegerField(
+        _('# open sessions'), default=0, editable=False)
+    sessions_w_result_count = models.PositiveIntegerField(
+        _('# sessions w/ result'), default=0, editable=False)
+    skipped_sessions_count = models.PositiveIntegerField(
+        _('# skipped sessions'), default=0, editable=False)
+    expired_sessions_count = models.PositiveIntegerField(
+        _('# expired sessions'), default=0, editable=False)
+
     objects = AssignmentManager()
 
     class Meta:
@@ -196,18 +283,24 @@ class Assignment(models.Model):
 
     @property
     def n_active_sessions(self):
-        return self.sessions.get_active().count()
+        """Sessions that expired are counted until they're closed (see
+        AssignmentSessionManager.close_expired)."""
+        return self.open_sessions_count
 
     def n_expired_sessions(self):
         return self.sessions.get_expired().count()
 
     @property
     def n_skipped_sessions(self):
-        return self.sessions.get_skipped().count()
+        return self.skipped_sessions_count
 
     @property
     def n_sessions_w_result(self):
-        return self.sessions.get_w_result().count()
+        return self.sessions_w_result_count
+
+    @property
+    def n_sessions(self):
+        return sum(getattr(self, c) for c in self.SESSION_COUNTERS)
 
     @property
     def has_results(self):
@@ -235,30 +328,95 @@ class Assignment(models.Model):
     def get_tile_thumb_url(self, size):
         return getattr(self.tile, 'url_%dx%d' % self.THUMB_SIZES[size])
 
+    def get_votes(self):
+        """Returns the running count of the results of the sessions (see
+        crowd.processing.merge.VoteAccumulator)."""
+        return VoteAccumulator(os.path.join(
+            self.seg_prob.assignments_root_path, self.VOTES_FILENAME % self.pk))
+
     def merge_results(self):
-        finished = self.sessions.get_w_result()
-        merge = None
-        alpha = float(2.0)
-        
-        try:
-            merge = h_dip.merge_masks([s.result.path for s in finished], alpha)
-        except:
-            #TODO log this error as a inconsistency problem: 
-            #number of masks is not equal to the number o sessions with results
-            pass
+        """
+        Returns the merge of the results of the sessions as a PIL image, or
+        None if there's none, storing it as 'merge' if it isn't yet.
+
+        The pixels marked by at least 1/settings.CROWD_MERGE_ALPHA of the
+        results are merged (see VoteAccumulator.merge). The
+        results are counted as the sessions are closed, so only those not
+        counted yet are read. Raises crowd.exceptions.MergeError with the
+        session whose result can't be merged.
+        """
 
-        # merge_skel = Image.fromarray(merge['merge_skel']) if merge else None
-        merge_skel = Image.fromarray(merge['merge']) if merge else None
+        votes = self.get_votes()
+        votes.sync(dict((s.pk, s.result.path) for s in
+                        self.sessions.get_w_result()))
+        mask = votes.merge(getattr(settings, 'CROWD_MERGE_ALPHA', 2.0))
+        if mask is None:
+            return None
+        merge = Image.fromarray(mask)
 
-        if not self.merge and merge_skel is not None:
+        if not self.merge:
             tile_filename = os.path.splitext(os.path.split(self.tile.name)[1])[0]
             merge_filename = '%s_merge.png' % (tile_filename)
 
             output = StringIO()
-            merge_skel.save(output, format='PNG')
+            merge.save(output, format='PNG')
             self.merge.save(merge_filename, ContentFile(output.getvalue()))
 
-        return merge_skel
+        return merge
+
+    def get_merge_artifacts(self):
+        """Returns the stored outputs of the merge of the results (see
+        get_merge_file), versioned by the sessions with result."""
+        return MergeArtifacts(os.path.join(
+            self.seg_prob.assignments_root_path, self.MERGES_DIRNAME),
+            str(self.pk), self.sessions.get_w_result().values_list('pk',
+            flat=True), (getattr(settings, 'CROWD_MERGE_ALPHA', 2.0),))
+
+    def get_merge_file(self, overlay=False):
+        """
+        Returns the version of the merge of the results and the path of its
+        PNG, or of the PNG of the merge painted red over the tile if
+        'overlay' (the path is None if there's no result). They're only
+        built again once the sessions with result change.
+        """
+
+        def build_merge(output_path):
+            merge = self.merge_results()
+            if merge is None:
+                return False
+            merge.save(output_path, format='PNG')
+            return True
+
+        def build_overlay(output_path):
+            merge = Image.open(path)
+            tile = Image.open(self.tile.path).convert('RGBA')
+            # only the part of the tile without the border
+            details = self.seg_prob.details
+            i0 = int(details.tiles_dimension * details.tiles_border)
+            i1 = tile.size[0] - i0
+            ret = tile.crop((i0, i0, i1, i1))
+            ret.paste((255, 0, 0), None, merge.crop((i0, i0, i1, i1)))
+            ret.save(output_path, format='PNG')
+            return True
+
+        artifacts = self.get_merge_artifacts()
+        path = artifacts.get('merge', build_merge)
+        if path is not None and overlay:
+            path = artifacts.get('overlay', build_overlay)
+        return artifacts.version, path
+
+    @h_decs.annotate(alters_data=True)
+    def score_sessions(self):
+        """
+        Computes the accuracy of the sessions with result against the merge
+        and corrects the scores of their workers accordingly. The sessions
+        already scored are skipped, so it can be run again safely. Returns
+        the number of sessions scored.
+        """
+
+        if not self.has_merge:
+            raise InvalidStateError(_('This assignment has no merge.'))
+        return AssignmentSessionStats.objects.update_accuracies(self)
 
 
 
@@ -268,24 +426,31 @@ class AssignmentSessionManager(models.Manager):
         # If there is an old session which has not expired but had
         # its segmentation problem turned to unpublished, it must be closed.
         try:
-            public_session = self.get(worker=worker, close_time__isnull=True, assignment__seg_prob__published=True)
+            # along with everything needed to work on it
+            public_session = self.select_related(
+                'assignment__seg_prob__details').get(worker=worker,
+                close_time__isnull=True, assignment__seg_prob__published=True)
             return public_session
         except AssignmentSession.DoesNotExist:
             try:
                 old_session = self.get(worker=worker, close_time__isnull=True)
                 old_session.close()
                 old_session.save()
-            except AssignmentSession.DoesNotExist:
+            except (AssignmentSession.DoesNotExist, InvalidStateError):
+                # or closed meanwhile
                 pass
 
-        # get any pending assignment excluding those in which the user already
-        # worked on, ordering by task creation date
-        assignments = Assignment.objects.get_available().exclude(
-            sessions__worker=worker).order_by('seg_prob__id', 'id')
-        if assignments.count():
-            #myass = random.choice(assignments[0:40])
-            return self.create(assignment=assignments[0], worker=worker)
-        
+        # reserve the first free slot of an assignment the user didn't work
+        # on already, ordering by segmentation problem creation
+        slot = AssignmentSlot.objects.reserve_for(worker)
+        if slot is not None:
+            try:
+                return self.create(assignment_id=slot.assignment_id,
+                    worker=worker)
+            except:
+                AssignmentSlot.objects.give_back(slot, worker)
+                raise
+
         return None
 
     def get_active(self):
@@ -305,10 +470,52 @@ class AssignmentSessionManager(models.Manager):
         # those sessions that were closed no later than the expiration deadline
         # without results
         return self.filter(close_time__isnull=False,
-            close_time__lte=F('expiration_deadline'), result='')
+            close_time__lte=F('expiration_deadline'), has_result=False)
 
     def get_w_result(self):
-        return self.filter(~Q(result=''))
+        return self.filter(has_result=True)
+
+    @h_decs.annotate(alters_data=True)
+    def close_expired(self, batch_size=None):
+        """
+        Closes the sessions that expired while open, updating the session
+        counters of their assignments. Returns the number of sessions closed.
+
+        The sessions are closed by one UPDATE per batch of 'batch_size'
+        sessions (settings.CROWD_SESSIONS_SWEEP_BATCH_SIZE by default).
+        """
+
+        batch_size = batch_size or getattr(settings,
+            'CROWD_SESSIONS_SWEEP_BATCH_SIZE', 500)
+        n_closed = 0
+        while True:
+            n = self._close_expired_batch(batch_size)
+            n_closed += n
+            if n < batch_size:
+                return n_closed
+
+    @transaction.commit_on_success
+    def _close_expired_batch(self, batch_size):
+        now = timezone.now()
+        # the sessions are locked so that none of them is closed by its
+        # worker meanwhile, which would make the counters drift. A worker
+        # holding a session loaded before won't close it again either (see
+        # AssignmentSession.save)
+        batch = list(self.filter(close_time__isnull=True,
+            expiration_deadline__lt=now).select_for_update().values_list(
+            'pk', 'assignment')[:batch_size])
+        if not batch:
+            return 0
+
+        self.filter(pk__in=[pk for pk, _ in batch]).update(close_time=now)
+
+        per_assignment = collections.defaultdict(int)
+        for _, assignment_id in batch:
+            per_assignment[assignment_id] += 1
+        for assignment_id, n in per_assignment.iteritems():
+            Assignment.objects.move_session_count(assignment_id,
+                'open_sessions_count', 'expired_sessions_count', n)
+        return len(batch)
 
     def n_sessions_expired_for(self, user):
         return self.get_expired().filter(worker=user).count()
@@ -327,11 +534,11 @@ class AssignmentSession(models.Model):
             self.assignment.tile.name)[0], self.pk)
 
     def _preprocess_result(self, result):
-        dim = self.assignment.seg_prob.details.tiles_dimension
-        output = StringIO()
-        Image.open(result).resize((dim, dim)).split()[-1].point(
-            lambda u: 255 if u > 0 else 0).save(output, format='PNG')
-        return ContentFile(output.getvalue())
+        """Returns the binarized result as a PNG ContentFile, along with its
+        mileage and its mask."""
+        png, mileage, mask = process_result(result,
+            self.assignment.seg_prob.details.tiles_dimension)
+        return ContentFile(png), mileage, mask
 
     # ================
     # model definition
@@ -350,6 +557,10 @@ class AssignmentSession(models.Model):
     # TODO change this to PreProcessImageField
     result = models.ImageField(_('result'), max_length=255,
         upload_to=_result_upload_to_fun, blank=True, editable=False)
+    # the same as bool(result), so that filtering by it doesn't compare
+    # strings
+    has_result = models.BooleanField(_('has result?'), default=False,
+        editable=False)
 
     # result_thumbnail = externals.thumbs.ImageWithThumbsField(
     #     _('result'), max_length=255, upload_to=_result_upload_to_fun,
@@ -360,6 +571,15 @@ class AssignmentSession(models.Model):
 
     objects = AssignmentSessionManager()
 
+    # besides the indexes of the foreign keys, the ones for the filters of
+    # AssignmentSessionManager (see crowd.models.indexes)
+    COMPOSITE_INDEXES = (
+        ('worker', 'close_time'),
+        ('assignment', 'close_time', 'expiration_deadline'),
+        ('close_time', 'expiration_deadline'),
+        ('assignment', 'has_result')
+    )
+
     class Meta:
         app_label = 'crowd'
 
@@ -401,8 +621,16 @@ class AssignmentSession(models.Model):
         return self.closed and not self.expired and not self.has_result
 
     @property
-    def has_result(self):
-        return self.result
+    def counter_name(self):
+        """Session counter of the assignment this session is counted in (see
+        Assignment.SESSION_COUNTERS)."""
+        if not self.closed:
+            return 'open_sessions_count'
+        elif self.has_result:
+            return 'sessions_w_result_count'
+        elif self.expired:
+            return 'expired_sessions_count'
+        return 'skipped_sessions_count'
 
     # ==================
     # overridden methods
@@ -410,6 +638,8 @@ class AssignmentSession(models.Model):
 
     @h_decs.annotate(alters_data=True)
     def clean(self):
+        self.has_result = bool(self.result)
+
         # this guarantees that a user cannot work on two sessions at the same
         # time
         worker_busy_already = AssignmentSession.objects.exclude(
@@ -435,6 +665,26 @@ class AssignmentSession(models.Model):
             self.expiration_deadline = self.start_time +\
                                        datetime.timedelta(seconds=timeout)
 
+    @transaction.commit_on_success
+    def save(self, *args, **kwargs):
+        # otherwise it's closed by clean, after the check below
+        if self.pk is not None and not self.closed and self.expired:
+            self.close()
+
+        if self.pk is not None and getattr(self, '_just_closed', False):
+            # the session may have been closed since it was loaded, e.g. by
+            # the sweeper (see AssignmentSessionManager.close_expired), so it's
+            # only closed (and its counters moved) if it's still open
+            closed = type(self).objects.filter(pk=self.pk,
+                close_time__isnull=True).update(close_time=self.close_time)
+            if not closed:
+                self._just_closed = False
+                self._result_mask = None
+                if self.has_result:
+                    self.result.delete(save=False)
+                raise InvalidStateError(_('This session is already closed.'))
+        super(AssignmentSession, self).save(*args, **kwargs)
+
     def __unicode__(self):
         return u'Session for assignment #%d - Remaining: %s' %\
                (self.assignment.id, self.remaining_time)
@@ -445,24 +695,348 @@ class AssignmentSession(models.Model):
 
     @h_decs.annotate(alters_data=True)
     def close(self, result=None):
+        """
+        Closes this session with the result image, given as a PIL image or
+        read from the file-like 'result', if any and if the session didn't
+        expire. If the result can't be read, the session is left open.
+
+        Returns the mileage (number of foreground pixels) of the result
+        stored, or None.
+        """
+
         if self.closed:
             raise InvalidStateError(_('This session is already closed.'))
-        self.close_time = timezone.now()
+        mileage = None
         if not self.expired and result is not None:
-            self.result.save('', self._preprocess_result(result),
-                save=False)
+            content, mileage, mask = self._preprocess_result(result)
+            self.result.save('', content, save=False)
+            self.has_result = True
+            # counted in the merge of the assignment once it's saved
+            self._result_mask = mask
+        self.close_time = timezone.now()
+        # the session counters are updated once it's saved
+        self._just_closed = True
+        return mileage
 
     @h_decs.annotate(alters_data=True)
     def cancel(self):
         if self.active:
             self.delete()
             
+class AssignmentSlotManager(models.Manager):
+    # number of free slots tried in order before looking for free slots
+    # again, so that concurrent workers losing a slot to each other move on
+    # to the next one instead of querying again
+    N_CANDIDATES = 10
+    MAX_RESERVATION_ATTEMPTS = 5
+    # number of slots deleted per query (see adjust)
+    DELETION_BATCH_SIZE = 500
+
+    def get_free(self):
+        """Slots of public assignments which aren't held by any worker or
+        whose holder's session expired."""
+        return self.filter(seg_prob__published=True,
+            assignment__workable=True, assignment__concluded=False).filter(
+            Q(worker__isnull=True) |
+            Q(expiration_deadline__lt=timezone.now()))
+
+    def get_candidates_for(self, worker, n):
+        """Returns the first 'n' free slots of assignments 'worker' has no
+        session for."""
+        seen = AssignmentSession.objects.filter(worker=worker).values(
+            'assignment')
+        return list(self.get_free().exclude(assignment__in=seen).order_by(
+            'seg_prob', 'assignment').select_related('seg_prob__details')[:n])
+
+    def get_next_for(self, worker):
+        """Returns the first free slot of an assignment 'worker' has no
+        session for, or None."""
+        slots = self.get_candidates_for(worker, 1)
+        return slots[0] if slots else None
+
+    def get_reserved_for(self, worker):
+        """Returns the slot 'worker' holds, without a session, for an
+        assignment that is still public (see reserve_next_for), or None."""
+        seen = AssignmentSession.objects.filter(worker=worker).values(
+            'assignment')
+        slots = self.filter(worker=worker,
+            expiration_deadline__gte=timezone.now(), seg_prob__published=True,
+            assignment__workable=True, assignment__concluded=False).exclude(
+            assignment__in=seen).select_related('seg_prob__details')[:1]
+        return slots[0] if slots else None
+
+    @h_decs.annotate(alters_data=True)
+    def take(self, slot, worker, deadline=None):
+        """
+        Makes 'worker' hold 'slot' until 'deadline' (by default, the timeout
+        of the assignments from now) if it's still free or already held by
+        'worker', returning whether it did. It's a single conditional UPDATE,
+        so out of many workers taking the same slot at once exactly one
+        succeeds.
+        """
+
+        now = timezone.now()
+        deadline = deadline or now + datetime.timedelta(
+            seconds=slot.seg_prob.details.assignments_timeout)
+        taken = self.filter(pk=slot.pk).filter(
+            Q(worker__isnull=True) | Q(expiration_deadline__lt=now) |
+            Q(worker=worker)).update(worker=worker,
+            expiration_deadline=deadline)
+        if taken:
+            slot.worker = worker
+            slot.expiration_deadline = deadline
+        return taken == 1
+
+    @h_decs.annotate(alters_data=True)
+    def give_back(self, slot, worker):
+        self.filter(pk=slot.pk, worker=worker).update(worker=None,
+            expiration_deadline=None)
+
+    @h_decs.annotate(alters_data=True)
+    def reserve_for(self, worker, deadline=None):
+        """Takes, until 'deadline' (see take), the slot reserved for
+        'worker' or else the first free slot of an assignment 'worker' has no
+        session for. Returns the slot or None if there's none left."""
+
+        reserved = self.get_reserved_for(worker)
+        if reserved is not None and self.take(reserved, worker, deadline):
+            return reserved
+
+        for _ in xrange(self.MAX_RESERVATION_ATTEMPTS):
+            candidates = self.get_candidates_for(worker, self.N_CANDIDATES)
+            if not candidates:
+                return None
+            for slot in candidates:
+                if self.take(slot, worker, deadline):
+                    return slot
+        return None
+
+    @h_decs.annotate(alters_data=True)
+    def reserve_next_for(self, session):
+        """
+        Reserves the slot of the assignment the worker of 'session' works on
+        next, so that it can be fetched in advance. The reservation lasts
+        until settings.CROWD_NEXT_ASSIGNMENT_RESERVATION_GRACE seconds after
+        'session' expires; then the slot is free again. Returns the slot or
+        None if there's none left.
+        """
+
+        grace = getattr(settings, 'CROWD_NEXT_ASSIGNMENT_RESERVATION_GRACE',
+            60)
+        deadline = session.expiration_deadline + datetime.timedelta(
+            seconds=grace)
+        return self.reserve_for(session.worker, deadline)
+
+    @h_decs.annotate(alters_data=True)
+    def claim(self, session):
+        """Makes the worker of 'session' hold a slot of its assignment until
+        the session expires. Returns False if there was no free slot."""
+
+        held = self.filter(assignment=session.assignment_id,
+            worker=session.worker_id)
+        if held.update(expiration_deadline=session.expiration_deadline):
+            return True
+
+        free = self.get_free().filter(assignment=session.assignment_id)[:1]
+        if not free:
+            return False
+        slot = free[0]
+        slot.worker_id = session.worker_id
+        slot.expiration_deadline = session.expiration_deadline
+        slot.save()
+        return True
+
+    @h_decs.annotate(alters_data=True)
+    def release(self, session):
+        """Gives back the slot held by the worker of 'session', which is used
+        up if the session has a result."""
+
+        held = self.filter(assignment=session.assignment_id,
+            worker=session.worker_id)
+        if session.has_result:
+            held.delete()
+        else:
+            held.update(worker=None, expiration_deadline=None)
+
+    @h_decs.annotate(alters_data=True)
+    def adjust(self, assignments):
+        """
+        Makes the number of slots of each of 'assignments' match the sessions
+        with result it still needs (none if it isn't workable or is
+        concluded), creating free slots or deleting the free ones first. The
+        slots kept, and who holds or reserved them, are left untouched.
+
+        It takes a fixed number of queries, whatever the number of
+        assignments. Unlike rebuild, it doesn't repair slots that drifted
+        from the sessions.
+        """
+
+        now = timezone.now()
+        needed = {}
+        for pk, seg_prob_id, workable, concluded, n_w_result, min_results in\
+                assignments.values_list('pk', 'seg_prob', 'workable',
+                    'concluded', 'sessions_w_result_count',
+                    'seg_prob__details__min_results_per_assignment'):
+            if workable and not concluded and min_results is not None:
+                needed[pk] = (seg_prob_id, max(0, min_results - n_w_result))
+            else:
+                needed[pk] = (seg_prob_id, 0)
+
+        slots = collections.defaultdict(list)
+        for assignment_id, pk, worker_id, deadline in self.filter(
+                assignment__in=assignments.values('pk')).values_list(
+                'assignment', 'pk',
+                'worker', 'expiration_deadline'):
+            held = worker_id is not None and deadline >= now
+            slots[assignment_id].append((held, pk))
+
+        to_create = []
+        to_delete = []
+        for assignment_id, (seg_prob_id, n_needed) in needed.iteritems():
+            current = sorted(slots[assignment_id])
+            if len(current) < n_needed:
+                to_create.extend(AssignmentSlot(assignment_id=assignment_id,
+                    seg_prob_id=seg_prob_id) for _ in
+                                 xrange(n_needed - len(current)))
+            else:
+                # the free ones first
+                to_delete.extend(pk for _, pk in
+                                 current[:len(current) - n_needed])
+
+        if to_create:
+            self.bulk_create(to_create)
+        for i in xrange(0, len(to_delete), self.DELETION_BATCH_SIZE):
+            self.filter(pk__in=to_delete[i:i + self.DELETION_BATCH_SIZE])\
+                .delete()
+
+    @h_decs.annotate(alters_data=True)
+    def rebuild(self, assignments):
+        """
+        Rebuilds the slots of 'assignments' from their sessions: a workable
+        assignment that isn't concluded has one slot per session with result
+        it still needs, held by its active sessions first. Reservations
+        without a session are lost, so it's meant to repair the slots (see
+        the reconcile_assignments command) rather than to keep them up to
+        date (see adjust).
+        """
+
+        for a in assignments.select_related('seg_prob__details'):
+            self.filter(assignment=a).delete()
+            if not a.workable or a.concluded or not a.seg_prob.has_details:
+                continue
+
+            n_slots = a.n_sessions_until_conclusion
+            active = a.sessions.get_active().order_by('start_time')\
+                .values_list('worker', 'expiration_deadline')[:n_slots]
+            slots = [AssignmentSlot(assignment=a, seg_prob_id=a.seg_prob_id,
+                                    worker_id=worker_id,
+                                    expiration_deadline=deadline)
+                     for worker_id, deadline in active]
+            slots.extend(AssignmentSlot(assignment=a,
+                                        seg_prob_id=a.seg_prob_id)
+                         for _ in xrange(n_slots - len(slots)))
+            self.bulk_create(slots)
+
+
+class AssignmentSlot(models.Model):
+    """
+    A place for a worker in an assignment, so that sessions are handed out by
+    taking the first free slot instead of counting the sessions of every
+    assignment.
+
+    An assignment has as many slots as sessions with result it still needs.
+    A slot is held by a worker while the session of the worker is active,
+    and used up when the session is closed with result. A worker may also
+    hold a slot, for a limited time, before creating a session for it (see
+    AssignmentSlotManager.reserve_next_for).
+    """
+
+    # ================
+    # model definition
+    # ================
+
+    assignment = models.ForeignKey(Assignment, verbose_name=_('assignment'),
+        related_name='slots', editable=False)
+
+    # the same as assignment.seg_prob, so that the slots are filtered and
+    # ordered without joining the assignments
+    seg_prob = models.ForeignKey(SegmentationProblem,
+        verbose_name=_('seg. problem'), related_name='assignment_slots',
+        editable=False)
+
+    worker = models.ForeignKey(User, verbose_name=_('worker'),
+        related_name='assignment_slots', null=True, editable=False)
+    expiration_deadline = models.DateTimeField(_('expiration deadline'),
+        null=True, editable=False)
+
+    objects = AssignmentSlotManager()
+
+    # the order in which the free slots are handed out (see
+    # crowd.models.indexes)
+    COMPOSITE_INDEXES = (
+        ('seg_prob', 'assignment'),
+    )
+
+    class Meta:
+        app_label = 'crowd'
+
+
 class AssignmentSessionStatsManager(models.Manager):
     def get_by_worker(self, worker):
         return self.filter(assignment_session__worker=worker)
     
     def get_by_assignment(self, assignment):
         return self.filter(assignment_session__assignment__id=assignment)
+
+    @transaction.commit_on_success
+    def _store_accuracies(self, pending, accuracies):
+        # locked, so that no score is corrected twice by concurrent runs
+        unscored = set(self.select_for_update().filter(
+            pk__in=accuracies.keys(), accuracy__isnull=True).values_list('pk',
+            flat=True))
+
+        penalties = collections.defaultdict(int)
+        for stats in pending:
+            if stats.pk not in unscored:
+                continue
+            stats.accuracy = accuracies[stats.pk]
+            self.filter(pk=stats.pk).update(accuracy=stats.accuracy)
+            penalties[stats.assignment_session.worker_id] += int(round(
+                (stats.mileage or 0) * (1 - stats.accuracy)))
+
+        for worker_id, penalty in penalties.iteritems():
+            if not penalty:
+                continue
+            profiles = WorkerProfile.objects.filter(user=worker_id)
+            if not profiles.filter(score__gte=penalty).update(
+                    score=F('score') - penalty):
+                profiles.update(score=0)
+        return len(unscored)
+
+    @h_decs.annotate(alters_data=True)
+    def update_accuracies(self, assignment):
+        """
+        Computes the accuracy of the sessions with result of 'assignment'
+        not scored yet against its merge and corrects the scores of their
+        workers, who were given the mileage as if the accuracy were 1.0 when
+        the sessions were closed. Returns the number of sessions scored.
+
+        The accuracies are computed by a single fmeasure call over all the
+        results, and stored along with the scores in one transaction.
+        """
+
+        pending = list(self.filter(assignment_session__assignment=assignment,
+            assignment_session__has_result=True,
+            accuracy__isnull=True).select_related('assignment_session'))
+        if not pending:
+            return 0
+
+        metrics = fm.fmeasure(assignment.merge.path,
+            [stats.assignment_session.result.path for stats in pending],
+            AssignmentSessionStats.ACCURACY_RADII)
+        accuracies = dict((stats.pk, AssignmentSessionStats.get_accuracy(m))
+                          for stats, m in zip(pending, metrics))
+        return self._store_accuracies(pending, accuracies)
 #    @h_decs.annotate(alters_data=True)
 #    def update_accuracy_by_assignment(self, assignment):
 #        sessions = AssignmentSession.objects.filter(assignment=assignment)
@@ -507,6 +1081,9 @@ class AssignmentSessionStats(models.Model):
     accuracy = models.DecimalField(_('accuracy'), max_digits=6, decimal_places=5, null=True)
     
     objects = AssignmentSessionStatsManager()
+
+    # the radii the accuracy is averaged over (see get_accuracy)
+    ACCURACY_RADII = range(2, 10)
     
     class Meta:
         app_label = 'crowd'
@@ -514,18 +1091,18 @@ class AssignmentSessionStats(models.Model):
     #def update_mileage(self, image_content):
      #   self.mileage = h_dip.count_foreground_pixels(image_content)
        
-    def update_accuracy(self):
-        rads = range(2,10)
-        n_radii = len(rads)
-        
-        metrics = fm.fmeasure(self.assignment_session.assignment.merge.path
-                              , [self.assignment_session.result.path], rads)
-        sum = 0
-        for radius in metrics[0]:
-            sum = sum + radius[2]
-        accuracy = sum/n_radii
-            
+    @classmethod
+    def get_accuracy(cls, metrics):
+        """Returns the accuracy of a result given its fmeasure 'metrics',
+        one per radius of ACCURACY_RADII."""
+        accuracy = sum(radius[2] for radius in metrics) / len(
+            cls.ACCURACY_RADII)
         if math.isnan(accuracy):
             accuracy = 0
-            
-        self.accuracy = accuracy
+        return Decimal('%.5f' % accuracy)
+
+    def update_accuracy(self):
+        metrics = fm.fmeasure(self.assignment_session.assignment.merge.path
+                              , [self.assignment_session.result.path],
+                              self.ACCURACY_RADII)
+        self.accuracy = self.get_accuracy(metrics[0])
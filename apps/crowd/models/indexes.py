@@ -0,0 +1,71 @@
+###############################################################################
+## Center for Advanced Computing Research
+## California Institute of Technology
+##
+## Composite indexes of models in crowd app.
+##
+## Copyright 2012 Rafael Barreto <barreto@cacr.caltech.edu>
+###############################################################################
+
+
+# ==============
+# Django imports
+# ==============
+
+from django.db import connection
+
+# ================
+# external imports
+# ================
+
+from south.db import db
+
+
+# Django 1.4 has no Meta.index_together, so the models declare their composite
+# indexes, as tuples of field names, in COMPOSITE_INDEXES. The migrations
+# create them and, for the tables created by syncdb (e.g. the test database
+# when the migrations aren't run), crowd.models.signals does.
+
+def get_composite_indexes(model):
+    """Returns the columns of the composite indexes of 'model' by the names
+    South creates them with."""
+
+    ret = {}
+    for field_names in getattr(model, 'COMPOSITE_INDEXES', ()):
+        columns = [model._meta.get_field(name).column for name in
+                   field_names]
+        ret[db.create_index_name(model._meta.db_table, columns)] = columns
+    return ret
+
+
+def get_index_names(table):
+    """Returns the names of the indexes of 'table' in the database."""
+
+    cursor = connection.cursor()
+    qn = connection.ops.quote_name
+    if connection.vendor == 'mysql':
+        cursor.execute('SHOW INDEX FROM %s' % qn(table))
+        return set(row[2] for row in cursor.fetchall())
+    elif connection.vendor == 'sqlite':
+        cursor.execute('PRAGMA index_list(%s)' % qn(table))
+        return set(row[1] for row in cursor.fetchall())
+    elif connection.vendor == 'postgresql':
+        cursor.execute('SELECT indexname FROM pg_indexes WHERE tablename = %s',
+            [table])
+        return set(row[0] for row in cursor.fetchall())
+    raise NotImplementedError('indexes of %s databases can\'t be listed' %
+                              connection.vendor)
+
+
+def create_composite_indexes(model):
+    """Creates the composite indexes of 'model' lacking in the database.
+    Returns their names."""
+
+    table = model._meta.db_table
+    existing = get_index_names(table)
+    created = []
+    for name, columns in sorted(get_composite_indexes(model).iteritems()):
+        if name not in existing:
+            db.create_index(table, columns)
+            created.append(name)
+    return created
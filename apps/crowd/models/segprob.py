@@ -12,20 +12,23 @@
 # Python stdlib imports
 # =====================
 from __future__ import with_statement
+import functools
 import logging
 import os
-import struct
 import uuid
 import tempfile
 
+from datetime import timedelta
+
 # ==============
 # Django imports
 # ==============
 from django.core.exceptions import ValidationError
-from django.core.files.base import File
 from django.core.validators import MinValueValidator, MaxValueValidator
 from django.db import models
+from django.db.models.query_utils import Q
 from django.db.utils import DatabaseError
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
 
@@ -33,9 +36,8 @@ from django.conf import settings
 # external imports
 # ================
 
+import numpy
 from PIL import Image
-from PIL import ImageMath
-from backports import lzma
 
 # ===============
 # project imports
@@ -45,6 +47,15 @@ import externals
 
 from crowd.models.exceptions import InvalidStateError
 from crowd.models.task import Task
+from crowd.processing.checkpoint import CreationCheckpoint
+from crowd.processing.livevessel import get_preprocessor
+from crowd.processing.merge import MergeArtifacts, PngStripWriter
+from crowd.processing.merge import merge_all, stitch_masks
+from crowd.processing.preprocess import PreprocessCache
+from crowd.processing.preprocess import read_preprocess_file
+from crowd.processing.preprocess import store_preprocess_files
+from crowd.processing.preprocess import write_preprocess_file
+from crowd.processing.tiling import TilingEngine
 from helpers import decorators as h_decs
 from helpers import dip as h_dip
 from helpers import filesystem as h_fs
@@ -52,11 +63,36 @@ from helpers import utils as h_utils
 from helpers.django_related import models as h_mod
 from helpers.django_related.utils import OverwriteStorage
 
-import subprocess
-
 debug_logger = logging.getLogger('debug')
 internal_errors_logger = logging.getLogger('internal_errors')
 
+class SegmentationProblemManager(models.Manager):
+    @h_decs.annotate(alters_data=True)
+    def lock(self, pk, field, timeout):
+        """
+        Takes the lock kept in the datetime 'field' of the segmentation problem
+        'pk', unless it's held and was taken less than 'timeout' seconds ago.
+        Returns whether it was taken.
+
+        The lock is taken by a single conditional UPDATE, so it holds across
+        processes whatever the cache backend is.
+        """
+
+        now = timezone.now()
+        return self.filter(Q(**{field + '__isnull': True}) |
+                           Q(**{field + '__lt': now - timedelta(
+                               seconds=timeout)}), pk=pk).update(
+            **{field: now}) == 1
+
+    @h_decs.annotate(alters_data=True)
+    def unlock(self, pk, field):
+        self.filter(pk=pk).update(**{field: None})
+
+    def is_locked(self, pk, field, timeout):
+        return self.filter(pk=pk, **{field + '__gte': timezone.now() -
+                                     timedelta(seconds=timeout)}).exists()
+
+
 class SegmentationProblem(models.Model):
     # ===============
     # class variables
@@ -68,20 +104,50 @@ class SegmentationProblem(models.Model):
         'large': (267, 200)
     }
 
+    CREATION_CHECKPOINT_NAME = 'creation.checkpoint'
+
+    # where the outputs of the merges are stored (see get_merge_file), under
+    # the root path
+    MERGES_DIRNAME = 'merges'
+
     # ===============
     # private methods
     # ===============
 
-    def _write_livevessel_preprocess_file(self, filename, costs, dimension, scales):
-        with open(filename, 'wb') as f:
-            n_scales = len(scales)
+    def _get_creation_checkpoint(self):
+        return CreationCheckpoint(os.path.join(self.assignments_root_path,
+            self.CREATION_CHECKPOINT_NAME), self.details.tiling_signature)
 
-            f.write(struct.pack('iii', dimension, dimension, n_scales))
-            f.write(struct.pack('%df' % n_scales, *scales))
+    def _delete_assignments(self):
+        try:
+            self.assignments.all().delete()
+        except DatabaseError:
+            debug_logger.exception('bulk deletion of assignments failed... '
+                                   'falling back to individual deletion')
+            map(lambda a: a.delete(), self.assignments.all())
 
-            for scale in costs:
-                for row in scale:
-                    f.write(struct.pack('%dB' % len(row), *row))
+    def _write_livevessel_preprocess_file(self, filename, costs, dimension, scales):
+        with open(filename, 'wb') as f:
+            write_preprocess_file(f, numpy.asarray(costs).reshape(
+                len(scales), dimension, dimension), scales)
+
+    def _cache_preprocess_files(self, raw_paths):
+        # so that no worker session has to decompress them
+        cache = PreprocessCache()
+        storage = self.assignments.model._meta.get_field(
+            'preprocess_file').storage
+        for pk, name in self.assignments.exclude(preprocess_file='')\
+                .values_list('pk', 'preprocess_file'):
+            try:
+                cache.put(pk, storage.path(name), raw_paths.get(name),
+                    evict=False)
+            except (IOError, OSError):
+                debug_logger.exception('preprocess file %s could not be '
+                                       'cached' % name)
+        try:
+            cache.evict()
+        except OSError:
+            debug_logger.exception('preprocess cache could not be evicted')
 
     def _image_upload_to_fun(self, filename):
         task = self.task
@@ -117,6 +183,16 @@ class SegmentationProblem(models.Model):
     # assignments
     published = models.BooleanField(_('published?'), default=False, blank=True)
 
+    # when the creation of the assignments was scheduled, while it's queued or
+    # running (see SegmentationProblemManager.lock)
+    creation_locked_at = models.DateTimeField(null=True, blank=True,
+        editable=False)
+    # the same for the merge of the assignments
+    merge_locked_at = models.DateTimeField(null=True, blank=True,
+        editable=False)
+
+    objects = SegmentationProblemManager()
+
     class Meta:
         app_label = 'crowd'
 
@@ -177,140 +253,141 @@ class SegmentationProblem(models.Model):
 
     @staticmethod
     def read_file(filename):
-        tmp_dir = tempfile.mkdtemp()
-        tmp_file_path = os.path.join(tmp_dir, 'tempfile')
-
-        try:
-            with lzma.open(filename, 'rb') as xz_file:
-                with open(tmp_file_path, 'wb') as tmp_file:
-                    tmp_file.write(xz_file.read())
-
-            costs = [[]]
-            #scales = []
-            with open(tmp_file_path, 'rb') as f:
-                width, height, n_scales = struct.unpack('iii', f.read(12))
-                scales = struct.unpack('%df' % n_scales, f.read(4*n_scales))
-
-                #costs = [[]]
-                i = 0
-                count = 0
-                a = f.read(width)
-                while a != '':
-                    costs[i].append(list(struct.unpack('%dB' % width, a)))
-                    a = f.read(width)
-
-                    count += 1
-                    if count == height:
-                        i += 1
-                        count = 0
-                        if i < 2:
-                            costs.append([])
-        finally:
-            h_fs.rm(tmp_dir, ignore_errors=True)
-
-        return {'costs': costs, 'scales': scales}
+        """Reads a LiveVessel preprocess file. The result is a mapping with
+        the keys 'costs' and 'scales' (see PreprocessData)."""
+        return read_preprocess_file(filename)
 
     def get_img_thumb_url(self, size):
         return getattr(self.image, 'url_%dx%d' % self.THUMB_SIZES[size])
 
     @h_decs.annotate(alters_data=True)
-    def create_assignments(self):
+    def create_assignments(self, progress=None, n_workers=None, resume=True):
+        """
+        Creates the assignments of this segmentation problem.
+
+        The tiles (and pre seg. tiles) are generated by a pool of 'n_workers'
+        processes (settings.CROWD_TILING_WORKERS by default). 'progress', if
+        given, is called as progress(stage, done, total).
+
+        Every tile, preprocess file and pre seg. tile is recorded in a
+        checkpoint as soon as it's stored, so a creation that fails is resumed
+        from where it stopped the next time, unless 'resume' is False or the
+        details the tiles depend on have changed meanwhile.
+        """
+
         # a segmentation problem can only have assignments if details about how
         # the assignments should be created are provided
         h_utils.require(self.has_details,
             InvalidStateError(_('This segmentation problem is lacking '
                                 'details.')))
 
-        # clear any previous assignments for this segmentation problem
-        self.clear_assignments()
+        checkpoint = self._get_creation_checkpoint()
+        if resume and checkpoint.matches():
+            # the files of the previous attempt are reused
+            self._delete_assignments()
+            debug_logger.debug('resuming creation of assignments for '
+                               'segmentation problem %d' % self.pk)
+        else:
+            # clear any previous assignments for this segmentation problem
+            self.clear_assignments()
+            checkpoint.start()
 
         details = self.details
+        model = self.assignments.model
+        engine = TilingEngine(
+            tiles_dim=details.tiles_dimension,
+            overlap_rel=details.tiles_overlap,
+            border_rel=details.tiles_border,
+            n_workers=n_workers,
+            progress=progress
+        )
         try:
             tmp_dir = tempfile.mkdtemp()
 
-            # generate the tiles for the assignments
-            tiles_info = h_dip.generate_tiles(
+            # generate the tiles (and their thumbnails) for the assignments
+            # straight into the storage, so saving the assignments below
+            # doesn't render the thumbnails again
+            tiles_info = engine.generate(
                 img_path=self.image.path,
-                tiles_dim=details.tiles_dimension,
-                overlap_rel=details.tiles_overlap,
-                border_rel=details.tiles_border,
-                dst_path=tmp_dir,
-                workable_checker=h_dip.simple_content_detection()
-            )[0]
+                storage=model._meta.get_field('tile').storage,
+                name_fun=lambda idx: os.path.join(
+                    self.assignments_root_rel_path, 'tile_%d.png' % idx),
+                thumb_sizes=model.THUMB_SIZES.values(),
+                workable_checker=h_dip.simple_content_detection(),
+                done=checkpoint.done('tiling'),
+                on_result=lambda info: checkpoint.record('tiling', info)
+            )
 
             assignments = []
+            # decompressed preprocess files by the name they're stored with
+            raw_preprocess_paths = {}
             for info in tiles_info:
-                a = self.assignments.model(
+                a = model(
                     seg_prob=self,
-                    tile_bbox_x0=info['cropped_bbox'][0],
-                    tile_bbox_y0=info['cropped_bbox'][1],
-                    tile_bbox_x1=info['cropped_bbox'][2],
-                    tile_bbox_y1=info['cropped_bbox'][3],
+                    tile_bbox_x0=info['bbox'][0],
+                    tile_bbox_y0=info['bbox'][1],
+                    tile_bbox_x1=info['bbox'][2],
+                    tile_bbox_y1=info['bbox'][3],
                     workable=info['workable']
                 )
-                with open(info['path'], 'rb') as f:
-                    a.tile.save(os.path.basename(info['path']), File(f),
-                        save=False)
+                a.tile = info['name']
                 assignments.append(a)
 
             if details.algorithm == u'LIVEVESSEL':
-                files_temp_path = []
-                live_script_rel_path = '../externals/matlab/livevessel_pre_process/'
-                livevessel_preprocess_script = h_fs.get_absolute_path(live_script_rel_path, settings.PROJECT_ROOT)
-                processes = []
-                for a in assignments:
-                    tile_number = os.path.basename(os.path.splitext(a.tile.path)[0]).split('_')[1]
-                    basedir = 'liv_preprocess_' + tile_number
-                    temp_path = os.path.join(tmp_dir, basedir)
-                    files_temp_path.append(temp_path)
-
-                    code = "addpath(genpath('"+ livevessel_preprocess_script + "'));"
-                    code = code + "offline('" + a.tile.path + "', '" + temp_path + "');"
-                    code = code + "exit;"
-
-                    processes.append(subprocess.Popen(
-                        ["/usr/local/bin/matlab", "-nosplash", "-nodesktop", "-nojvm", "-r", code],
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE))
-
-
-                exit_code = [process.communicate() for process in processes]
-                #print "next process"
-                #out, err = process.communicate()
-
-                index = 0
-                for a in assignments:
-                    compressed_file_path = files_temp_path[index] + '.xz'
-                    with open(files_temp_path[index], 'rb') as f:
-                        with lzma.open(compressed_file_path, 'wb') as xz_file:
-                            xz_file.write(f.read())
-
-                    with open(compressed_file_path, 'rb') as f:
-                        basename = os.path.basename(compressed_file_path)
-                        a.preprocess_file.save(basename, File(f), save=False)
-                    index += 1
-
-
+                preprocessed = checkpoint.done('preprocessing')
+                jobs = []
+                for a, info in zip(assignments, tiles_info):
+                    if info['index'] in preprocessed:
+                        a.preprocess_file = preprocessed[info['index']]['name']
+                    else:
+                        jobs.append((info['index'], a, os.path.join(tmp_dir,
+                            'liv_preprocess_%d' % info['index'])))
+
+                preprocessor = get_preprocessor(progress=progress)
+                failures = preprocessor.run([(a.tile.path, temp_path) for
+                                             _, a, temp_path in jobs])
+
+                # tiles that could not be preprocessed can't be worked on, but
+                # they shouldn't prevent the others from being created
+                failed_paths = set()
+                for failure in failures:
+                    internal_errors_logger.error('LiveVessel preprocessing of '
+                                                 '%s failed after %d '
+                                                 'attempt(s): %s' % (
+                        failure['tile'], failure['attempts'],
+                        failure['reason']))
+                    failed_paths.add(failure['output'])
+
+                to_store = []
+                for idx, a, temp_path in jobs:
+                    if temp_path in failed_paths:
+                        a.workable = False
+                    else:
+                        to_store.append((idx, a.preprocess_file, temp_path))
+
+                store_preprocess_files([(field_file, temp_path) for
+                                        _, field_file, temp_path in to_store])
+                for idx, field_file, temp_path in to_store:
+                    checkpoint.record('preprocessing',
+                        {'index': idx, 'name': field_file.name})
+                    raw_preprocess_paths[field_file.name] = temp_path
 
             if details.pre_seg:
                 # generate pre segs. for the tiles
-                pre_seg_tiles_info, border = h_dip.generate_tiles(
+                pre_seg_tiles_info = engine.generate(
                     img_path=details.pre_seg.path,
-                    tiles_dim=details.tiles_dimension,
-                    overlap_rel=details.tiles_overlap,
-                    border_rel=details.tiles_border,
-                    dst_path=tmp_dir,
-                    tiles_prefix='pre_seg_'
+                    storage=model._meta.get_field('pre_seg').storage,
+                    name_fun=lambda idx: os.path.join(
+                        self.assignments_root_rel_path,
+                        'pre_seg_tile_%d.png' % idx),
+                    crop_border=True,
+                    stage='pre_seg',
+                    done=checkpoint.done('pre_seg'),
+                    on_result=lambda info: checkpoint.record('pre_seg', info)
                 )
                 assert len(tiles_info) == len(pre_seg_tiles_info)
                 for a, info in zip(assignments, pre_seg_tiles_info):
-                    img = Image.open(info['path'])
-                    img_w, img_h = img.size
-                    img.crop((border, border, img_w - border,
-                              img_h - border)).save(info['path'])
-                    with open(info['path'], 'rb') as f:
-                        a.pre_seg.save(os.path.basename(info['path']), File(f),
-                            save=False)
+                    a.pre_seg = info['name']
 
             # effectively create the assignments
             try:
@@ -320,48 +397,139 @@ class SegmentationProblem(models.Model):
                                        'failed... falling back to individual '
                                        'creation' % len(assignments))
                 map(lambda a: a.save(), assignments)
+            self.assignments.sync_slots()
+            checkpoint.clear()
+
+            if raw_preprocess_paths:
+                self._cache_preprocess_files(raw_preprocess_paths)
 
             # in case of success, return the number of assignments created
             return len(assignments)
         except:
-            # in case any thing goes wrong, undo and log the problem to the
-            # administrators
-            self.clear_assignments()
+            # in case any thing goes wrong, undo what can't be resumed and log
+            # the problem to the administrators
+            self._delete_assignments()
             internal_errors_logger.exception('assignments for segmentation '
                                              'problem %d could not be '
-                                             'created' % self.pk)
+                                             'created (the creation can be '
+                                             'resumed)' % self.pk)
         finally:
             h_fs.rm(tmp_dir, ignore_errors=True)
 
     @h_decs.annotate(alters_data=True)
     def clear_assignments(self):
-        try:
-            self.assignments.all().delete()
-        except DatabaseError:
-            debug_logger.exception('bulk deletion of assignments failed... '
-                                   'falling back to individual deletion')
-            map(lambda a: a.delete(), self.assignments.all())
+        self._delete_assignments()
         h_fs.rm(self.assignments_root_path, ignore_errors=True)
 
+    def get_merge_artifacts(self):
+        """Returns the stored outputs of the merge of the assignments (see
+        get_merge_file), versioned by the sessions with result."""
+        return MergeArtifacts(os.path.join(self.root_path,
+            self.MERGES_DIRNAME), 'seg_prob', self.assignments.filter(
+            sessions__has_result=True).values_list('sessions__pk', flat=True),
+            (getattr(settings, 'CROWD_MERGE_ALPHA', 2.0),))
+
+    def get_merge_file(self, overlay=False, build=True):
+        """
+        Returns the version of the merge of the assignments and the path of
+        its PNG, or of the PNG of the merge painted red over the image if
+        'overlay'. They're only built again once the sessions with result
+        change, unless the results of any assignment couldn't be merged, in
+        which case the version is None.
+
+        Unless 'build', the one stored last is returned instead of building
+        it, whose version is None if it's out of date (see
+        crowd.tasks.MergeAssignmentsTask).
+        """
+
+        def build_merge(output_path):
+            if self.merge_assignments(output_path):
+                return MergeArtifacts.INCOMPLETE
+            return True
+
+        def build_overlay(output_path):
+            ret = Image.open(self.image.path).convert('RGBA')
+            ret.paste((255, 0, 0), None, Image.open(path))
+            ret.save(output_path, format='PNG')
+            return version is not None or MergeArtifacts.INCOMPLETE
+
+        artifacts = self.get_merge_artifacts()
+        if not build:
+            name = 'overlay' if overlay else 'merge'
+            path = artifacts.get_stored(name)
+            return artifacts.get_version(name, path), path
+
+        path = artifacts.get('merge', build_merge)
+        version = artifacts.get_version('merge', path)
+        if path is not None and overlay:
+            path = artifacts.get('overlay', build_overlay)
+            version = artifacts.get_version('overlay', path)
+        return version, path
+
+    @staticmethod
+    def _get_merge_placement(tile_bbox, border_sz):
+        # the merges cover the whole tiles, whose bbox (see
+        # Assignment.tile_bbox_*) includes the border, but only the part
+        # without the border is kept. Returns where that part goes in the
+        # image, (x0, y0), and the box of the merge it's taken from
+        x0, y0, x1, y1 = tile_bbox
+        return (x0 + border_sz, y0 + border_sz,
+                (border_sz, border_sz, x1 - x0 - border_sz,
+                 y1 - y0 - border_sz))
+
+    @staticmethod
+    def _load_assignment_merge(path, box):
+        # the part of the merge of an assignment within 'box' (x0, y0, x1, y1)
+        x0, y0, x1, y1 = box
+        return numpy.asarray(Image.open(path))[y0:y1, x0:x1]
+
     @h_decs.annotate(alters_data=True)
-    def merge_assignments(self):
-        ret = Image.new('1', Image.open(self.image.path).size)
-        if self.has_assignments:
-            t_dim = self.details.tiles_dimension
-            border_sz = int(t_dim * self.details.tiles_border)
-            assignments = self.assignments.all()
-            for a in assignments:
-                a_mask = a.merge_results()
-                if a_mask is None:
-                    continue
-
-                x0, y0 = a.tile_bbox_x0 + border_sz, a.tile_bbox_y0 + border_sz
-                x1, y1 = a.tile_bbox_x1 - border_sz, a.tile_bbox_y1 - border_sz
-
-                bbox = (x0, y0, x1, y1)
-                ret.paste(ImageMath.eval('a | b', a = ret.crop(bbox),
-                    b = a_mask), bbox)
-        return ret
+    def merge_assignments(self, path, n_workers=None):
+        """
+        Writes the merge of the assignments to 'path' as a 1-bit PNG of the
+        size of the image: the OR of the merges of their results, without the
+        tile borders. Returns the errors, by assignment id, of the
+        assignments whose results couldn't be merged, which are left out.
+
+        The merges of the assignments are computed by a pool of 'n_workers'
+        processes (settings.CROWD_MERGE_PROCESSES by default) and then
+        stitched settings.CROWD_MERGE_STRIP_HEIGHT rows at a time (see
+        crowd.processing.merge.stitch_masks), so the whole image is never in
+        memory.
+        """
+
+        n_workers = n_workers or getattr(settings, 'CROWD_MERGE_PROCESSES', 4)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            placements = []
+            failures = {}
+            if self.has_assignments:
+                jobs = self.assignments.get_merge_jobs(tmp_dir)
+                outputs, failures = merge_all([job for _, job in jobs],
+                    n_workers)
+                for pk, error in failures.iteritems():
+                    internal_errors_logger.error('results of assignment %d '
+                                                 'could not be merged: %s' %
+                                                 (pk, error))
+
+                t_dim = self.details.tiles_dimension
+                border_sz = int(t_dim * self.details.tiles_border)
+                for a, _ in jobs:
+                    if outputs.get(a.pk) is None:
+                        continue
+                    x0, y0, box = self._get_merge_placement(
+                        (a.tile_bbox_x0, a.tile_bbox_y0, a.tile_bbox_x1,
+                         a.tile_bbox_y1), border_sz)
+                    placements.append((x0, y0, functools.partial(
+                        self._load_assignment_merge, outputs[a.pk], box)))
+
+            with open(path, 'wb') as f:
+                stitch_masks(placements, PngStripWriter(f,
+                    Image.open(self.image.path).size), getattr(settings,
+                    'CROWD_MERGE_STRIP_HEIGHT', 1024))
+            return failures
+        finally:
+            h_fs.rm(tmp_dir, ignore_errors=True)
 
 
 class SegmentationProblemDetails(models.Model):
@@ -395,6 +563,11 @@ class SegmentationProblemDetails(models.Model):
     DEFAULT_MIN_RESULTS_PER_ASSIGNMENT = 5
     DEFAULT_ASSIGNMENTS_TIMEOUT = 300  # 5 minutes
 
+    # fields the tiles (and their preprocess files) depend on. Changing any
+    # other field leaves the assignments alone
+    TILING_FIELDS = ('algorithm', 'pre_seg', 'tiles_dimension',
+                     'tiles_overlap', 'tiles_border')
+
     # ================
     # model definition
     # ================
@@ -438,6 +611,33 @@ class SegmentationProblemDetails(models.Model):
         verbose_name = _('segmentation problem details')
         verbose_name_plural = _('segmentation problems details')
 
+    # ==========
+    # properties
+    # ==========
+
+    @property
+    def tiling_signature(self):
+        """Values of the image and of the fields the tiles depend on."""
+        return [self.seg_prob.image.name] + [unicode(getattr(self, f)) for f
+                                             in self.TILING_FIELDS]
+
+    @property
+    def tiling_changed(self):
+        """True if any of the fields the tiles depend on differs from the
+        stored details."""
+
+        if self.pk is None:
+            return True
+        try:
+            stored = type(self).objects.get(pk=self.pk)
+        except type(self).DoesNotExist:
+            return True
+
+        # a new pre seg. may be uploaded under the same name
+        if self.pre_seg and not self.pre_seg._committed:
+            return True
+        return self.tiling_signature != stored.tiling_signature
+
     # ==================
     # overridden methods
     # ==================
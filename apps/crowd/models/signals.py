@@ -14,13 +14,19 @@
 
 import logging
 
+# ================
+# external imports
+# ================
+
+from celery import current_app
+
 # ==============
 # Django imports
 # ==============
 
 from django.contrib.auth import user_logged_out
 from django.db.models.signals import post_delete, pre_save, pre_delete, \
-    post_save
+    post_save, post_syncdb
 from django.dispatch.dispatcher import receiver
 
 # ===============
@@ -29,7 +35,10 @@ from django.dispatch.dispatcher import receiver
 
 import helpers
 
+from crowd.models.assignment import Assignment
 from crowd.models.assignment import AssignmentSession
+from crowd.models.assignment import AssignmentSlot
+from crowd.models.indexes import create_composite_indexes
 from crowd.models.segprob import SegmentationProblem
 from crowd.models.segprob import SegmentationProblemDetails
 from crowd.models.task import Task
@@ -56,11 +65,129 @@ def _seg_prob_post_delete(sender, **kwargs):
 @disable_for_loaddata
 def _seg_prob_details_pre_change(sender, **kwargs):
     instance = kwargs['instance']
+    # e.g. changing the timeout of the assignments doesn't invalidate them
+    if kwargs.get('signal') is pre_save and not instance.tiling_changed:
+        return
     instance.seg_prob.clear_assignments()
     debug_logger.debug('%s "%s" pre change (pre_save | pre_delete) triggered' %
                        (sender.__name__, instance))
 
 
+@receiver(pre_save, sender=SegmentationProblemDetails,
+    dispatch_uid='6a2f8c4e-1d7b-4e93-a0c5-b8e3f7d21c96')
+@disable_for_loaddata
+def _seg_prob_details_pre_save(sender, **kwargs):
+    instance = kwargs['instance']
+    # the number of slots of the assignments depends on it
+    instance._min_results_changed = instance.pk is not None and not \
+        type(instance).objects.filter(pk=instance.pk,
+            min_results_per_assignment=instance.min_results_per_assignment)\
+        .exists()
+
+
+@receiver(post_save, sender=SegmentationProblemDetails,
+    dispatch_uid='c1a0e1c6-3f0b-4a8e-9d55-0e7d2c6b8f41')
+@disable_for_loaddata
+def _seg_prob_details_post_save(sender, **kwargs):
+    instance = kwargs['instance']
+    if getattr(instance, '_min_results_changed', False):
+        instance._min_results_changed = False
+        AssignmentSlot.objects.adjust(instance.seg_prob.assignments.all())
+
+
+@receiver(post_save, sender=Assignment,
+    dispatch_uid='5f0c7d0e-8b8a-4d1e-a2f3-6c9b4e2d7a13')
+@disable_for_loaddata
+def _assignment_post_save(sender, **kwargs):
+    # e.g. it may have been concluded or made unworkable. The slots that are
+    # still needed are kept, along with their reservations
+    AssignmentSlot.objects.adjust(Assignment.objects.filter(
+        pk=kwargs['instance'].pk))
+
+
+@receiver(post_delete, sender=Assignment,
+    dispatch_uid='8e4b2d17-6a3c-4f9e-b1d5-c7a0f3e92b64')
+def _assignment_post_delete(sender, **kwargs):
+    instance = kwargs['instance']
+    # the running count of its results (see Assignment.get_votes)
+    try:
+        instance.get_votes().clear()
+    except Exception:
+        debug_logger.exception('votes of %s "%s" not removed' %
+                               (sender.__name__, instance))
+
+
+@receiver(post_save, sender=AssignmentSession,
+    dispatch_uid='a7e2c9d4-5b1f-4c8e-8f3a-1d6b0e9c2f58')
+@disable_for_loaddata
+def _count_session_post_save(sender, **kwargs):
+    a_session = kwargs['instance']
+    if kwargs['created']:
+        Assignment.objects.move_session_count(a_session.assignment_id,
+            target=a_session.counter_name)
+    elif getattr(a_session, '_just_closed', False):
+        Assignment.objects.move_session_count(a_session.assignment_id,
+            'open_sessions_count', a_session.counter_name)
+    a_session._just_closed = False
+
+
+@receiver(post_delete, sender=AssignmentSession,
+    dispatch_uid='3c8f1b6a-9e2d-4d7b-a5c0-7b4e6f2a1d83')
+@disable_for_loaddata
+def _count_session_post_delete(sender, **kwargs):
+    a_session = kwargs['instance']
+    Assignment.objects.move_session_count(a_session.assignment_id,
+        source=a_session.counter_name)
+
+
+@receiver(post_save, sender=AssignmentSession,
+    dispatch_uid='5d2a9e71-4c3b-4f8d-b6e0-8a1f7c2d9e46')
+@disable_for_loaddata
+def _count_session_result_votes(sender, **kwargs):
+    a_session = kwargs['instance']
+    mask = getattr(a_session, '_result_mask', None)
+    if mask is None:
+        return
+    a_session._result_mask = None
+    try:
+        a_session.assignment.get_votes().add(a_session.pk, mask)
+    except Exception:
+        # the result is counted when the results are merged (see
+        # Assignment.merge_results)
+        debug_logger.exception('result of %s "%s" not counted' %
+                               (sender.__name__, a_session))
+
+
+@receiver(post_save, sender=AssignmentSession,
+    dispatch_uid='0b6f4f3e-2d7c-4f55-8e0a-9a4c1d3b5e27')
+@disable_for_loaddata
+def _update_assignment_slot(sender, **kwargs):
+    a_session = kwargs['instance']
+    if a_session.closed:
+        AssignmentSlot.objects.release(a_session)
+    elif kwargs['created']:
+        AssignmentSlot.objects.claim(a_session)
+
+
+@receiver(post_delete, sender=AssignmentSession,
+    dispatch_uid='e3d8a6b1-7c4f-4a2e-b9d0-2f5e8c1a6d94')
+@disable_for_loaddata
+def _release_assignment_slot(sender, **kwargs):
+    a_session = kwargs['instance']
+    if not a_session.closed:
+        AssignmentSlot.objects.release(a_session)
+
+
+@receiver(post_syncdb, dispatch_uid='b4c7e2a9-3d6f-4e1b-8a50-9f2d1c7e6b38')
+def _create_composite_indexes(sender, **kwargs):
+    # for the tables created by syncdb instead of the migrations (see
+    # crowd.models.indexes)
+    for model in kwargs['created_models']:
+        for name in create_composite_indexes(model):
+            debug_logger.debug('index %s of %s created' % (name,
+                                                          model.__name__))
+
+
 @receiver(pre_save, sender=Task,
     dispatch_uid='da4151d5-23ce-490b-b13d-ba4ab6e24156')
 @receiver(pre_save, sender=TaskCategory,
@@ -91,8 +218,16 @@ def _cancel_last_worker_session(sender, **kwargs):
     dispatch_uid='77d49629-1034-4fac-b6ef-35239f38c348')
 def _check_assignment_conclusion(sender, **kwargs):
     a_session = kwargs['instance']
-    a = a_session.assignment
+    # fetched again, as the session counters have just been updated
+    a = Assignment.objects.get(pk=a_session.assignment_id)
     if not a.concluded and a.n_sessions_until_conclusion == 0:
         a.concluded = True
-        a.merge_results()
         a.save()
+        # the merge and the scoring are done out of the request (see
+        # crowd.tasks.ConcludeAssignmentTask), which is referred by name as
+        # the tasks module depends on the models
+        try:
+            current_app.send_task('crowd.conclude_assignment', args=(a.pk,))
+        except Exception, e:
+            # it's scheduled again by crowd.tasks.ScoreConcludedAssignmentsTask
+            debug_logger.debug('conclusion of "%s" not scheduled: %s' % (a, e))
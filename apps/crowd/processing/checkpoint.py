@@ -0,0 +1,90 @@
+###############################################################################
+## Center for Advanced Computing Research
+## California Institute of Technology
+##
+## Checkpoints of the creation of assignments.
+##
+## Copyright 2012 Rafael Barreto <barreto@cacr.caltech.edu>
+###############################################################################
+
+
+# =====================
+# Python stdlib imports
+# =====================
+
+import json
+import os
+
+
+class CreationCheckpoint(object):
+    """
+    Log of the finished steps of the creation of the assignments of a
+    segmentation problem, so that a failed creation can be resumed.
+
+    It's stored at 'path' as JSON lines: the first one holds the 'signature'
+    of the parameters the steps depend on, and each of the others the 'info'
+    of a step (a dict with, at least, an 'index') of a 'stage'. A checkpoint
+    whose signature differs from the expected one is meaningless.
+    """
+
+    def __init__(self, path, signature):
+        self.path = path
+        self.signature = signature
+        self._stages = None
+
+    # ===============
+    # private methods
+    # ===============
+
+    def _load(self):
+        self._stages = {}
+        if not os.path.exists(self.path):
+            return False
+
+        with open(self.path) as f:
+            lines = f.readlines()
+        try:
+            if json.loads(lines[0])['signature'] != self.signature:
+                return False
+            for line in lines[1:]:
+                step = json.loads(line)
+                self._stages.setdefault(step['stage'], {})[
+                    step['info']['index']] = step['info']
+        except (IndexError, KeyError, ValueError):
+            # the last line may be incomplete if the process died writing it
+            pass
+        return True
+
+    # ==============
+    # public methods
+    # ==============
+
+    def matches(self):
+        """True if there's a checkpoint for the expected signature."""
+        return self._load()
+
+    def start(self):
+        """Discards any previous checkpoint and starts a new one."""
+
+        dir_path = os.path.dirname(self.path)
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        with open(self.path, 'w') as f:
+            f.write(json.dumps({'signature': self.signature}) + '\n')
+        self._stages = {}
+
+    def done(self, stage):
+        """Returns the infos of the finished steps of 'stage' by index."""
+        if self._stages is None:
+            self._load()
+        return dict(self._stages.get(stage, {}))
+
+    def record(self, stage, info):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'stage': stage, 'info': info}) + '\n')
+        self._stages.setdefault(stage, {})[info['index']] = info
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._stages = {}
@@ -0,0 +1,97 @@
+###############################################################################
+## Center for Advanced Computing Research
+## California Institute of Technology
+##
+## NumPy implementation of the LiveVessel offline cost computation.
+##
+## Copyright 2012 Rafael Barreto <barreto@cacr.caltech.edu>
+###############################################################################
+
+
+# ================
+# external imports
+# ================
+
+import numpy
+from PIL import Image
+from scipy import ndimage
+
+# ===============
+# project imports
+# ===============
+
+from crowd.processing.preprocess import write_preprocess_file
+
+
+# EXPERIMENTAL: these costs are a Frangi vesselness written after the
+# description of the MATLAB 'offline' script, not a port of it, so they differ
+# from the ones it computes. Only the layout of the preprocess files is the
+# same. That's why they can't be selected as a LiveVessel backend (see
+# crowd.processing.livevessel.PREPROCESSORS): they're only compared with
+# MATLAB preprocess files by the livevessel_benchmark command.
+
+DEFAULT_SCALES = (1.0, 2.0, 3.0)
+
+# sensitivity of the vesselness to blob-like structures
+BETA = 0.5
+
+_EPS = 1e-10
+
+
+def _hessian_eigenvalues(channel, scale):
+    """Returns the eigenvalues of the scale-normalized Hessian of 'channel',
+    the one with the smallest magnitude first."""
+
+    norm = scale ** 2
+    hxx = ndimage.gaussian_filter(channel, scale, order=(0, 2)) * norm
+    hyy = ndimage.gaussian_filter(channel, scale, order=(2, 0)) * norm
+    hxy = ndimage.gaussian_filter(channel, scale, order=(1, 1)) * norm
+
+    trace = hxx + hyy
+    delta = numpy.sqrt((hxx - hyy) ** 2 + 4 * hxy ** 2)
+    l1, l2 = (trace + delta) / 2, (trace - delta) / 2
+
+    swap = numpy.abs(l1) > numpy.abs(l2)
+    return numpy.where(swap, l2, l1), numpy.where(swap, l1, l2)
+
+
+def vesselness(channel, scale):
+    """
+    Frangi's vesselness of the dark tubular structures of 'channel' at
+    'scale', in [0, 1].
+    """
+
+    small, large = _hessian_eigenvalues(channel, scale)
+
+    blobness = (small / numpy.where(large == 0, _EPS, large)) ** 2
+    structureness = small ** 2 + large ** 2
+    c = max(numpy.sqrt(structureness.max()) / 2, _EPS)
+
+    ret = numpy.exp(-blobness / (2 * BETA ** 2)) *\
+          (1 - numpy.exp(-structureness / (2 * c ** 2)))
+    # vessels are darker than the background, i.e. the largest curvature is
+    # positive across them
+    ret[large < 0] = 0
+    return ret / max(ret.max(), _EPS)
+
+
+def compute_costs(img, scales=DEFAULT_SCALES):
+    """
+    Returns the LiveVessel costs of the PIL image 'img' as an uint8 array of
+    shape (n_scales, height, width). The lower the cost, the more likely the
+    pixel belongs to a vessel at that scale.
+    """
+
+    # vessels have the best contrast in the green channel of retina images
+    channel = numpy.asarray(img.convert('RGB'), dtype=numpy.float64)[..., 1]
+    return numpy.array([numpy.rint(255 * (1 - vesselness(channel, s)))
+                        for s in scales], dtype=numpy.uint8)
+
+
+def preprocess_tile(tile_path, output_path, scales=DEFAULT_SCALES):
+    """Writes the preprocess file of the tile at 'tile_path' in the same
+    format as the MATLAB 'offline' script."""
+
+    costs = compute_costs(Image.open(tile_path), scales)
+    with open(output_path, 'wb') as f:
+        write_preprocess_file(f, costs, scales)
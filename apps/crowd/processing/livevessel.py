@@ -0,0 +1,288 @@
+###############################################################################
+## Center for Advanced Computing Research
+## California Institute of Technology
+##
+## LiveVessel preprocessing of assignment tiles.
+##
+## Copyright 2012 Rafael Barreto <barreto@cacr.caltech.edu>
+###############################################################################
+
+
+# =====================
+# Python stdlib imports
+# =====================
+
+import collections
+import logging
+import os
+import subprocess
+import tempfile
+import time
+
+# ==============
+# Django imports
+# ==============
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# ===============
+# project imports
+# ===============
+
+from helpers import filesystem as h_fs
+
+
+debug_logger = logging.getLogger('debug')
+
+LIVEVESSEL_SCRIPT_REL_PATH = '../externals/matlab/livevessel_pre_process/'
+
+# suffix of the name an output is written under until it's complete, when
+# it's renamed to its final name
+PARTIAL_OUTPUT_SUFFIX = '.part'
+
+# MATLAB code preprocessing every tile listed in a manifest, so the MATLAB
+# startup cost is paid once per manifest instead of once per tile. A tile
+# that fails doesn't prevent the following ones from being preprocessed.
+MATLAB_BATCH_CODE = (
+    "addpath(genpath('%(script)s'));"
+    "fid = fopen('%(manifest)s');"
+    "line = fgetl(fid);"
+    "while ischar(line),"
+    " paths = regexp(line, '\\t', 'split');"
+    " partial = [paths{2} '%(partial_suffix)s'];"
+    " try, offline(paths{1}, partial);"
+    " movefile(partial, paths{2}, 'f');"
+    " catch err, disp(getReport(err)); end;"
+    " line = fgetl(fid);"
+    "end;"
+    "fclose(fid);"
+    "exit;")
+
+
+def write_manifest(path, jobs):
+    """
+    Writes the manifest of a batch of (tile path, output path) pairs: one
+    line per tile with both paths separated by a tab.
+    """
+
+    with open(path, 'w') as f:
+        for tile_path, output_path in jobs:
+            f.write('%s\t%s\n' % (tile_path, output_path))
+
+
+def get_command(manifest_path):
+    """
+    Returns the arguments of the process that preprocesses every tile listed
+    in the manifest at 'manifest_path'.
+
+    By default, the MATLAB 'offline' script is used. It can be replaced by
+    any executable through settings.CROWD_LIVEVESSEL_COMMAND, a list of
+    arguments where '%(manifest)s' is substituted. Such an executable must
+    preprocess the tiles in the order they are listed and write each output
+    under its name plus PARTIAL_OUTPUT_SUFFIX, renaming it once it's
+    complete: an output is taken as finished as soon as it exists.
+    """
+
+    template = getattr(settings, 'CROWD_LIVEVESSEL_COMMAND', None)
+    if template:
+        return [arg % {'manifest': manifest_path} for arg in template]
+
+    script_path = h_fs.get_absolute_path(LIVEVESSEL_SCRIPT_REL_PATH,
+        settings.PROJECT_ROOT)
+    return [getattr(settings, 'CROWD_LIVEVESSEL_MATLAB',
+                '/usr/local/bin/matlab'),
+            '-nosplash', '-nodesktop', '-nojvm', '-r',
+            MATLAB_BATCH_CODE % {'script': script_path,
+                                 'manifest': manifest_path,
+                                 'partial_suffix': PARTIAL_OUTPUT_SUFFIX}]
+
+
+class PreprocessScheduler(object):
+    """
+    Runs the LiveVessel preprocessing of many tiles in batches, keeping at
+    most 'max_processes' processes in flight.
+
+    Each process preprocesses a batch of 'batch_size' tiles listed in a
+    manifest (by default, the tiles are split evenly among the processes).
+    A process that doesn't finish any tile in 'timeout' seconds is killed.
+    A tile that isn't preprocessed is retried up to 'retries' times.
+    'progress', if given, is called as progress('preprocessing', done, total)
+    every time a tile is finished (successfully or not).
+
+    Any other preprocessor can be used in place of this one as long as it
+    provides run(jobs) with the same semantics.
+    """
+
+    POLL_INTERVAL = 0.1
+
+    # amount of the process output kept in the failure reports
+    OUTPUT_TAIL_SIZE = 1024
+
+    def __init__(self, max_processes=None, timeout=None, retries=None,
+                 batch_size=None, command_fun=get_command, progress=None):
+        self.max_processes = max_processes or getattr(settings,
+            'CROWD_LIVEVESSEL_PROCESSES', 4)
+        self.timeout = timeout or getattr(settings,
+            'CROWD_LIVEVESSEL_TIMEOUT', 600)
+        self.retries = retries if retries is not None else getattr(settings,
+            'CROWD_LIVEVESSEL_RETRIES', 1)
+        self.batch_size = batch_size or getattr(settings,
+            'CROWD_LIVEVESSEL_BATCH_SIZE', None)
+        self.command_fun = command_fun
+        self.progress = progress
+
+    # ===============
+    # private methods
+    # ===============
+
+    def _get_batch_size(self, n_jobs):
+        if self.batch_size:
+            return self.batch_size
+        return max(1, -(-n_jobs // self.max_processes))
+
+    def _start(self, batch, tmp_dir):
+        fd, manifest_path = tempfile.mkstemp(suffix='.manifest', dir=tmp_dir)
+        os.close(fd)
+        write_manifest(manifest_path, [(tile_path, output_path) for
+                                       tile_path, output_path, _ in batch])
+
+        log = tempfile.TemporaryFile()
+        process = subprocess.Popen(self.command_fun(manifest_path),
+            stdout=log, stderr=subprocess.STDOUT)
+        return {'process': process, 'remaining': list(batch), 'log': log,
+                'last_progress': time.time()}
+
+    def _check(self, running):
+        """Returns None while 'running' hasn't finished, '' if it exited
+        normally and the failure reason otherwise."""
+
+        process = running['process']
+        if process.poll() is None:
+            if time.time() - running['last_progress'] <= self.timeout:
+                return None
+            process.kill()
+            process.wait()
+            reason = 'timed out after %d seconds' % self.timeout
+        elif process.returncode != 0:
+            reason = 'exited with code %d' % process.returncode
+        else:
+            return ''
+
+        log = running['log']
+        log.seek(0, os.SEEK_END)
+        log.seek(max(0, log.tell() - self.OUTPUT_TAIL_SIZE))
+        return '%s: %s' % (reason, log.read().strip())
+
+    # ==============
+    # public methods
+    # ==============
+
+    def run(self, jobs):
+        """
+        Preprocesses the (tile path, output path) pairs in 'jobs'.
+
+        Returns the list of failures, i.e. dicts with the keys 'tile',
+        'output', 'attempts' and 'reason', of the tiles that could not be
+        preprocessed even after retrying.
+        """
+
+        jobs = [(tile_path, output_path, 1) for tile_path, output_path in
+                jobs]
+        batch_size = self._get_batch_size(len(jobs))
+        pending = collections.deque(jobs[i:i + batch_size] for i in
+                                    xrange(0, len(jobs), batch_size))
+        running = []
+        failures = []
+        state = {'done': 0}
+
+        def finish(job, reason=None):
+            tile_path, output_path, attempt = job
+            if reason is not None:
+                failures.append({'tile': tile_path, 'output': output_path,
+                                 'attempts': attempt, 'reason': reason})
+            state['done'] += 1
+            if self.progress is not None:
+                self.progress('preprocessing', state['done'], len(jobs))
+
+        def retry(batch, reason):
+            to_retry = []
+            for tile_path, output_path, attempt in batch:
+                if attempt <= self.retries:
+                    to_retry.append((tile_path, output_path, attempt + 1))
+                else:
+                    finish((tile_path, output_path, attempt), reason)
+            if to_retry:
+                debug_logger.debug('preprocessing of %d tile(s) failed (%s)'
+                                   '... retrying' % (len(to_retry), reason))
+                pending.append(to_retry)
+
+        def collect_outputs(running):
+            # outputs are renamed to their final name once complete (see
+            # get_command), so one killed or crashing midway isn't taken
+            remaining = []
+            for job in running['remaining']:
+                if os.path.exists(job[1]):
+                    finish(job)
+                    running['last_progress'] = time.time()
+                else:
+                    remaining.append(job)
+            running['remaining'] = remaining
+            return remaining
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            while pending or running:
+                while pending and len(running) < self.max_processes:
+                    running.append(self._start(pending.popleft(), tmp_dir))
+
+                time.sleep(self.POLL_INTERVAL)
+
+                still_running = []
+                for r in running:
+                    collect_outputs(r)
+                    reason = self._check(r)
+                    if reason is None:
+                        still_running.append(r)
+                        continue
+                    r['log'].close()
+
+                    # outputs written right before the process exited
+                    remaining = collect_outputs(r)
+                    if not remaining:
+                        continue
+                    if reason:
+                        # the process died while preprocessing the first
+                        # remaining tile, the others never had a chance
+                        culprit, others = remaining[0], remaining[1:]
+                        retry([culprit], reason)
+                        if others:
+                            pending.append(others)
+                    else:
+                        retry(remaining, 'no output was written')
+                running = still_running
+        finally:
+            # don't leave orphan processes behind if anything goes wrong
+            for r in running:
+                if r['process'].poll() is None:
+                    r['process'].kill()
+                    r['process'].wait()
+                r['log'].close()
+            h_fs.rm(tmp_dir, ignore_errors=True)
+
+        return failures
+
+
+# available implementations of the LiveVessel preprocessing, selected by
+# settings.CROWD_LIVEVESSEL_BACKEND. Only the MATLAB one computes the costs the
+# workers' client expects (crowd.processing.costs isn't a port of it)
+PREPROCESSORS = {
+    'matlab': PreprocessScheduler
+}
+
+
+def get_preprocessor(progress=None):
+    backend = getattr(settings, 'CROWD_LIVEVESSEL_BACKEND', 'matlab')
+    if backend not in PREPROCESSORS:
+        raise ImproperlyConfigured('unknown LiveVessel backend %r' % backend)
+    return PREPROCESSORS[backend](progress=progress)
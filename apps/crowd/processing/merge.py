@@ -0,0 +1,455 @@
+###############################################################################
+## Center for Advanced Computing Research
+## California Institute of Technology
+##
+## Merge of the results of assignments.
+##
+## Copyright 2012 Rafael Barreto <barreto@cacr.caltech.edu>
+###############################################################################
+
+
+# =====================
+# Python stdlib imports
+# =====================
+
+import contextlib
+import fcntl
+import glob
+import hashlib
+import itertools
+import multiprocessing
+import os
+import struct
+import tempfile
+import zipfile
+import zlib
+
+# ================
+# external imports
+# ================
+
+import numpy
+from PIL import Image
+
+# ===============
+# project imports
+# ===============
+
+from crowd.exceptions import MergeError
+
+
+def read_mask(session_id, path):
+    """Returns the foreground (> 0) of the result of session 'session_id'
+    stored at 'path' as a boolean array. Raises MergeError if it can't be
+    read."""
+
+    try:
+        return numpy.asarray(Image.open(path).convert('L')) > 0
+    except (IOError, ValueError), e:
+        raise MergeError(session_id, e)
+
+
+class VoteAccumulator(object):
+    """
+    Running count, per pixel, of the results of an assignment marking it as
+    foreground, so that merging them doesn't read every result again: each
+    result is counted once, as its session is closed.
+
+    It's stored at 'path' as a NumPy .npz, along with the ids of the sessions
+    counted. Its changes are made under an exclusive lock on a file next to
+    it, so concurrent ones (e.g. sessions of the assignment closed at once)
+    don't overwrite each other.
+    """
+
+    LOCK_SUFFIX = '.lock'
+
+    def __init__(self, path):
+        self.path = path
+        self.votes = None
+        self.session_ids = []
+        self._loaded = False
+
+    # ===============
+    # private methods
+    # ===============
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            data = numpy.load(self.path)
+            try:
+                self.votes = data['votes']
+                self.session_ids = data['sessions'].tolist()
+            finally:
+                data.close()
+        except (IOError, KeyError, ValueError, zipfile.BadZipfile):
+            # counted again from the results (see sync)
+            self._reset()
+
+    def _reset(self):
+        self.votes = None
+        self.session_ids = []
+
+    def _make_dir(self):
+        dir_path = os.path.dirname(self.path)
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        return dir_path
+
+    @contextlib.contextmanager
+    def _locked(self):
+        # the count is loaded again once the lock is taken, as it may have
+        # changed meanwhile
+        self._make_dir()
+        with open(self.path + self.LOCK_SUFFIX, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                self._loaded = False
+                self._reset()
+                self._load()
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _save(self):
+        dir_path = self._make_dir()
+
+        # written apart and renamed, so that it's never read half written
+        fd, tmp_path = tempfile.mkstemp(dir=dir_path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                numpy.savez(f, votes=self.votes, sessions=numpy.array(
+                    self.session_ids, dtype=numpy.int64))
+            os.rename(tmp_path, self.path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+    def _count(self, session_id, mask):
+        mask = numpy.asarray(mask) > 0
+        if self.votes is None:
+            self.votes = numpy.zeros(mask.shape, dtype=numpy.uint16)
+        elif self.votes.shape != mask.shape:
+            raise MergeError(session_id, 'its size %s differs from the size '
+                             '%s of the others' % (mask.shape,
+                                                   self.votes.shape))
+        self.votes += mask
+        self.session_ids.append(session_id)
+
+    # ==============
+    # public methods
+    # ==============
+
+    def add(self, session_id, mask):
+        """
+        Counts 'mask' (an array whose foreground is > 0) as the result of
+        session 'session_id', unless it was counted already. Returns whether
+        it was counted.
+        """
+
+        with self._locked():
+            if session_id in self.session_ids:
+                return False
+            self._count(session_id, mask)
+            self._save()
+            return True
+
+    def sync(self, results):
+        """
+        Makes the count match 'results', a dict of the result paths by
+        session id: only the results not counted yet are read, unless a
+        result counted is no longer among them, in which case every result is
+        counted again. Raises MergeError with the session whose result can't
+        be counted.
+        """
+
+        with self._locked():
+            if not set(self.session_ids) <= set(results):
+                self._reset()
+
+            missing = sorted(set(results) - set(self.session_ids))
+            if missing:
+                for session_id in missing:
+                    self._count(session_id, read_mask(session_id,
+                                                      results[session_id]))
+                self._save()
+
+    def merge(self, alpha):
+        """
+        Returns the merge of the results counted, as an array of 0s and
+        255s, or None if no result was counted.
+
+        It's the rule of helpers.dip.merge_masks(paths, alpha) computed from
+        the counts: the pixels marked as foreground by at least 1/'alpha' of
+        the results (e.g. half of them for the alpha of 2 merge_results has
+        always used).
+        """
+
+        self._load()
+        if not self.session_ids:
+            return None
+        merged = self.votes * float(alpha) >= len(self.session_ids)
+        return numpy.where(merged, 255, 0).astype(numpy.uint8)
+
+    def clear(self):
+        """Removes the count stored, e.g. as its assignment is deleted."""
+
+        for path in (self.path, self.path + self.LOCK_SUFFIX):
+            if os.path.exists(path):
+                os.remove(path)
+        self._reset()
+
+
+def _merge_job(job):
+    key, votes_path, results, alpha, output_path = job
+    try:
+        votes = VoteAccumulator(votes_path)
+        votes.sync(results)
+        mask = votes.merge(alpha)
+    except MergeError, e:
+        return key, None, str(e)
+    if mask is None:
+        return key, None, None
+    Image.fromarray(mask).save(output_path, format='PNG')
+    return key, output_path, None
+
+
+def merge_all(jobs, n_workers):
+    """
+    Runs the merges of 'jobs', (key, votes path, results, alpha,
+    output path) tuples (see VoteAccumulator), in a pool of 'n_workers'
+    processes, each writing its merge as a PNG to its output path.
+
+    Returns the output paths by key (None if there was nothing to merge)
+    and the failures, the MergeError messages by key.
+    """
+
+    outputs = {}
+    failures = {}
+
+    def collect(results):
+        for key, output_path, error in results:
+            if error is not None:
+                failures[key] = error
+            else:
+                outputs[key] = output_path
+
+    if n_workers > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(min(n_workers, len(jobs)))
+        try:
+            collect(pool.imap_unordered(_merge_job, jobs))
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        collect(itertools.imap(_merge_job, jobs))
+
+    return outputs, failures
+
+
+class MergeArtifacts(object):
+    """
+    Outputs of a merge (e.g. the merge itself and its overlay on the image
+    merged) stored as PNGs under 'root', versioned by the ids of the sessions
+    whose results are merged and by any other 'params' of the merge: an
+    output is only built again once its version changes.
+    """
+
+    # returned by a build whose output is incomplete (e.g. some results
+    # couldn't be merged), which is served but not stored as the version, so
+    # it's built again next time
+    INCOMPLETE = 'incomplete'
+
+    def __init__(self, root, prefix, session_ids, params=()):
+        self.root = root
+        self.prefix = prefix
+        key = '%s|%r' % (','.join(str(i) for i in sorted(session_ids)),
+                         tuple(params))
+        self.version = hashlib.sha1(key).hexdigest()[:16]
+
+    # ===============
+    # private methods
+    # ===============
+
+    def _remove_old_versions(self, name):
+        current = self.get_path(name)
+        for path in glob.glob(os.path.join(self.root, '%s_%s_*.png' % (
+                self.prefix, name))):
+            if path != current:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    # ==============
+    # public methods
+    # ==============
+
+    def get_path(self, name):
+        return os.path.join(self.root, '%s_%s_%s.png' % (self.prefix, name,
+                                                         self.version))
+
+    def get_incomplete_path(self, name):
+        return os.path.join(self.root, '%s_%s_%s.png' % (self.prefix, name,
+                                                         self.INCOMPLETE))
+
+    def get_version(self, name, path):
+        """Returns the version of the output 'name' at 'path' (see get), or
+        None if it's incomplete or there's none."""
+        if path == self.get_path(name):
+            return self.version
+        return None
+
+    def get_stored(self, name):
+        """Returns the path of the output 'name' of this version if it's
+        stored, or else of the one stored last (e.g. of an old version), or
+        None if there's none."""
+
+        path = self.get_path(name)
+        if os.path.exists(path):
+            return path
+
+        stored = []
+        for path in glob.glob(os.path.join(self.root, '%s_%s_*.png' % (
+                self.prefix, name))):
+            try:
+                stored.append((os.path.getmtime(path), path))
+            except OSError:
+                # removed meanwhile (see _remove_old_versions)
+                pass
+        return max(stored)[1] if stored else None
+
+    def get(self, name, build):
+        """
+        Returns the path of the output 'name', unless it's stored already
+        building it by build(path), which writes it to 'path' and returns
+        whether there was anything to merge, or INCOMPLETE. Returns None if
+        there wasn't anything to merge.
+        """
+
+        path = self.get_path(name)
+        if os.path.exists(path):
+            return path
+
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        # written apart and renamed, so that it's never served half written
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        os.close(fd)
+        try:
+            built = build(tmp_path)
+            if not built:
+                return None
+            if built == self.INCOMPLETE:
+                path = self.get_incomplete_path(name)
+            os.rename(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        if built != self.INCOMPLETE:
+            self._remove_old_versions(name)
+        return path
+
+
+class PngStripWriter(object):
+    """
+    Writes a 1-bit grayscale PNG of 'size' to the file-like 'f' a strip of
+    rows at a time (see write), so that the image is never wholly in
+    memory.
+    """
+
+    SIGNATURE = '\x89PNG\r\n\x1a\n'
+
+    def __init__(self, f, size):
+        self.f = f
+        self.width, self.height = size
+        self._n_rows = 0
+        self._compressor = zlib.compressobj()
+
+        f.write(self.SIGNATURE)
+        # bit depth 1, grayscale, default compression, filter and interlace
+        self._write_chunk('IHDR', struct.pack('>IIBBBBB', self.width,
+                                              self.height, 1, 0, 0, 0, 0))
+
+    # ===============
+    # private methods
+    # ===============
+
+    def _write_chunk(self, chunk_type, data):
+        self.f.write(struct.pack('>I', len(data)))
+        self.f.write(chunk_type + data)
+        self.f.write(struct.pack('>I', zlib.crc32(chunk_type + data) &
+                                 0xffffffff))
+
+    # ==============
+    # public methods
+    # ==============
+
+    def write(self, strip):
+        """Writes the next rows of the image, given as a boolean array as
+        wide as it (True is white)."""
+
+        strip = numpy.asarray(strip, dtype=bool)
+        if strip.shape[1] != self.width or \
+                self._n_rows + strip.shape[0] > self.height:
+            raise ValueError('the strip doesn\'t fit the image')
+        # every row is prefixed by its filter type, 0 (none)
+        rows = numpy.hstack((numpy.zeros((strip.shape[0], 1), numpy.uint8),
+                             numpy.packbits(strip, axis=1)))
+        data = self._compressor.compress(rows.tobytes())
+        if data:
+            self._write_chunk('IDAT', data)
+        self._n_rows += strip.shape[0]
+
+    def close(self):
+        if self._n_rows != self.height:
+            raise ValueError('%d of %d rows written' % (self._n_rows,
+                                                         self.height))
+        self._write_chunk('IDAT', self._compressor.flush())
+        self._write_chunk('IEND', '')
+
+
+def stitch_masks(placements, writer, strip_height):
+    """
+    Writes by 'writer' (see PngStripWriter) the OR of the masks of
+    'placements', (x0, y0, load) tuples where load() returns a 2D array,
+    whose foreground is > 0, to be placed at (x0, y0), or None.
+
+    The image is built 'strip_height' rows at a time, and a mask is only
+    loaded when the strip reaches it and kept while it overlaps the strip,
+    so the memory used is bounded by the strip and the masks across it,
+    not by the image.
+    """
+
+    pending = sorted(placements, key=lambda p: p[1])
+    active = []
+    i = 0
+    for top in xrange(0, writer.height, strip_height):
+        bottom = min(writer.height, top + strip_height)
+        while i < len(pending) and pending[i][1] < bottom:
+            x0, y0, load = pending[i]
+            i += 1
+            mask = load()
+            if mask is not None:
+                active.append((x0, y0, numpy.asarray(mask) > 0))
+        active = [(x0, y0, mask) for x0, y0, mask in active if
+                  y0 + mask.shape[0] > top]
+
+        strip = numpy.zeros((bottom - top, writer.width), dtype=bool)
+        for x0, y0, mask in active:
+            # the part of the mask within the strip
+            r0, r1 = max(y0, top), min(y0 + mask.shape[0], bottom)
+            c0, c1 = max(x0, 0), min(x0 + mask.shape[1], writer.width)
+            if r0 < r1 and c0 < c1:
+                strip[r0 - top:r1 - top, c0:c1] |= mask[r0 - y0:r1 - y0,
+                                                        c0 - x0:c1 - x0]
+        writer.write(strip)
+    writer.close()
@@ -0,0 +1,362 @@
+###############################################################################
+## Center for Advanced Computing Research
+## California Institute of Technology
+##
+## Binary format of the LiveVessel preprocess files.
+##
+## Copyright 2012 Rafael Barreto <barreto@cacr.caltech.edu>
+###############################################################################
+
+
+# =====================
+# Python stdlib imports
+# =====================
+
+import collections
+import mmap
+import multiprocessing.pool
+import os
+import shutil
+import struct
+import tempfile
+import time
+
+# ================
+# external imports
+# ================
+
+import numpy
+from backports import lzma
+
+# ==============
+# Django imports
+# ==============
+
+from django.conf import settings
+from django.core.files.base import File
+
+
+# A preprocess file is made of a header with the width, the height and the
+# number of scales (native ints), followed by the scales (native floats) and,
+# for each scale, a plane of width * height uint8 costs in row-major order.
+HEADER_FORMAT = 'iii'
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+SCALE_FORMAT = 'f'
+SCALE_SIZE = struct.calcsize(SCALE_FORMAT)
+
+
+def write_preprocess_file(f, costs, scales):
+    """
+    Writes in the file object 'f' the 'costs' (an array of shape
+    (n_scales, height, width)) computed for 'scales'.
+    """
+
+    costs = numpy.ascontiguousarray(costs, dtype=numpy.uint8)
+    n_scales, height, width = costs.shape
+    if n_scales != len(scales):
+        raise ValueError('there are %d cost planes for %d scales' % (
+            n_scales, len(scales)))
+
+    f.write(struct.pack(HEADER_FORMAT, width, height, n_scales))
+    f.write(struct.pack('%d%s' % (n_scales, SCALE_FORMAT), *scales))
+    f.write(costs.tobytes())
+
+
+class PreprocessData(collections.Mapping):
+    """
+    Decoded preprocess file.
+
+    'planes' is an uint8 array of shape (n_scales, height, width), usually a
+    read-only view of the decompressed (or memory-mapped) file. For
+    compatibility, it's also a mapping with the keys 'costs' (the planes as
+    nested lists, built only when accessed) and 'scales'.
+    """
+
+    KEYS = ('costs', 'scales')
+
+    def __init__(self, scales, planes):
+        self.scales = tuple(scales)
+        self.planes = planes
+        self._costs = None
+
+    # ==========
+    # properties
+    # ==========
+
+    @property
+    def width(self):
+        return self.planes.shape[2]
+
+    @property
+    def height(self):
+        return self.planes.shape[1]
+
+    # ==================
+    # overridden methods
+    # ==================
+
+    def __getitem__(self, key):
+        if key == 'scales':
+            return self.scales
+        if key == 'costs':
+            if self._costs is None:
+                self._costs = self.planes.tolist()
+            return self._costs
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self.KEYS)
+
+    def __len__(self):
+        return len(self.KEYS)
+
+
+def parse_preprocess_data(buf):
+    """Returns the PreprocessData of the preprocess file whose whole content
+    is in 'buf' (any object supporting the buffer protocol). The cost planes
+    are a view of 'buf', not a copy."""
+
+    width, height, n_scales = struct.unpack_from(HEADER_FORMAT, buf)
+    scales_format = '%d%s' % (n_scales, SCALE_FORMAT)
+    scales = struct.unpack_from(scales_format, buf, HEADER_SIZE)
+
+    planes = numpy.frombuffer(buf, dtype=numpy.uint8,
+        count=n_scales * height * width,
+        offset=HEADER_SIZE + struct.calcsize(scales_format))
+    return PreprocessData(scales, planes.reshape(n_scales, height, width))
+
+
+class LZMAStreamFile(File):
+    """
+    File whose content is the lzma compression of the file at 'path'. The
+    content is compressed chunk by chunk as the storage consumes it, so
+    neither the original nor the compressed content is ever entirely in
+    memory.
+    """
+
+    CHUNK_SIZE = 256 * 1024
+
+    def __init__(self, path, preset=None):
+        super(LZMAStreamFile, self).__init__(None,
+            name=os.path.basename(path) + '.xz')
+        self.path = path
+        self.preset = preset if preset is not None else getattr(settings,
+            'CROWD_PREPROCESS_XZ_PRESET', 6)
+        self._size = 0
+
+    def multiple_chunks(self, chunk_size=None):
+        return True
+
+    def chunks(self, chunk_size=None):
+        compressor = lzma.LZMACompressor(preset=self.preset)
+        self._size = 0
+        with open(self.path, 'rb') as f:
+            for block in iter(lambda: f.read(self.CHUNK_SIZE), ''):
+                data = compressor.compress(block)
+                if data:
+                    self._size += len(data)
+                    yield data
+        data = compressor.flush()
+        self._size += len(data)
+        yield data
+
+    def __iter__(self):
+        return self.chunks()
+
+
+def store_preprocess_files(pairs, preset=None, n_threads=None):
+    """
+    Compresses the raw preprocess files into the storage of the file fields.
+    'pairs' are (field file, raw file path) tuples. Being mostly lzma work,
+    which doesn't hold the GIL, the files are compressed by a pool of
+    'n_threads' threads.
+    """
+
+    n_threads = n_threads or getattr(settings,
+        'CROWD_PREPROCESS_COMPRESSION_THREADS', 1)
+
+    def store(pair):
+        field_file, raw_path = pair
+        content = LZMAStreamFile(raw_path, preset)
+        field_file.save(content.name, content, save=False)
+
+    if n_threads > 1 and len(pairs) > 1:
+        pool = multiprocessing.pool.ThreadPool(min(n_threads, len(pairs)))
+        try:
+            pool.map(store, pairs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        map(store, pairs)
+
+
+def decompress_preprocess_file(path):
+    """
+    Returns the raw content of the lzma compressed preprocess file at 'path'.
+
+    Header, scales and planes are aligned so that, in a browser, they can be
+    read with Int32Array(buf, 0, 3), Float32Array(buf, 12, n_scales) and
+    Uint8Array(buf, 12 + 4 * n_scales) without copying.
+    """
+
+    with lzma.open(path, 'rb') as f:
+        return f.read()
+
+
+def read_preprocess_file(path):
+    """
+    Reads the preprocess file at 'path', either lzma compressed (.xz), which
+    is decompressed in memory, or raw, which is memory-mapped.
+    """
+
+    if path.endswith('.xz'):
+        return parse_preprocess_data(decompress_preprocess_file(path))
+
+    with open(path, 'rb') as f:
+        return parse_preprocess_data(mmap.mmap(f.fileno(), 0,
+            access=mmap.ACCESS_READ))
+
+
+class PreprocessCache(object):
+    """
+    On-disk LRU cache of the decompressed preprocess files of the
+    assignments, shared by every process of the project.
+
+    Entries are keyed by assignment id and modification time of the
+    compressed file, so replacing the latter invalidates them (the stale
+    entries are left to the eviction). The least recently used entries are
+    evicted when the cache grows larger than 'max_size' bytes. As that
+    lists the whole cache, it's done at most once every 'eviction_interval'
+    seconds, so the cache may grow larger meanwhile.
+    """
+
+    # marks when the cache was last evicted (see _evict_if_due)
+    EVICTION_MARKER_NAME = '.evicted'
+
+    def __init__(self, root=None, max_size=None, eviction_interval=None):
+        self.root = root or settings.CROWD_PREPROCESS_CACHE_ROOT
+        self.max_size = max_size or getattr(settings,
+            'CROWD_PREPROCESS_CACHE_MAX_SIZE', 1024 ** 3)
+        self.eviction_interval = eviction_interval if eviction_interval is \
+            not None else getattr(settings,
+            'CROWD_PREPROCESS_CACHE_EVICTION_INTERVAL', 60)
+
+    # ===============
+    # private methods
+    # ===============
+
+    def _entry_prefix(self, assignment_id):
+        return '%d-' % assignment_id
+
+    def _entry_path(self, assignment_id, path):
+        return os.path.join(self.root, '%s%d' % (
+            self._entry_prefix(assignment_id), int(os.path.getmtime(path))))
+
+    def _store(self, entry_path, write_fun, evict=True):
+        if not os.path.isdir(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError:
+                # created in the meantime by another process
+                pass
+
+        # write aside and rename, so readers never see partial entries
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write_fun(f)
+            os.rename(tmp_path, entry_path)
+        except:
+            os.remove(tmp_path)
+            raise
+
+        if evict:
+            self._evict_if_due()
+
+    def _evict_if_due(self):
+        marker_path = os.path.join(self.root, self.EVICTION_MARKER_NAME)
+        try:
+            last_eviction = os.path.getmtime(marker_path)
+        except OSError:
+            last_eviction = 0
+        if time.time() - last_eviction < self.eviction_interval:
+            return
+        open(marker_path, 'a').close()
+        self._touch(marker_path)
+        self.evict()
+
+    def _touch(self, path):
+        try:
+            os.utime(path, None)
+        except OSError:
+            # evicted in the meantime
+            pass
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    # ==============
+    # public methods
+    # ==============
+
+    def get(self, assignment_id, path):
+        """Returns the decompressed content of the preprocess file at 'path'
+        of the given assignment, decompressing it only on cache misses."""
+
+        entry_path = self._entry_path(assignment_id, path)
+        try:
+            with open(entry_path, 'rb') as f:
+                data = f.read()
+        except IOError:
+            data = decompress_preprocess_file(path)
+            self._store(entry_path, lambda f: f.write(data))
+            return data
+
+        # the access time may not be kept by the filesystem (noatime), so the
+        # modification time tracks the usage
+        self._touch(entry_path)
+        return data
+
+    def put(self, assignment_id, path, raw_path=None, evict=True):
+        """
+        Caches the preprocess file at 'path' of the given assignment. If its
+        decompressed content is already available at 'raw_path', it's copied
+        instead of decompressing the file again.
+
+        When putting many files, 'evict' should be False and evict() called
+        once they are all cached.
+        """
+
+        entry_path = self._entry_path(assignment_id, path)
+        if raw_path is not None:
+            def write_fun(f):
+                with open(raw_path, 'rb') as raw_file:
+                    shutil.copyfileobj(raw_file, f)
+        else:
+            write_fun = lambda f: f.write(decompress_preprocess_file(path))
+        self._store(entry_path, write_fun, evict)
+
+    def evict(self):
+        """Removes the least recently used entries while the cache is larger
+        than its maximum size."""
+
+        entries = []
+        for name in os.listdir(self.root):
+            if name.endswith('.tmp') or name == self.EVICTION_MARKER_NAME:
+                continue
+            try:
+                st = os.stat(os.path.join(self.root, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+
+        size = sum(e[1] for e in entries)
+        for _, entry_size, name in sorted(entries):
+            if size <= self.max_size:
+                break
+            self._remove(os.path.join(self.root, name))
+            size -= entry_size
@@ -0,0 +1,158 @@
+###############################################################################
+## Center for Advanced Computing Research
+## California Institute of Technology
+##
+## Processing of the results submitted by workers.
+##
+## Copyright 2012 Rafael Barreto <barreto@cacr.caltech.edu>
+###############################################################################
+
+
+# =====================
+# Python stdlib imports
+# =====================
+
+import base64
+import binascii
+import struct
+import urllib
+
+try:
+    from cStringIO import StringIO
+except:
+    from StringIO import StringIO
+
+# ================
+# external imports
+# ================
+
+import numpy
+from PIL import Image
+
+# content types of the results posted as raw bodies (see read_result)
+PNG_CONTENT_TYPE = 'image/png'
+RLE_CONTENT_TYPE = 'application/x-rle'
+RESULT_CONTENT_TYPES = (PNG_CONTENT_TYPE, RLE_CONTENT_TYPE)
+
+RLE_HEADER = struct.Struct('<HH')
+
+
+def decode_data_url(data_url):
+    """
+    Returns the content of a data URL (e.g. the one produced by the
+    toDataURL() of a canvas). Raises ValueError if it's not a data URL.
+    """
+
+    if not data_url.startswith('data:') or ',' not in data_url:
+        raise ValueError('not a data URL')
+    header, data = data_url.split(',', 1)
+    if header.endswith(';base64'):
+        try:
+            return base64.b64decode(data)
+        except (TypeError, binascii.Error), e:
+            raise ValueError('invalid base64 data: %s' % e)
+    return urllib.unquote(data)
+
+
+def binarize_result(img, dim):
+    """
+    Returns the mask of a result image as a uint8 array of 0s and 255s: its
+    last band (i.e. the alpha of the canvas) resized to 'dim'x'dim' and
+    thresholded at 0.
+    """
+
+    if img.mode == '1':
+        img = img.convert('L')
+    band = img.resize((dim, dim)).split()[-1]
+    return numpy.where(numpy.asarray(band) > 0, 255, 0).astype(numpy.uint8)
+
+
+def encode_mask(mask):
+    output = StringIO()
+    Image.fromarray(mask).save(output, format='PNG')
+    return output.getvalue()
+
+
+def decode_rle(data, size=None):
+    """
+    Returns the mask, as a uint8 array of 0s and 255s, encoded in 'data' by
+    encode_rle. Raises ValueError if it's malformed or, before decoding it,
+    if 'size' (width, height) is given and the mask is of another size.
+
+    The encoding is the width and the height of the mask as little endian
+    uint16s, followed by the lengths of the runs of its pixels, in row-major
+    order, as little endian uint16s. The runs alternate between background
+    and foreground, starting with background; a run longer than 65535
+    pixels is split by a run of length 0 of the other kind.
+    """
+
+    if len(data) < RLE_HEADER.size or (len(data) - RLE_HEADER.size) % 2:
+        raise ValueError('truncated run-length encoded mask')
+    width, height = RLE_HEADER.unpack_from(data)
+    if size is not None and (width, height) != tuple(size):
+        raise ValueError('the mask is %dx%d instead of %dx%d' % ((width,
+            height) + tuple(size)))
+    runs = numpy.frombuffer(data, dtype='<u2', offset=RLE_HEADER.size)
+    values = numpy.zeros(len(runs), dtype=numpy.uint8)
+    values[1::2] = 255
+    if runs.sum(dtype=numpy.int64) != width * height:
+        raise ValueError('the runs don\'t cover the %dx%d mask' % (width,
+                                                                   height))
+    return numpy.repeat(values, runs).reshape((height, width))
+
+
+def encode_rle(mask):
+    """The inverse of decode_rle, for any mask whose foreground is > 0."""
+
+    flat = (numpy.asarray(mask) > 0).ravel()
+    # indexes where the pixels change, i.e. where the runs start
+    changes = numpy.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = numpy.concatenate(([0], changes, [flat.size]))
+    lengths = numpy.diff(bounds)
+    if flat.size and flat[0]:
+        lengths = numpy.concatenate(([0], lengths))
+
+    runs = []
+    for length in lengths:
+        while length > 0xffff:
+            runs.extend((0xffff, 0))
+            length -= 0xffff
+        runs.append(length)
+    height, width = numpy.asarray(mask).shape[:2]
+    return RLE_HEADER.pack(width, height) + \
+        numpy.array(runs, dtype='<u2').tobytes()
+
+
+def read_result(stream, content_type, size):
+    """
+    Returns the result image of 'content_type' (PNG_CONTENT_TYPE, e.g. a
+    1-bit PNG, or RLE_CONTENT_TYPE) read from the file-like 'stream'.
+    Raises ValueError if the content type isn't supported or if the image
+    isn't of 'size' (width, height), which is checked before decoding it.
+    """
+
+    if content_type == PNG_CONTENT_TYPE:
+        # only the header is read until the image is loaded
+        ret = Image.open(StringIO(stream.read()))
+        if ret.size != tuple(size):
+            raise ValueError('the image is %dx%d instead of %dx%d' % (
+                ret.size + tuple(size)))
+        return ret
+    if content_type == RLE_CONTENT_TYPE:
+        return Image.fromarray(decode_rle(stream.read(), size))
+    raise ValueError('unsupported content type: %s' % content_type)
+
+
+def process_result(result, dim):
+    """
+    Binarizes the result image, given as a PIL image or read from the
+    file-like 'result' (see binarize_result).
+
+    Returns the PNG of the mask, its mileage, i.e. the number of foreground
+    pixels, and the mask itself, all from the same in-memory array.
+    """
+
+    if not isinstance(result, Image.Image):
+        result = Image.open(result)
+    mask = binarize_result(result, dim)
+    return encode_mask(mask), int(numpy.count_nonzero(mask)), mask
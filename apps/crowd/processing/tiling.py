@@ -0,0 +1,220 @@
+###############################################################################
+## Center for Advanced Computing Research
+## California Institute of Technology
+##
+## Parallel tiling of segmentation problem images.
+##
+## Copyright 2012 Rafael Barreto <barreto@cacr.caltech.edu>
+###############################################################################
+
+
+# =====================
+# Python stdlib imports
+# =====================
+
+import itertools
+import multiprocessing
+from operator import itemgetter
+
+try:
+    from cStringIO import StringIO
+except:
+    from StringIO import StringIO
+
+# ==============
+# Django imports
+# ==============
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+
+# ================
+# external imports
+# ================
+
+from PIL import Image
+
+# ===============
+# project imports
+# ===============
+
+import externals
+
+
+# state shared with the pool workers. It is filled right before the pool is
+# forked, so the (possibly huge) decoded source image is inherited by the
+# workers copy-on-write instead of being pickled along with every tile job.
+_worker_state = {}
+
+
+def tile_boxes(img_size, tiles_dim, overlap_rel):
+    """
+    Returns the bounding boxes (x0, y0, x1, y1) of the tiles covering an
+    image of size 'img_size', in row-major order.
+
+    Consecutive tiles overlap by 'overlap_rel' of 'tiles_dim' and the last
+    tile of each row/column is aligned to the image edge.
+    """
+
+    step = max(1, int(tiles_dim * (1.0 - overlap_rel)))
+
+    def offsets(length):
+        last = max(0, length - tiles_dim)
+        ret = range(0, last + 1, step)
+        if ret[-1] != last:
+            ret.append(last)
+        return ret
+
+    img_w, img_h = img_size
+    return [(x0, y0, x0 + tiles_dim, y0 + tiles_dim)
+            for y0 in offsets(img_h) for x0 in offsets(img_w)]
+
+
+def get_thumb_name(name, size):
+    """Storage name of the thumbnail of 'name' as expected by
+    externals.thumbs.ImageWithThumbsField."""
+    root, ext = name.rsplit('.', 1)
+    return '%s.%dx%d.%s' % (root, size[0], size[1], ext)
+
+
+def _process_tile(job):
+    index, bbox, name = job
+    state = _worker_state
+
+    border = state['border']
+    x0, y0, x1, y1 = bbox
+    cropped_bbox = (x0 + border, y0 + border, x1 - border, y1 - border)
+
+    tile = state['image'].crop(cropped_bbox if state['crop_border'] else bbox)
+
+    workable = None
+    if state['workable_checker'] is not None:
+        workable = state['workable_checker'](tile)
+
+    output = StringIO()
+    tile.save(output, format='PNG')
+    content = ContentFile(output.getvalue())
+
+    storage = state['storage']
+    # leftovers of an interrupted generation are overwritten instead of
+    # making the storage pick alternative names
+    for stale in [name] + [get_thumb_name(name, size) for size in
+                           state['thumb_sizes']]:
+        if storage.exists(stale):
+            storage.delete(stale)
+
+    name = storage.save(name, content)
+    for size in state['thumb_sizes']:
+        storage.save(get_thumb_name(name, size),
+            externals.thumbs.generate_thumb(content, size, 'png'))
+
+    return {'index': index, 'bbox': bbox, 'cropped_bbox': cropped_bbox,
+            'name': name, 'workable': workable}
+
+
+class TilingEngine(object):
+    """
+    Crops, encodes and stores the tiles of an image (and their thumbnails)
+    using a pool of processes.
+
+    'progress', if given, is called as progress(stage, done, total) every time
+    a tile is finished.
+
+    A generation can be resumed by passing the infos of the tiles generated
+    already (see generate()), which are then skipped.
+    """
+
+    # number of tiles handed to a worker at once
+    CHUNK_SIZE = 8
+
+    def __init__(self, tiles_dim, overlap_rel, border_rel, n_workers=None,
+                 progress=None):
+        self.tiles_dim = tiles_dim
+        self.overlap_rel = overlap_rel
+        self.border_rel = border_rel
+        self.n_workers = n_workers or getattr(settings,
+            'CROWD_TILING_WORKERS', None) or multiprocessing.cpu_count()
+        self.progress = progress
+
+    # ==========
+    # properties
+    # ==========
+
+    @property
+    def border(self):
+        return int(self.tiles_dim * self.border_rel)
+
+    # ===============
+    # private methods
+    # ===============
+
+    def _collect(self, results, done, total, stage, on_result):
+        ret = list(done)
+        for info in results:
+            ret.append(info)
+            if on_result is not None:
+                on_result(info)
+            if self.progress is not None:
+                self.progress(stage, len(ret), total)
+        return ret
+
+    # ==============
+    # public methods
+    # ==============
+
+    def generate(self, img_path, storage, name_fun, thumb_sizes=(),
+                 crop_border=False, workable_checker=None, stage='tiling',
+                 done=None, on_result=None):
+        """
+        Generates the tiles of the image at 'img_path' and saves them in
+        'storage' under the names given by name_fun(tile_index).
+
+        Returns a list, ordered by tile index, of dicts with the keys 'index',
+        'bbox', 'cropped_bbox' (the bbox without the border, the part of the
+        image the tile is responsible for), 'name' (the name under which the
+        tile was actually stored) and 'workable' (None if no
+        'workable_checker' is given).
+
+        'done' maps tile indexes to the infos of tiles generated already,
+        which are returned as they are. 'on_result', if given, is called with
+        the info of each newly generated tile as soon as it's stored.
+        """
+
+        done = done or {}
+
+        img = Image.open(img_path)
+        img.load()
+
+        boxes = tile_boxes(img.size, self.tiles_dim, self.overlap_rel)
+        jobs = [(idx, bbox, name_fun(idx)) for idx, bbox in enumerate(boxes)
+                if idx not in done]
+        done = [done[idx] for idx in xrange(len(boxes)) if idx in done]
+
+        _worker_state.update({
+            'image': img,
+            'border': self.border,
+            'crop_border': crop_border,
+            'workable_checker': workable_checker,
+            'storage': storage,
+            'thumb_sizes': thumb_sizes
+        })
+        try:
+            if self.n_workers > 1 and len(jobs) > 1:
+                pool = multiprocessing.Pool(min(self.n_workers, len(jobs)))
+                try:
+                    ret = self._collect(pool.imap_unordered(_process_tile,
+                        jobs, self.CHUNK_SIZE), done, len(boxes), stage,
+                        on_result)
+                    pool.close()
+                except:
+                    pool.terminate()
+                    raise
+                finally:
+                    pool.join()
+            else:
+                ret = self._collect(itertools.imap(_process_tile, jobs), done,
+                    len(boxes), stage, on_result)
+        finally:
+            _worker_state.clear()
+
+        return sorted(ret, key=itemgetter('index'))
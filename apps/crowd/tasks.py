@@ -2,10 +2,15 @@ from __future__ import absolute_import
 from datetime import timedelta, datetime
 from celery.app import shared_task
 
+from django.conf import settings
 from django.core.cache import cache
 
-from celery.task import PeriodicTask, task
+from celery.result import AsyncResult
+from celery.task import PeriodicTask, Task, task
 
+from apps.crowd.exceptions import AssignmentsCreationError
+from apps.crowd.models.assignment import Assignment, AssignmentSession
+from apps.crowd.models.segprob import SegmentationProblem
 from apps.profiles.models import WorkerProfile
 
 
@@ -39,6 +44,234 @@ class RankingTask(PeriodicTask):
         cache.set('ranking_dict', ranking_dict)
         cache.set('ranking_keys', ranking_keys)
 
+
+class CloseExpiredSessionsTask(PeriodicTask):
+    """
+    Closes the assignment sessions that expired while open
+
+    Otherwise they would keep their workers busy and count as active until
+    the workers came back. The sessions are closed in batches (see
+    AssignmentSessionManager.close_expired).
+    """
+
+    name = 'crowd.close_expired_sessions'
+    run_every = timedelta(seconds=getattr(settings,
+        'CROWD_SESSIONS_SWEEP_INTERVAL', 60))
+    ignore_result = True
+
+    def run(self):
+        return AssignmentSession.objects.close_expired()
+
+
+class ConcludeAssignmentTask(Task):
+    """
+    Merges the results of a concluded assignment and scores its sessions
+
+    It's scheduled when an assignment is concluded, so the worker who closed
+    the last session doesn't wait for it, and both steps can be run again
+    safely: the merge is kept once created and every session is scored once
+    (see Assignment.score_sessions). Until it runs, the workers keep the
+    score given as if their accuracy were 1.0.
+    """
+
+    name = 'crowd.conclude_assignment'
+    ignore_result = True
+    max_retries = getattr(settings, 'CROWD_CONCLUSION_MAX_RETRIES', 5)
+    default_retry_delay = getattr(settings, 'CROWD_CONCLUSION_RETRY_DELAY',
+        30)
+
+    @classmethod
+    def schedule(cls, assignment_id):
+        return cls().apply_async(args=(assignment_id,))
+
+    def run(self, assignment_id):
+        try:
+            assignment = Assignment.objects.get(pk=assignment_id)
+        except Assignment.DoesNotExist:
+            # e.g. the assignments were recreated meanwhile
+            return 0
+
+        # it's scheduled before the conclusion is committed
+        if not assignment.concluded:
+            raise self.retry()
+
+        try:
+            if not assignment.has_merge:
+                assignment.merge_results()
+            return assignment.score_sessions()
+        except Exception, e:
+            raise self.retry(exc=e)
+
+
+class ScoreConcludedAssignmentsTask(PeriodicTask):
+    """
+    Schedules the conclusion of the concluded assignments not scored yet
+
+    e.g. those whose ConcludeAssignmentTask was lost or gave up retrying.
+    """
+
+    name = 'crowd.score_concluded_assignments'
+    run_every = timedelta(seconds=getattr(settings,
+        'CROWD_CONCLUSION_SWEEP_INTERVAL', 10 * 60))
+    ignore_result = True
+
+    def run(self):
+        pks = list(Assignment.objects.get_pending_scoring().values_list('pk',
+            flat=True))
+        for pk in pks:
+            ConcludeAssignmentTask.schedule(pk)
+        return len(pks)
+
+
+class CreateAssignmentsTask(Task):
+    """
+    Creates the assignments of a segmentation problem
+
+    The tiling, pre seg. tiling and LiveVessel preprocessing progress is
+    stored as the task state meta, {'stages': {stage: {'done': d, 'total': t}}},
+    so the admin can poll it through get_progress. There is at most one of
+    these tasks per segmentation problem, whose id is given by get_task_id:
+    scheduling it takes a lock on the segmentation problem in the database
+    (see SegmentationProblemManager.lock), released once it ends (or after
+    settings.CROWD_ASSIGNMENTS_CREATION_LOCK_TIMEOUT seconds), so a task
+    still queued isn't scheduled again.
+
+    It's routed to the 'assignments' queue (see CELERY_ROUTES in settings).
+    """
+
+    name = 'crowd.create_assignments'
+    ignore_result = False
+    track_started = True
+
+    lock_field = 'creation_locked_at'
+    lock_timeout = getattr(settings, 'CROWD_ASSIGNMENTS_CREATION_LOCK_TIMEOUT',
+        6 * 60 * 60)
+
+    @staticmethod
+    def get_task_id(seg_prob_id):
+        return 'crowd-create-assignments-%d' % seg_prob_id
+
+    @classmethod
+    def lock(cls, seg_prob_id):
+        """Takes the lock of the creation of the assignments of the given
+        segmentation problem, e.g. so they aren't cleared meanwhile. Returns
+        whether it was taken."""
+        return SegmentationProblem.objects.lock(seg_prob_id, cls.lock_field,
+            cls.lock_timeout)
+
+    @classmethod
+    def unlock(cls, seg_prob_id):
+        SegmentationProblem.objects.unlock(seg_prob_id, cls.lock_field)
+
+    @classmethod
+    def get_progress(cls, seg_prob_id):
+        """
+        Returns a dict with the 'state' of the task for the given segmentation
+        problem and the progress of its 'stages'.
+        """
+
+        result = AsyncResult(cls.get_task_id(seg_prob_id))
+        ret = {'state': result.state, 'stages': {}}
+        if isinstance(result.info, dict):
+            ret['stages'] = result.info.get('stages', {})
+        return ret
+
+    @classmethod
+    def is_running(cls, seg_prob_id):
+        """True if the task is scheduled (even if still queued) or
+        running."""
+        if SegmentationProblem.objects.is_locked(seg_prob_id, cls.lock_field,
+                cls.lock_timeout):
+            return True
+        return cls.get_progress(seg_prob_id)['state'] in ('STARTED',
+                                                          'PROGRESS')
+
+    @classmethod
+    def schedule(cls, seg_prob_id, n_workers=None):
+        """Schedules the task, unless it's scheduled already, in which case
+        None is returned."""
+
+        if not cls.lock(seg_prob_id):
+            return None
+        try:
+            return cls().apply_async(args=(seg_prob_id,),
+                kwargs={'n_workers': n_workers},
+                task_id=cls.get_task_id(seg_prob_id))
+        except:
+            cls.unlock(seg_prob_id)
+            raise
+
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        self.unlock(args[0])
+
+    def run(self, seg_prob_id, n_workers=None):
+        stages = {}
+
+        def progress(stage, done, total):
+            # avoid hitting the result backend for every single tile
+            previous = stages.get(stage, {'done': 0})['done']
+            if done != total and 100 * done / total == 100 * previous / total:
+                stages[stage] = {'done': previous, 'total': total}
+                return
+            stages[stage] = {'done': done, 'total': total}
+            self.update_state(state='PROGRESS', meta={'stages': stages})
+
+        seg_prob = SegmentationProblem.objects.get(pk=seg_prob_id)
+        n_assignments = seg_prob.create_assignments(progress=progress,
+            n_workers=n_workers)
+        if n_assignments is None:
+            raise AssignmentsCreationError(seg_prob_id)
+
+        return {'stages': stages, 'n_assignments': n_assignments}
+
+
+class MergeAssignmentsTask(Task):
+    """
+    Merges the assignments of a segmentation problem
+
+    The merge and its overlay are built (see
+    SegmentationProblem.get_merge_file) out of the request that finds them
+    out of date, as the merge forks a pool of processes. As with
+    CreateAssignmentsTask, scheduling it takes a lock on the segmentation
+    problem in the database, released once it ends (or after
+    settings.CROWD_MERGE_LOCK_TIMEOUT seconds), so there's at most one merge
+    of a segmentation problem queued or running.
+
+    It's routed to the 'assignments' queue (see CELERY_ROUTES in settings).
+    """
+
+    name = 'crowd.merge_assignments'
+    ignore_result = True
+
+    lock_field = 'merge_locked_at'
+    lock_timeout = getattr(settings, 'CROWD_MERGE_LOCK_TIMEOUT', 60 * 60)
+
+    @classmethod
+    def schedule(cls, seg_prob_id):
+        """Schedules the task, unless it's scheduled already, in which case
+        None is returned."""
+
+        if not SegmentationProblem.objects.lock(seg_prob_id, cls.lock_field,
+                cls.lock_timeout):
+            return None
+        try:
+            return cls().apply_async(args=(seg_prob_id,))
+        except:
+            SegmentationProblem.objects.unlock(seg_prob_id, cls.lock_field)
+            raise
+
+    def after_return(self, status, retval, task_id, args, kwargs, einfo):
+        SegmentationProblem.objects.unlock(args[0], self.lock_field)
+
+    def run(self, seg_prob_id):
+        try:
+            seg_prob = SegmentationProblem.objects.get(pk=seg_prob_id)
+        except SegmentationProblem.DoesNotExist:
+            return None
+        # the merge is built along with its overlay
+        version, _ = seg_prob.get_merge_file(overlay=True)
+        return version
+
 # class ScoreDecreaseByTimeTask(PeriodicTask):
 #     time_unity = 1
 #     score_penalty = 300
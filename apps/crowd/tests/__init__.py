@@ -9,3 +9,4 @@
 
 
 from crowd.tests.models import *
+from crowd.tests.processing import *
@@ -9,3 +9,4 @@
 
 
 from crowd.tests.models.assignment import *
+from crowd.tests.models.segprob import *
@@ -15,6 +15,14 @@
 import datetime
 import hashlib
 import os
+import threading
+
+from decimal import Decimal
+
+try:
+    from cStringIO import StringIO
+except:
+    from StringIO import StringIO
 
 # ==============
 # Django imports
@@ -23,6 +31,16 @@ import os
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+from django.utils.unittest import skipIf, skipUnless
+
+# ================
+# external imports
+# ================
+
+from south.db import db
 
 # ===============
 # project imports
@@ -30,7 +48,10 @@ from django.core.exceptions import ValidationError
 
 from crowd.models.assignment import Assignment
 from crowd.models.assignment import AssignmentSession
+from crowd.models.assignment import AssignmentSessionStats
+from crowd.models.assignment import AssignmentSlot
 from crowd.models.exceptions import InvalidStateError
+from crowd.models.indexes import get_composite_indexes, get_index_names
 from crowd.models.segprob import SegmentationProblem
 from helpers.django_related.tests import TimezoneNowMockedTestCase
 
@@ -45,6 +66,12 @@ def _close_session_w_result(session):
 class AssignmentManagerTest(TimezoneNowMockedTestCase):
     fixtures = ('initial.json',)
 
+    def setUp(self):
+        super(AssignmentManagerTest, self).setUp()
+
+        # the fixture doesn't have the session counters
+        Assignment.objects.update_session_counters()
+
     @staticmethod
     def _create_sessions_for_assignment(assignment, n):
         sessions = []
@@ -93,15 +120,19 @@ class AssignmentManagerTest(TimezoneNowMockedTestCase):
         min_res_per_assignment = seg_prob_details.min_results_per_assignment
         assignments_timeout = seg_prob_details.assignments_timeout
 
-        AssignmentManagerTest._create_sessions_for_assignment(assignment,
-            min_res_per_assignment)
+        sessions = AssignmentManagerTest._create_sessions_for_assignment(
+            assignment, min_res_per_assignment)
 
         # there are now 'min_res_per_assignment' active sessions, so
         # 'assignment' should not be available anymore
         self.assertNotIn(assignment, Assignment.objects.get_available())
 
-        # force expiration
+        # force expiration. The expired sessions count as active until the
+        # sweeper closes them
         self.now += datetime.timedelta(seconds=assignments_timeout + 1)
+        self.assertNotIn(assignment, Assignment.objects.get_available())
+        self.assertGreaterEqual(AssignmentSession.objects.close_expired(),
+            len(sessions))
 
         # and now, 'assignment' must be available again
         self.assertIn(assignment, Assignment.objects.get_available())
@@ -187,9 +218,11 @@ class AssignmentManagerTest(TimezoneNowMockedTestCase):
         self.assertNotIn(assignment, Assignment.objects.get_available())
         
         # force expiration.
-        # All sessions will expire and assignment will be available.
+        # All sessions will expire and, once the sweeper closes them,
+        # assignment will be available.
         assign_timeout = seg_prob_details.assignments_timeout
         self.now += datetime.timedelta(seconds=assign_timeout+1)        
+        AssignmentSession.objects.close_expired()
         self.assertIn(assignment, Assignment.objects.get_available())
         
 class AssignmentSessionManagerTest(TimezoneNowMockedTestCase):
@@ -210,6 +243,10 @@ class AssignmentSessionManagerTest(TimezoneNowMockedTestCase):
         self.workers.append(User.objects.get(username='worker9'))
         self.workers.append(User.objects.get(username='worker10'))
 
+        # the fixture doesn't have the session counters nor the dispatch slots
+        Assignment.objects.update_session_counters()
+        Assignment.objects.sync_slots()
+
     def test_get_by_worker_allocation(self):
         w1 = self.workers[0]
         s1_w1 = AssignmentSession.objects.get_by_worker(w1)
@@ -291,6 +328,435 @@ class AssignmentSessionManagerTest(TimezoneNowMockedTestCase):
             self.workers[0]))
 
 
+class AssignmentSessionCountersTest(TimezoneNowMockedTestCase):
+    fixtures = ('initial.json',)
+
+    def setUp(self):
+        super(AssignmentSessionCountersTest, self).setUp()
+
+        Assignment.objects.update_session_counters()
+        self.assignment = Assignment.objects.filter(
+            sessions__isnull=True).order_by('?')[0]
+        self.workers = User.objects.all()[0:4]
+
+    def _counters(self):
+        return Assignment.objects.filter(pk=self.assignment.pk).values_list(
+            *Assignment.SESSION_COUNTERS)[0]
+
+    def _create_session(self, worker):
+        return AssignmentSession.objects.create(assignment=self.assignment,
+            worker=worker)
+
+    def test_transitions(self):
+        sessions = [self._create_session(w) for w in self.workers]
+        self.assertEqual(self._counters(), (4, 0, 0, 0))
+
+        sessions[0].close()
+        sessions[0].save()
+        _close_session_w_result(sessions[1])
+        sessions[1].save()
+        sessions[2].cancel()
+
+        # saving a closed session again doesn't count it twice
+        sessions[0].save()
+
+        self.now += sessions[3].timeout + datetime.timedelta(seconds=1)
+        self.assertGreaterEqual(AssignmentSession.objects.close_expired(), 1)
+
+        # open, w/ result, skipped and expired
+        self.assertEqual(self._counters(), (0, 1, 1, 1))
+
+    def test_close_expired_in_batches(self):
+        sessions = [self._create_session(w) for w in self.workers]
+        self.now += sessions[0].timeout + datetime.timedelta(seconds=1)
+
+        self.assertGreaterEqual(AssignmentSession.objects.close_expired(
+            batch_size=1), len(sessions))
+        self.assertEqual(AssignmentSession.objects.filter(
+            close_time__isnull=True).count(), 0)
+        self.assertEqual(self._counters(), (0, 0, 0, len(sessions)))
+
+        # the workers are free again
+        AssignmentSession.objects.create(worker=self.workers[0],
+            assignment=Assignment.objects.exclude(
+                pk=self.assignment.pk).order_by('?')[0])
+
+    def test_stale_session_isnt_closed_twice(self):
+        session = self._create_session(self.workers[0])
+        stale = AssignmentSession.objects.get(pk=session.pk)
+
+        self.now += session.timeout + datetime.timedelta(seconds=1)
+        self.assertEqual(AssignmentSession.objects.close_expired(), 1)
+        close_time = AssignmentSession.objects.get(pk=session.pk).close_time
+
+        stale.close()
+        self.assertRaises(InvalidStateError, stale.save)
+        self.assertEqual(AssignmentSession.objects.get(
+            pk=session.pk).close_time, close_time)
+        self.assertEqual(self._counters(), (0, 0, 0, 1))
+
+    def test_stale_saves_are_reconciled(self):
+        stale = Assignment.objects.get(pk=self.assignment.pk)
+        self._create_session(self.workers[0])
+        expected = self._counters()
+
+        # a stale instance overwrites the counters, until they're recomputed
+        # (see the reconcile_assignments command)
+        stale.save()
+        self.assertNotEqual(self._counters(), expected)
+        self.assertEqual(Assignment.objects.update_session_counters(), 1)
+        self.assertEqual(self._counters(), expected)
+
+    def test_update_session_counters(self):
+        self._create_session(self.workers[0])
+        expected = self._counters()
+
+        Assignment.objects.update(open_sessions_count=0,
+            sessions_w_result_count=7)
+        self.assertGreater(Assignment.objects.update_session_counters(), 0)
+        self.assertEqual(self._counters(), expected)
+        self.assertEqual(Assignment.objects.update_session_counters(), 0)
+
+
+class AssignmentScoringTest(TimezoneNowMockedTestCase):
+    fixtures = ('initial.json',)
+
+    def setUp(self):
+        super(AssignmentScoringTest, self).setUp()
+
+        Assignment.objects.update_session_counters()
+        self.assignment = Assignment.objects.filter(
+            sessions__isnull=True).order_by('?')[0]
+        session = AssignmentSession.objects.create(
+            assignment=self.assignment, worker=User.objects.all()[0])
+        self.stats = AssignmentSessionStats.objects.create(
+            assignment_session=session, mileage=10)
+        _close_session_w_result(session)
+        session.save()
+
+    def test_get_pending_scoring(self):
+        pending = Assignment.objects.get_pending_scoring()
+        Assignment.objects.filter(pk=self.assignment.pk).update(
+            concluded=True)
+        self.assertIn(self.assignment, pending.all())
+
+        AssignmentSessionStats.objects.filter(pk=self.stats.pk).update(
+            accuracy=1)
+        self.assertNotIn(self.assignment, pending.all())
+
+    def test_score_sessions_wo_merge(self):
+        assignment = Assignment.objects.get(pk=self.assignment.pk)
+        assignment.merge = None
+        self.assertRaises(InvalidStateError, assignment.score_sessions)
+
+    def test_update_accuracies_is_idempotent(self):
+        AssignmentSessionStats.objects.filter(pk=self.stats.pk).update(
+            accuracy=1)
+        self.assertEqual(AssignmentSessionStats.objects.update_accuracies(
+            self.assignment), 0)
+
+    def test_get_accuracy(self):
+        n_radii = len(AssignmentSessionStats.ACCURACY_RADII)
+        self.assertEqual(AssignmentSessionStats.get_accuracy(
+            [(0, 0, 0.5)] * n_radii), Decimal('0.5'))
+        self.assertEqual(AssignmentSessionStats.get_accuracy(
+            [(0, 0, float('nan'))] * n_radii), 0)
+
+
+class AssignmentSlotManagerTest(TimezoneNowMockedTestCase):
+    fixtures = ('initial.json',)
+
+    def setUp(self):
+        super(AssignmentSlotManagerTest, self).setUp()
+
+        Assignment.objects.update_session_counters()
+        Assignment.objects.sync_slots()
+        self.assignment = Assignment.objects.get_public().filter(
+            concluded=False).order_by('?')[0]
+        self.n_slots = self.assignment.n_sessions_until_conclusion
+        self.workers = User.objects.all()[0:self.n_slots + 1]
+
+    def _create_free_assignment(self):
+        """Creates another public assignment, whose slots are all free, so
+        that there's something to hand out next whatever the fixture holds."""
+        a = self.assignment
+        return Assignment.objects.create(seg_prob=a.seg_prob, tile=a.tile.name,
+            tile_bbox_x0=a.tile_bbox_x0, tile_bbox_y0=a.tile_bbox_y0,
+            tile_bbox_x1=a.tile_bbox_x1, tile_bbox_y1=a.tile_bbox_y1,
+            workable=True)
+
+    def test_sync(self):
+        self.assertEqual(self.assignment.slots.count(), self.n_slots)
+        self.assertFalse(AssignmentSlot.objects.filter(
+            assignment__workable=False).exists())
+
+        session = AssignmentSession.objects.create(assignment=self.assignment,
+            worker=self.workers[0])
+        AssignmentSlot.objects.all().delete()
+        Assignment.objects.sync_slots()
+        self.assertEqual(self.assignment.slots.count(), self.n_slots)
+        self.assertEqual(self.assignment.slots.get(
+            worker=self.workers[0]).expiration_deadline,
+            session.expiration_deadline)
+
+    def test_adjust_keeps_reservations(self):
+        other = self._create_free_assignment()
+        n_slots = other.n_sessions_until_conclusion
+        self.assertEqual(other.slots.count(), n_slots)
+
+        slot = other.slots.all()[0]
+        self.assertTrue(AssignmentSlot.objects.take(slot, self.workers[0]))
+        other.save()
+        self.assertEqual(other.slots.count(), n_slots)
+        self.assertTrue(other.slots.filter(worker=self.workers[0]).exists())
+
+        # the slots follow the workable flag
+        other.workable = False
+        other.save()
+        self.assertEqual(other.slots.count(), 0)
+        other.workable = True
+        other.save()
+        self.assertEqual(other.slots.count(), n_slots)
+
+    def test_claim_and_release(self):
+        free = AssignmentSlot.objects.get_free().filter(
+            assignment=self.assignment)
+
+        sessions = [AssignmentSession.objects.create(
+            assignment=self.assignment, worker=w) for w in
+                    self.workers[0:self.n_slots]]
+        self.assertEqual(free.count(), 0)
+
+        # skipping gives the slot back...
+        sessions[0].close()
+        sessions[0].save()
+        self.assertEqual(free.count(), 1)
+
+        # ...while finishing uses it up
+        _close_session_w_result(sessions[1])
+        sessions[1].save()
+        self.assertEqual(free.count(), 1)
+        self.assertEqual(self.assignment.slots.count(), self.n_slots - 1)
+
+    def test_expired_slots_are_free(self):
+        for w in self.workers[0:self.n_slots]:
+            AssignmentSession.objects.create(assignment=self.assignment,
+                worker=w)
+        free = AssignmentSlot.objects.get_free().filter(
+            assignment=self.assignment)
+        self.assertEqual(free.count(), 0)
+
+        timeout = self.assignment.seg_prob.details.assignments_timeout
+        self.now += datetime.timedelta(seconds=timeout + 1)
+        self.assertEqual(free.count(), self.n_slots)
+
+    def test_take_is_exclusive(self):
+        slot = AssignmentSlot.objects.get_free().filter(
+            assignment=self.assignment)[0]
+        self.assertTrue(AssignmentSlot.objects.take(slot, self.workers[0]))
+
+        # a worker that picked the same slot concurrently loses it...
+        self.assertFalse(AssignmentSlot.objects.take(slot, self.workers[1]))
+
+        # ...but reserving moves on to the next free slot
+        reserved = AssignmentSlot.objects.reserve_for(self.workers[1])
+        self.assertNotEqual(reserved.pk, slot.pk)
+        self.assertEqual(reserved.worker, self.workers[1])
+
+    def test_reserve_for_wo_free_slots(self):
+        AssignmentSlot.objects.update(worker=self.workers[0],
+            expiration_deadline=self.now + datetime.timedelta(hours=1))
+        self.assertIsNone(AssignmentSlot.objects.reserve_for(self.workers[1]))
+
+    def test_reserve_next_for(self):
+        self._create_free_assignment()
+        worker = self.workers[0]
+        session = AssignmentSession.objects.create(assignment=self.assignment,
+            worker=worker)
+
+        slot = AssignmentSlot.objects.reserve_next_for(session)
+        self.assertIsNotNone(slot)
+        self.assertNotEqual(slot.assignment_id, self.assignment.pk)
+        self.assertGreater(slot.expiration_deadline,
+            session.expiration_deadline)
+
+        # asking again keeps the same reservation
+        self.assertEqual(AssignmentSlot.objects.reserve_next_for(session).pk,
+            slot.pk)
+
+        # the next session is created for the reserved assignment
+        session.close()
+        session.save()
+        self.assertEqual(AssignmentSession.objects.get_by_worker(
+            worker).assignment_id, slot.assignment_id)
+
+    def test_reservations_expire(self):
+        self._create_free_assignment()
+        session = AssignmentSession.objects.create(assignment=self.assignment,
+            worker=self.workers[0])
+        slot = AssignmentSlot.objects.reserve_next_for(session)
+        self.assertIsNotNone(slot)
+        self.assertFalse(AssignmentSlot.objects.get_free().filter(
+            pk=slot.pk).exists())
+
+        self.now = slot.expiration_deadline + datetime.timedelta(seconds=1)
+        self.assertIsNone(AssignmentSlot.objects.get_reserved_for(
+            self.workers[0]))
+        self.assertTrue(AssignmentSlot.objects.get_free().filter(
+            pk=slot.pk).exists())
+
+    def test_get_next_for_skips_seen_assignments(self):
+        self._create_free_assignment()
+        worker = self.workers[0]
+        session = AssignmentSession.objects.create(assignment=self.assignment,
+            worker=worker)
+        session.close()
+        session.save()
+
+        # the assignment skipped still has free slots
+        self.assertTrue(AssignmentSlot.objects.get_free().filter(
+            assignment=self.assignment).exists())
+        slot = AssignmentSlot.objects.get_next_for(worker)
+        self.assertIsNotNone(slot)
+        self.assertNotEqual(slot.assignment_id, self.assignment.pk)
+
+
+@skipIf(connection.vendor == 'sqlite',
+    'the in-memory test database isn\'t shared by threads')
+class AssignmentSlotContentionTest(TransactionTestCase):
+    """Many workers asking for sessions at once, each in a thread of its
+    own, as the requests of a multi-threaded server."""
+
+    fixtures = ('initial.json',)
+
+    N_WORKERS = 20
+
+    def setUp(self):
+        Assignment.objects.update_session_counters()
+        Assignment.objects.sync_slots()
+        self.assignment = AssignmentSlot.objects.get_free().filter(
+            seg_prob__published=True).order_by('?')[0].assignment
+        # the only one handed out, so every worker competes for its slots
+        Assignment.objects.exclude(pk=self.assignment.pk).update(
+            workable=False)
+        AssignmentSlot.objects.adjust(Assignment.objects.all())
+        self.n_needed = self.assignment.n_sessions_until_conclusion
+        self.workers = [User.objects.create_user('contender%d' % i) for i in
+                        xrange(self.N_WORKERS)]
+
+    def _run_at_once(self, fun):
+        start = threading.Event()
+        results, errors = {}, []
+
+        def run(worker):
+            start.wait()
+            try:
+                results[worker.pk] = fun(worker)
+            except Exception, e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=run, args=(w,)) for w in
+                   self.workers]
+        for t in threads:
+            t.start()
+        start.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        return results
+
+    def test_take_same_slot(self):
+        slot = AssignmentSlot.objects.get_free().filter(
+            assignment=self.assignment).select_related('seg_prob__details')[0]
+        taken = self._run_at_once(lambda w: AssignmentSlot.objects.take(slot,
+            w))
+        self.assertEqual(taken.values().count(True), 1)
+
+    def test_no_assignment_gets_more_open_sessions_than_needed(self):
+        sessions = self._run_at_once(
+            lambda w: AssignmentSession.objects.get_by_worker(w))
+
+        created = [s for s in sessions.values() if s is not None]
+        self.assertTrue(created)
+        self.assertTrue(all(s.assignment_id == self.assignment.pk for s in
+                            created))
+        self.assertLessEqual(AssignmentSession.objects.filter(
+            assignment=self.assignment, close_time__isnull=True).count(),
+            self.n_needed)
+        self.assertLessEqual(AssignmentSlot.objects.filter(
+            assignment=self.assignment).count(), self.n_needed)
+
+
+class CompositeIndexesTest(TestCase):
+    """The composite indexes declared by the models exist in the database,
+    whether it was built by the migrations or by syncdb."""
+
+    def _assert_indexes_exist(self, model, expected_columns):
+        indexes = get_composite_indexes(model)
+        self.assertEqual(sorted(indexes.values()), sorted(expected_columns))
+        self.assertTrue(set(indexes) <= get_index_names(
+            model._meta.db_table))
+
+    def test_assignment_session_indexes(self):
+        self._assert_indexes_exist(AssignmentSession, [
+            ['worker_id', 'close_time'],
+            ['assignment_id', 'close_time', 'expiration_deadline'],
+            ['close_time', 'expiration_deadline'],
+            ['assignment_id', 'has_result']])
+
+    def test_assignment_slot_indexes(self):
+        self._assert_indexes_exist(AssignmentSlot,
+            [['seg_prob_id', 'assignment_id']])
+
+
+@skipUnless(connection.vendor == 'mysql', 'query plans are checked on MySQL')
+class AssignmentSessionQueryPlanTest(TestCase):
+    """The filters of AssignmentSessionManager must be able to use the
+    composite indexes of the model (see crowd.models.indexes)."""
+
+    fixtures = ('initial.json',)
+
+    TABLE = AssignmentSession._meta.db_table
+
+    def setUp(self):
+        self.assignment = Assignment.objects.order_by('?')[0]
+        self.worker = User.objects.all()[0]
+
+    def _assert_can_use_index(self, queryset, columns):
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN ' + sql, params)
+        names = [c[0] for c in cursor.description]
+        plans = [dict(zip(names, row)) for row in cursor.fetchall()]
+
+        possible_keys = []
+        for plan in plans:
+            if plan['table'] == self.TABLE:
+                possible_keys = (plan['possible_keys'] or '').split(',')
+        self.assertIn(db.create_index_name(self.TABLE, columns),
+            possible_keys)
+
+    def test_open_sessions_of_worker(self):
+        self._assert_can_use_index(AssignmentSession.objects.filter(
+            worker=self.worker, close_time__isnull=True),
+            ['worker_id', 'close_time'])
+
+    def test_active_sessions_of_assignment(self):
+        self._assert_can_use_index(self.assignment.sessions.get_active(),
+            ['assignment_id', 'close_time', 'expiration_deadline'])
+
+    def test_sessions_w_result_of_assignment(self):
+        self._assert_can_use_index(self.assignment.sessions.get_w_result(),
+            ['assignment_id', 'has_result'])
+
+    def test_expired_open_sessions(self):
+        self._assert_can_use_index(AssignmentSession.objects.filter(
+            close_time__isnull=True, expiration_deadline__lt=timezone.now()),
+            ['close_time', 'expiration_deadline'])
+
+
 class AssignmentSessionModelTest(TimezoneNowMockedTestCase):
     fixtures = ('initial.json',)
 
@@ -318,6 +784,16 @@ class AssignmentSessionModelTest(TimezoneNowMockedTestCase):
         self.session.close()
         self.assertRaises(InvalidStateError, self.session.close)
 
+    def test_session_closing_w_unreadable_result(self):
+        self.assertRaises(IOError, self.session.close,
+            StringIO('not an image'))
+        self.assertTrue(self.session.active)
+        self.assertFalse(self.session.has_result)
+
+        # it can still be closed (i.e. skipped)
+        self.session.close()
+        self.assertTrue(self.session.closed)
+
     def test_session_closing_w_result(self):
         # results should be set only by closing
 
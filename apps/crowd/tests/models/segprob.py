@@ -0,0 +1,125 @@
+###############################################################################
+## Center for Advanced Computing Research
+## California Institute of Technology
+##
+## Tests for models related to segmentation problems in crowd app.
+##
+## Copyright 2012 Rafael Barreto <barreto@cacr.caltech.edu>
+###############################################################################
+
+
+# =============
+# Python stdlib
+# =============
+
+import datetime
+import os
+import tempfile
+
+try:
+    from cStringIO import StringIO
+except:
+    from StringIO import StringIO
+
+# ==============
+# Django imports
+# ==============
+
+from django.test import SimpleTestCase
+
+# ================
+# external imports
+# ================
+
+import numpy
+from PIL import Image
+
+# ===============
+# project imports
+# ===============
+
+from crowd.models.segprob import SegmentationProblem
+from crowd.processing.merge import PngStripWriter, stitch_masks
+from helpers import filesystem as h_fs
+from helpers.django_related.tests import TimezoneNowMockedTestCase
+
+
+class SegmentationProblemLockTest(TimezoneNowMockedTestCase):
+    fixtures = ('initial.json',)
+
+    FIELD = 'creation_locked_at'
+    TIMEOUT = 60
+
+    def setUp(self):
+        super(SegmentationProblemLockTest, self).setUp()
+        self.pk = SegmentationProblem.objects.all()[0].pk
+
+    def _lock(self):
+        return SegmentationProblem.objects.lock(self.pk, self.FIELD,
+            self.TIMEOUT)
+
+    def test_lock_is_taken_once(self):
+        self.assertTrue(self._lock())
+        self.assertFalse(self._lock())
+        self.assertTrue(SegmentationProblem.objects.is_locked(self.pk,
+            self.FIELD, self.TIMEOUT))
+
+        SegmentationProblem.objects.unlock(self.pk, self.FIELD)
+        self.assertFalse(SegmentationProblem.objects.is_locked(self.pk,
+            self.FIELD, self.TIMEOUT))
+        self.assertTrue(self._lock())
+
+    def test_lock_times_out(self):
+        self.assertTrue(self._lock())
+        self.now += datetime.timedelta(seconds=self.TIMEOUT + 1)
+        self.assertFalse(SegmentationProblem.objects.is_locked(self.pk,
+            self.FIELD, self.TIMEOUT))
+        self.assertTrue(self._lock())
+
+
+class SegmentationProblemMergeTest(SimpleTestCase):
+    # a tile of 80 pixels w/ a border of 20 (see TilingEngine)
+    TILE_DIM = 80
+    BORDER = 20
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'merge.png')
+
+        # the border is all foreground, the rest only one pixel
+        merge = numpy.zeros((self.TILE_DIM, self.TILE_DIM), numpy.uint8)
+        merge[:self.BORDER] = merge[-self.BORDER:] = 255
+        merge[:, :self.BORDER] = merge[:, -self.BORDER:] = 255
+        merge[self.BORDER + 10, self.BORDER + 5] = 255
+        Image.fromarray(merge).save(self.path)
+
+    def tearDown(self):
+        h_fs.rm(self.tmp_dir, ignore_errors=True)
+
+    def _place(self, tile_bbox):
+        x0, y0, box = SegmentationProblem._get_merge_placement(tile_bbox,
+            self.BORDER)
+        return x0, y0, lambda: SegmentationProblem._load_assignment_merge(
+            self.path, box)
+
+    def test_load_assignment_merge_wo_border(self):
+        _, _, load = self._place((0, 0, self.TILE_DIM, self.TILE_DIM))
+        mask = load()
+        self.assertEqual(mask.shape, (40, 40))
+        self.assertEqual(zip(*numpy.nonzero(mask)), [(10, 5)])
+
+    def test_merge_placement(self):
+        # the stored bbox is the one of the whole tile, border included, as
+        # it has been since before the tiling engine
+        self.assertEqual(SegmentationProblem._get_merge_placement(
+            (100, 50, 180, 130), self.BORDER), (120, 70, (20, 20, 60, 60)))
+
+    def test_assignment_merge_layout(self):
+        # the tile at (100, 50) in the image, so its bbox w/o the border
+        # starts at (120, 70)
+        output = StringIO()
+        stitch_masks([self._place((100, 50, 180, 130))], PngStripWriter(
+            output, (200, 150)), 16)
+        merge = numpy.asarray(Image.open(StringIO(
+            output.getvalue())).convert('L'))
+        self.assertEqual(zip(*numpy.nonzero(merge)), [(80, 125)])
@@ -0,0 +1,17 @@
+###############################################################################
+## Center for Advanced Computing Research
+## California Institute of Technology
+##
+## Tests package for processing pipelines in crowd app.
+##
+## Copyright 2012 Rafael Barreto <barreto@cacr.caltech.edu>
+###############################################################################
+
+
+from crowd.tests.processing.checkpoint import *
+from crowd.tests.processing.costs import *
+from crowd.tests.processing.livevessel import *
+from crowd.tests.processing.merge import *
+from crowd.tests.processing.preprocess import *
+from crowd.tests.processing.results import *
+from crowd.tests.processing.tiling import *
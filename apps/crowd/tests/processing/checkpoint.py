@@ -0,0 +1,76 @@
+###############################################################################
+## Center for Advanced Computing Research
+## California Institute of Technology
+##
+## Tests for the checkpoints of the creation of assignments in crowd app.
+##
+## Copyright 2012 Rafael Barreto <barreto@cacr.caltech.edu>
+###############################################################################
+
+
+# =============
+# Python stdlib
+# =============
+
+import os
+import tempfile
+
+# ==============
+# Django imports
+# ==============
+
+from django.test import SimpleTestCase
+
+# ===============
+# project imports
+# ===============
+
+from crowd.processing.checkpoint import CreationCheckpoint
+from helpers import filesystem as h_fs
+
+
+class CreationCheckpointTest(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'assignment', 'checkpoint')
+
+    def tearDown(self):
+        h_fs.rm(self.tmp_dir, ignore_errors=True)
+
+    def test_resume(self):
+        checkpoint = CreationCheckpoint(self.path, ['image.png', u'100'])
+        self.assertFalse(checkpoint.matches())
+        checkpoint.start()
+        checkpoint.record('tiling', {'index': 0, 'name': 'tile_0.png'})
+        checkpoint.record('tiling', {'index': 1, 'name': 'tile_1.png'})
+        checkpoint.record('pre_seg', {'index': 0, 'name': 'pre_seg_0.png'})
+
+        resumed = CreationCheckpoint(self.path, ['image.png', u'100'])
+        self.assertTrue(resumed.matches())
+        self.assertEqual(sorted(resumed.done('tiling')), [0, 1])
+        self.assertEqual(resumed.done('pre_seg')[0]['name'], 'pre_seg_0.png')
+        self.assertEqual(resumed.done('preprocessing'), {})
+
+    def test_signature_mismatch(self):
+        CreationCheckpoint(self.path, ['image.png', u'100']).start()
+        checkpoint = CreationCheckpoint(self.path, ['image.png', u'200'])
+        self.assertFalse(checkpoint.matches())
+        self.assertEqual(checkpoint.done('tiling'), {})
+
+    def test_truncated_step(self):
+        checkpoint = CreationCheckpoint(self.path, ['image.png'])
+        checkpoint.start()
+        checkpoint.record('tiling', {'index': 0, 'name': 'tile_0.png'})
+        with open(self.path, 'a') as f:
+            f.write('{"stage": "tiling", "in')
+
+        resumed = CreationCheckpoint(self.path, ['image.png'])
+        self.assertTrue(resumed.matches())
+        self.assertEqual(resumed.done('tiling').keys(), [0])
+
+    def test_clear(self):
+        checkpoint = CreationCheckpoint(self.path, ['image.png'])
+        checkpoint.start()
+        checkpoint.clear()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertFalse(checkpoint.matches())
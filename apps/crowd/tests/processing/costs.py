@@ -0,0 +1,105 @@
+###############################################################################
+## Center for Advanced Computing Research
+## California Institute of Technology
+##
+## Tests for the NumPy LiveVessel cost computation in crowd app.
+##
+## Copyright 2012 Rafael Barreto <barreto@cacr.caltech.edu>
+###############################################################################
+
+
+# =============
+# Python stdlib
+# =============
+
+import os
+import struct
+import tempfile
+
+try:
+    from cStringIO import StringIO
+except:
+    from StringIO import StringIO
+
+# ==============
+# Django imports
+# ==============
+
+from django.test import SimpleTestCase
+
+# ================
+# external imports
+# ================
+
+import numpy
+from PIL import Image, ImageDraw
+from backports import lzma
+
+# ===============
+# project imports
+# ===============
+
+from crowd.models.segprob import SegmentationProblem
+from crowd.processing import costs
+from crowd.processing.preprocess import write_preprocess_file
+from helpers import filesystem as h_fs
+
+
+def _write_golden_file(f, costs, dimension, scales):
+    """Former pure Python writer of the preprocess files, kept as reference
+    of the binary layout."""
+    n_scales = len(scales)
+
+    f.write(struct.pack('iii', dimension, dimension, n_scales))
+    f.write(struct.pack('%df' % n_scales, *scales))
+
+    for scale in costs:
+        for row in scale:
+            f.write(struct.pack('%dB' % len(row), *row))
+
+
+class CostsTest(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+        # a dark vessel crossing a bright background
+        self.tile = Image.new('RGB', (64, 64), (200, 180, 160))
+        ImageDraw.Draw(self.tile).line([(0, 32), (63, 32)], fill=(90, 40, 30),
+            width=3)
+        self.tile_path = os.path.join(self.tmp_dir, 'tile.png')
+        self.tile.save(self.tile_path)
+
+    def tearDown(self):
+        h_fs.rm(self.tmp_dir, ignore_errors=True)
+
+    def test_layout_matches_former_writer(self):
+        # only the layout of the file: the costs themselves aren't checked
+        # against the MATLAB script (see crowd.processing.costs)
+        scales = (1.0, 2.0, 3.0)
+        tile_costs = costs.compute_costs(self.tile, scales)
+        self.assertEqual(tile_costs.shape, (3, 64, 64))
+        self.assertEqual(tile_costs.dtype, numpy.uint8)
+
+        output = StringIO()
+        write_preprocess_file(output, tile_costs, scales)
+        golden = StringIO()
+        _write_golden_file(golden, tile_costs.tolist(), 64, scales)
+
+        self.assertEqual(output.getvalue(), golden.getvalue())
+
+    def test_vessels_are_cheaper(self):
+        for plane in costs.compute_costs(self.tile):
+            self.assertLess(plane[32, 10:54].mean(), plane[5, 10:54].mean())
+            self.assertLess(plane[32, 10:54].mean(), plane[58, 10:54].mean())
+
+    def test_preprocess_tile_is_readable(self):
+        output_path = os.path.join(self.tmp_dir, 'tile_preprocess')
+        costs.preprocess_tile(self.tile_path, output_path, (1.5, 2.5))
+        with open(output_path, 'rb') as f:
+            with lzma.open(output_path + '.xz', 'wb') as xz_file:
+                xz_file.write(f.read())
+
+        data = SegmentationProblem.read_file(output_path + '.xz')
+        self.assertEqual(data['scales'], (1.5, 2.5))
+        self.assertEqual(numpy.array(data['costs'][:2]).tolist(),
+            costs.compute_costs(self.tile, (1.5, 2.5)).tolist())
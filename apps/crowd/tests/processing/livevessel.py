@@ -0,0 +1,159 @@
+###############################################################################
+## Center for Advanced Computing Research
+## California Institute of Technology
+##
+## Tests for the LiveVessel preprocessing in crowd app.
+##
+## Copyright 2012 Rafael Barreto <barreto@cacr.caltech.edu>
+###############################################################################
+
+
+# =============
+# Python stdlib
+# =============
+
+import os
+import sys
+import tempfile
+
+# ==============
+# Django imports
+# ==============
+
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+
+# ===============
+# project imports
+# ===============
+
+from crowd.processing.livevessel import PreprocessScheduler
+from helpers import filesystem as h_fs
+
+
+# stands for the MATLAB 'offline' script in batch mode. Its behavior depends on
+# the prefix of the tile file names and, for each tile, it writes in the output
+# how many stubs (itself included) were running at that moment.
+STUB_SOURCE = '''
+import os, sys, time
+
+work_dir, manifest = sys.argv[1:3]
+with open(os.path.join(work_dir, 'starts'), 'a') as f:
+    f.write('%d\\n' % os.getpid())
+running_dir = os.path.join(work_dir, 'running')
+marker = os.path.join(running_dir, str(os.getpid()))
+open(marker, 'w').close()
+
+try:
+    for line in open(manifest):
+        tile, output = line.rstrip('\\n').split('\\t')
+        name = os.path.basename(tile)
+        if name.startswith('crash'):
+            sys.exit(1)
+        if name.startswith('partial'):
+            # dies halfway through writing the output
+            with open(output + '.part', 'w') as f:
+                f.write('0')
+            sys.exit(3)
+        if name.startswith('bad'):
+            continue
+        if name.startswith('slow'):
+            time.sleep(5)
+        if name.startswith('flaky') and not os.path.exists(tile + '.tried'):
+            open(tile + '.tried', 'w').close()
+            sys.exit(2)
+        time.sleep(0.1)
+        with open(output + '.part', 'w') as f:
+            f.write(str(len(os.listdir(running_dir))))
+        os.rename(output + '.part', output)
+finally:
+    os.remove(marker)
+'''
+
+
+class PreprocessSchedulerTest(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tmp_dir, 'running'))
+        self.stub_path = os.path.join(self.tmp_dir, 'stub.py')
+        with open(self.stub_path, 'w') as f:
+            f.write(STUB_SOURCE)
+
+    def tearDown(self):
+        h_fs.rm(self.tmp_dir, ignore_errors=True)
+
+    def _jobs(self, *names):
+        jobs = []
+        for name in names:
+            tile_path = os.path.join(self.tmp_dir, name)
+            open(tile_path, 'w').close()
+            jobs.append((tile_path, tile_path + '.out'))
+        return jobs
+
+    def _run(self, jobs, **kwargs):
+        with override_settings(CROWD_LIVEVESSEL_COMMAND=[sys.executable,
+                self.stub_path, self.tmp_dir, '%(manifest)s']):
+            return PreprocessScheduler(**kwargs).run(jobs)
+
+    def _n_starts(self):
+        with open(os.path.join(self.tmp_dir, 'starts')) as f:
+            return len(f.readlines())
+
+    def test_tiles_are_split_among_bounded_processes(self):
+        jobs = self._jobs(*['tile_%d' % i for i in xrange(8)])
+        progress = []
+        failures = self._run(jobs, max_processes=3,
+            progress=lambda *args: progress.append(args))
+
+        self.assertEqual(failures, [])
+        self.assertEqual(progress[-1], ('preprocessing', 8, 8))
+        # the startup cost is paid once per process, not once per tile
+        self.assertEqual(self._n_starts(), 3)
+        for _, output_path in jobs:
+            with open(output_path) as f:
+                self.assertLessEqual(int(f.read()), 3)
+
+    def test_batch_size(self):
+        self._run(self._jobs(*['tile_%d' % i for i in xrange(5)]),
+            max_processes=1, batch_size=2)
+        self.assertEqual(self._n_starts(), 3)
+
+    def test_failures_are_reported(self):
+        jobs = self._jobs('tile_0', 'bad_1', 'tile_2')
+        failures = self._run(jobs, max_processes=1, retries=2)
+
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(failures[0]['tile'], jobs[1][0])
+        self.assertEqual(failures[0]['attempts'], 3)
+        self.assertIn('no output was written', failures[0]['reason'])
+        self.assertTrue(os.path.exists(jobs[0][1]))
+        self.assertTrue(os.path.exists(jobs[2][1]))
+
+    def test_crash_only_fails_the_culprit(self):
+        jobs = self._jobs('tile_0', 'crash_1', 'tile_2')
+        failures = self._run(jobs, max_processes=1, retries=0)
+
+        self.assertEqual([f['tile'] for f in failures], [jobs[1][0]])
+        self.assertIn('exited with code 1', failures[0]['reason'])
+        self.assertTrue(os.path.exists(jobs[2][1]))
+
+    def test_partial_output_is_not_taken(self):
+        jobs = self._jobs('tile_0', 'partial_1')
+        failures = self._run(jobs, max_processes=1, retries=0)
+
+        self.assertEqual([f['tile'] for f in failures], [jobs[1][0]])
+        self.assertIn('exited with code 3', failures[0]['reason'])
+        self.assertFalse(os.path.exists(jobs[1][1]))
+
+    def test_failures_are_retried(self):
+        self.assertEqual(self._run(self._jobs('flaky_0'), retries=1), [])
+
+        failures = self._run(self._jobs('flaky_1'), retries=0)
+        self.assertEqual(failures[0]['attempts'], 1)
+
+    def test_timeout(self):
+        jobs = self._jobs('slow_0')
+        failures = self._run(jobs, timeout=1, retries=0)
+
+        self.assertEqual(len(failures), 1)
+        self.assertIn('timed out', failures[0]['reason'])
@@ -0,0 +1,355 @@
+###############################################################################
+## Center for Advanced Computing Research
+## California Institute of Technology
+##
+## Tests for the merge of the results of assignments in crowd app.
+##
+## Copyright 2012 Rafael Barreto <barreto@cacr.caltech.edu>
+###############################################################################
+
+
+# =============
+# Python stdlib
+# =============
+
+import multiprocessing
+import os
+import tempfile
+
+try:
+    from cStringIO import StringIO
+except:
+    from StringIO import StringIO
+
+# ==============
+# Django imports
+# ==============
+
+from django.test import SimpleTestCase
+
+# ================
+# external imports
+# ================
+
+import numpy
+from PIL import Image
+from PIL import ImageMath
+
+# ===============
+# project imports
+# ===============
+
+from crowd.exceptions import MergeError
+from crowd.processing.merge import MergeArtifacts, PngStripWriter
+from crowd.processing.merge import VoteAccumulator, merge_all, stitch_masks
+from helpers import dip as h_dip
+from helpers import filesystem as h_fs
+
+
+def _add_votes(args):
+    path, session_id, mask = args
+    return VoteAccumulator(path).add(session_id, mask)
+
+
+class VoteAccumulatorTest(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'assignment', 'votes.npz')
+
+        self.results = {}
+        self.masks = {}
+        for session_id in (1, 2, 3):
+            mask = numpy.where(numpy.random.rand(20, 20) < 0.5, 255,
+                0).astype(numpy.uint8)
+            path = os.path.join(self.tmp_dir, '%d.png' % session_id)
+            Image.fromarray(mask).save(path)
+            self.results[session_id] = path
+            self.masks[session_id] = mask
+
+    def tearDown(self):
+        h_fs.rm(self.tmp_dir, ignore_errors=True)
+
+    def _expected_votes(self, session_ids):
+        return sum((self.masks[i] > 0).astype(numpy.uint16) for i in
+                   session_ids)
+
+    def test_add_counts_once(self):
+        votes = VoteAccumulator(self.path)
+        self.assertTrue(votes.add(1, self.masks[1]))
+        self.assertFalse(votes.add(1, self.masks[1]))
+
+        # it's stored
+        votes = VoteAccumulator(self.path)
+        self.assertEqual(votes.session_ids, [])
+        self.assertFalse(votes.add(1, self.masks[1]))
+        self.assertTrue(numpy.array_equal(votes.votes,
+            self._expected_votes([1])))
+
+    def test_sync(self):
+        VoteAccumulator(self.path).add(1, self.masks[1])
+
+        votes = VoteAccumulator(self.path)
+        votes.sync(self.results)
+        self.assertEqual(sorted(votes.session_ids), [1, 2, 3])
+        self.assertTrue(numpy.array_equal(votes.votes,
+            self._expected_votes([1, 2, 3])))
+
+        # a result that is gone is discounted
+        del self.results[2]
+        votes = VoteAccumulator(self.path)
+        votes.sync(self.results)
+        self.assertEqual(sorted(votes.session_ids), [1, 3])
+        self.assertTrue(numpy.array_equal(votes.votes,
+            self._expected_votes([1, 3])))
+
+    def test_merge(self):
+        votes = VoteAccumulator(self.path)
+        self.assertIsNone(votes.merge(2.0))
+
+        votes.sync(self.results)
+        expected = self._expected_votes([1, 2, 3]) >= 2
+        self.assertTrue(numpy.array_equal(votes.merge(2.0) > 0, expected))
+        self.assertTrue(numpy.array_equal(votes.merge(1) > 0,
+            self._expected_votes([1, 2, 3]) == 3))
+
+    def test_merge_matches_merge_masks(self):
+        # the merge from the counts is the one the results were merged with
+        # before, ties (half of 4 results) included
+        mask = numpy.where(numpy.random.rand(20, 20) < 0.5, 255,
+            0).astype(numpy.uint8)
+        self.results[4] = os.path.join(self.tmp_dir, '4.png')
+        Image.fromarray(mask).save(self.results[4])
+
+        for session_ids in ([1], [1, 2], [1, 2, 3], [1, 2, 3, 4]):
+            results = dict((i, self.results[i]) for i in session_ids)
+            votes = VoteAccumulator(self.path)
+            votes.sync(results)
+            for alpha in (1.0, 2.0, 3.0):
+                expected = h_dip.merge_masks([results[i] for i in
+                    session_ids], alpha)['merge']
+                self.assertTrue(numpy.array_equal(votes.merge(alpha) > 0,
+                    numpy.asarray(expected) > 0))
+
+    def test_concurrent_adds(self):
+        pool = multiprocessing.Pool(3)
+        try:
+            added = pool.map(_add_votes, [(self.path, i, self.masks[i])
+                                          for i in (1, 2, 3)])
+        finally:
+            pool.close()
+            pool.join()
+
+        self.assertEqual(added, [True] * 3)
+        # none of them was overwritten by the others
+        votes = VoteAccumulator(self.path)
+        for i in (1, 2, 3):
+            self.assertFalse(votes.add(i, self.masks[i]))
+        self.assertTrue(numpy.array_equal(votes.votes,
+            self._expected_votes([1, 2, 3])))
+
+    def test_unreadable_result(self):
+        path = os.path.join(self.tmp_dir, '4.png')
+        with open(path, 'w') as f:
+            f.write('not an image')
+        self.results[4] = path
+
+        try:
+            VoteAccumulator(self.path).sync(self.results)
+            self.fail('MergeError not raised')
+        except MergeError, e:
+            self.assertEqual(e.session_id, 4)
+
+    def test_clear(self):
+        votes = VoteAccumulator(self.path)
+        votes.add(1, self.masks[1])
+        votes.clear()
+        self.assertEqual(votes.session_ids, [])
+        # nor any temporary file is left behind
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), [])
+
+    def test_size_mismatch(self):
+        votes = VoteAccumulator(self.path)
+        votes.add(1, self.masks[1])
+        self.assertRaises(MergeError, votes.add, 2, self.masks[2][:10])
+
+
+class MergeAllTest(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+        self.jobs = []
+        for key in xrange(4):
+            results = {}
+            for session_id in xrange(3):
+                mask = numpy.where(numpy.random.rand(20, 20) < 0.5, 255,
+                    0).astype(numpy.uint8)
+                path = os.path.join(self.tmp_dir, '%d_%d.png' % (key,
+                                                                 session_id))
+                Image.fromarray(mask).save(path)
+                results[session_id] = path
+            self.jobs.append((key, os.path.join(self.tmp_dir,
+                '%d_votes.npz' % key), results, 2.0, os.path.join(
+                self.tmp_dir, '%d_merge.png' % key)))
+
+        # one without results and one with a broken result
+        self.jobs.append((4, os.path.join(self.tmp_dir, '4_votes.npz'), {},
+            2.0, os.path.join(self.tmp_dir, '4_merge.png')))
+        broken_path = os.path.join(self.tmp_dir, 'broken.png')
+        with open(broken_path, 'w') as f:
+            f.write('not an image')
+        self.jobs.append((5, os.path.join(self.tmp_dir, '5_votes.npz'),
+            {7: broken_path}, 2.0, os.path.join(self.tmp_dir,
+            '5_merge.png')))
+
+    def tearDown(self):
+        h_fs.rm(self.tmp_dir, ignore_errors=True)
+
+    def _run(self, n_workers):
+        outputs, failures = merge_all(self.jobs, n_workers)
+        merges = dict((key, numpy.asarray(Image.open(path)))
+                      for key, path in outputs.iteritems() if path)
+        return outputs, failures, merges
+
+    def test_pool_and_serial_agree(self):
+        serial_outputs, serial_failures, serial_merges = self._run(1)
+        for f in os.listdir(self.tmp_dir):
+            if f.endswith('_votes.npz') or f.endswith('_merge.png'):
+                os.remove(os.path.join(self.tmp_dir, f))
+        outputs, failures, merges = self._run(3)
+
+        self.assertEqual(outputs, serial_outputs)
+        self.assertEqual(failures, serial_failures)
+        self.assertEqual(sorted(merges), range(4))
+        for key in merges:
+            self.assertTrue(numpy.array_equal(merges[key],
+                serial_merges[key]))
+
+        self.assertIsNone(outputs[4])
+        self.assertEqual(failures.keys(), [5])
+        self.assertIn('7', failures[5])
+
+
+class MergeArtifactsTest(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.n_builds = 0
+
+    def tearDown(self):
+        h_fs.rm(self.tmp_dir, ignore_errors=True)
+
+    def _build(self, path):
+        self.n_builds += 1
+        Image.new('L', (10, 10), 255).save(path, format='PNG')
+        return True
+
+    def test_version(self):
+        self.assertEqual(MergeArtifacts(self.tmp_dir, '1', [3, 1, 2]).version,
+            MergeArtifacts(self.tmp_dir, '1', [1, 2, 3]).version)
+        self.assertNotEqual(MergeArtifacts(self.tmp_dir, '1', [1, 2]).version,
+            MergeArtifacts(self.tmp_dir, '1', [1, 2, 3]).version)
+        self.assertNotEqual(
+            MergeArtifacts(self.tmp_dir, '1', [1], (0.5,)).version,
+            MergeArtifacts(self.tmp_dir, '1', [1], (1,)).version)
+
+    def test_get_builds_once_per_version(self):
+        artifacts = MergeArtifacts(self.tmp_dir, '1', [1, 2])
+        path = artifacts.get('merge', self._build)
+        self.assertEqual(artifacts.get('merge', self._build), path)
+        self.assertEqual(MergeArtifacts(self.tmp_dir, '1', [2, 1]).get(
+            'merge', self._build), path)
+        self.assertEqual(self.n_builds, 1)
+
+        # a new version replaces the old one
+        new_path = MergeArtifacts(self.tmp_dir, '1', [1, 2, 3]).get('merge',
+            self._build)
+        self.assertEqual(self.n_builds, 2)
+        self.assertTrue(os.path.exists(new_path))
+        self.assertFalse(os.path.exists(path))
+
+    def test_get_incomplete(self):
+        artifacts = MergeArtifacts(self.tmp_dir, '1', [1, 2])
+        path = artifacts.get('merge', self._build)
+
+        def build_incomplete(path):
+            self._build(path)
+            return MergeArtifacts.INCOMPLETE
+
+        # it's not stored as the version, so it's built every time...
+        artifacts = MergeArtifacts(self.tmp_dir, '1', [1, 2, 3])
+        for _ in xrange(2):
+            incomplete_path = artifacts.get('merge', build_incomplete)
+            self.assertNotEqual(incomplete_path, artifacts.get_path('merge'))
+            self.assertIsNone(artifacts.get_version('merge',
+                incomplete_path))
+        self.assertEqual(self.n_builds, 3)
+        # ...and the last complete version is kept meanwhile
+        self.assertTrue(os.path.exists(path))
+
+        complete_path = artifacts.get('merge', self._build)
+        self.assertEqual(artifacts.get_version('merge', complete_path),
+            artifacts.version)
+        self.assertEqual(os.listdir(self.tmp_dir),
+            [os.path.basename(complete_path)])
+
+    def test_get_stored(self):
+        artifacts = MergeArtifacts(self.tmp_dir, '1', [1, 2])
+        self.assertIsNone(artifacts.get_stored('merge'))
+        path = artifacts.get('merge', self._build)
+
+        # the last version stored is served until the new one is built
+        artifacts = MergeArtifacts(self.tmp_dir, '1', [1, 2, 3])
+        self.assertEqual(artifacts.get_stored('merge'), path)
+        self.assertIsNone(artifacts.get_version('merge', path))
+        self.assertIsNone(artifacts.get_stored('overlay'))
+
+        new_path = artifacts.get('merge', self._build)
+        self.assertEqual(artifacts.get_stored('merge'), new_path)
+
+    def test_get_wo_anything_to_merge(self):
+        artifacts = MergeArtifacts(self.tmp_dir, '1', [])
+        self.assertIsNone(artifacts.get('merge', lambda path: False))
+        self.assertEqual(os.listdir(self.tmp_dir), [])
+
+
+class StitchMasksTest(SimpleTestCase):
+    SIZE = (131, 97)
+
+    def setUp(self):
+        random = numpy.random.RandomState(0)
+        self.placements = []
+        self.expected = Image.new('1', self.SIZE)
+        for _ in xrange(20):
+            # some of them fall partially out of the image
+            x0 = random.randint(-10, self.SIZE[0])
+            y0 = random.randint(0, self.SIZE[1])
+            mask = numpy.where(random.rand(25, 30) < 0.3, 255,
+                0).astype(numpy.uint8)
+            self.placements.append((x0, y0, lambda mask=mask: mask))
+
+            # the way the merges were stitched before
+            bbox = (x0, y0, x0 + mask.shape[1], y0 + mask.shape[0])
+            self.expected.paste(ImageMath.eval('a | b',
+                a=self.expected.crop(bbox), b=Image.fromarray(mask)), bbox)
+        self.placements.append((0, 0, lambda: None))
+
+    def _stitch(self, strip_height):
+        output = StringIO()
+        stitch_masks(self.placements, PngStripWriter(output, self.SIZE),
+            strip_height)
+        return Image.open(StringIO(output.getvalue()))
+
+    def test_same_result_for_any_strip_height(self):
+        expected = numpy.asarray(self.expected.convert('L')) > 0
+        for strip_height in (1, 10, 97, 1000):
+            merge = self._stitch(strip_height)
+            self.assertEqual(merge.mode, '1')
+            self.assertEqual(merge.size, self.SIZE)
+            self.assertTrue(numpy.array_equal(
+                numpy.asarray(merge.convert('L')) > 0, expected))
+
+    def test_incomplete_image(self):
+        writer = PngStripWriter(StringIO(), self.SIZE)
+        writer.write(numpy.zeros((10, self.SIZE[0]), dtype=bool))
+        self.assertRaises(ValueError, writer.close)
+        self.assertRaises(ValueError, writer.write,
+            numpy.zeros((10, self.SIZE[0] + 1), dtype=bool))
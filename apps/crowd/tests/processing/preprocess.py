@@ -0,0 +1,207 @@
+###############################################################################
+## Center for Advanced Computing Research
+## California Institute of Technology
+##
+## Tests for the preprocess files format in crowd app.
+##
+## Copyright 2012 Rafael Barreto <barreto@cacr.caltech.edu>
+###############################################################################
+
+
+# =============
+# Python stdlib
+# =============
+
+import os
+import tempfile
+
+# ==============
+# Django imports
+# ==============
+
+from django.core.files.storage import FileSystemStorage
+from django.test import SimpleTestCase
+
+# ================
+# external imports
+# ================
+
+import numpy
+from backports import lzma
+
+# ===============
+# project imports
+# ===============
+
+from crowd.processing.preprocess import LZMAStreamFile, PreprocessCache
+from crowd.processing.preprocess import read_preprocess_file
+from crowd.processing.preprocess import store_preprocess_files
+from crowd.processing.preprocess import write_preprocess_file
+from helpers import filesystem as h_fs
+
+
+class PreprocessFileTest(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.scales = (1.0, 2.5)
+        self.planes = numpy.arange(2 * 3 * 4, dtype=numpy.uint8).reshape(
+            2, 3, 4)
+
+        self.raw_path = os.path.join(self.tmp_dir, 'preprocess')
+        with open(self.raw_path, 'wb') as f:
+            write_preprocess_file(f, self.planes, self.scales)
+        with lzma.open(self.raw_path + '.xz', 'wb') as f:
+            write_preprocess_file(f, self.planes, self.scales)
+
+    def tearDown(self):
+        h_fs.rm(self.tmp_dir, ignore_errors=True)
+
+    def _check(self, data):
+        self.assertEqual((data.width, data.height), (4, 3))
+        self.assertEqual(data.scales, self.scales)
+        self.assertTrue(numpy.array_equal(data.planes, self.planes))
+
+        # compatibility with the former dict of nested lists
+        self.assertEqual(sorted(data.keys()), ['costs', 'scales'])
+        self.assertEqual(data['costs'], self.planes.tolist())
+        self.assertEqual(dict(data)['scales'], self.scales)
+
+    def test_read_compressed(self):
+        self._check(read_preprocess_file(self.raw_path + '.xz'))
+
+    def test_read_memory_mapped(self):
+        self._check(read_preprocess_file(self.raw_path))
+
+    def test_write_wrong_number_of_scales(self):
+        with open(self.raw_path, 'wb') as f:
+            self.assertRaises(ValueError, write_preprocess_file, f,
+                self.planes, (1.0,))
+
+
+class PreprocessCompressionTest(SimpleTestCase):
+    class FieldFile(object):
+        def __init__(self, storage):
+            self.storage = storage
+            self.name = None
+
+        def save(self, name, content, save=True):
+            self.name = self.storage.save(name, content)
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.storage = FileSystemStorage(os.path.join(self.tmp_dir, 'media'))
+
+        self.raw_paths = []
+        for i in xrange(4):
+            path = os.path.join(self.tmp_dir, 'preprocess_%d' % i)
+            with open(path, 'wb') as f:
+                f.write(os.urandom(1000) * 700)
+            self.raw_paths.append(path)
+
+    def tearDown(self):
+        h_fs.rm(self.tmp_dir, ignore_errors=True)
+
+    def _check(self, name, raw_path):
+        with lzma.open(self.storage.path(name), 'rb') as f:
+            with open(raw_path, 'rb') as raw_file:
+                self.assertEqual(f.read(), raw_file.read())
+
+    def test_stream_file(self):
+        content = LZMAStreamFile(self.raw_paths[0], preset=1)
+        name = self.storage.save('a/' + content.name, content)
+
+        self.assertEqual(name, 'a/preprocess_0.xz')
+        self.assertEqual(content.size, self.storage.size(name))
+        self._check(name, self.raw_paths[0])
+
+    def test_store_in_threads(self):
+        pairs = [(self.FieldFile(self.storage), path) for path in
+                 self.raw_paths]
+        store_preprocess_files(pairs, preset=0, n_threads=3)
+
+        for field_file, path in pairs:
+            self._check(field_file.name, path)
+
+
+class PreprocessCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = PreprocessCache(os.path.join(self.tmp_dir, 'cache'),
+            max_size=2 * 100, eviction_interval=0)
+
+        self.paths = []
+        for i in xrange(3):
+            path = os.path.join(self.tmp_dir, 'preprocess_%d.xz' % i)
+            with lzma.open(path, 'wb') as f:
+                f.write(chr(i) * 100)
+            self.paths.append(path)
+
+    def tearDown(self):
+        h_fs.rm(self.tmp_dir, ignore_errors=True)
+
+    def _entries(self):
+        return sorted(name for name in os.listdir(self.cache.root) if
+                      name != PreprocessCache.EVICTION_MARKER_NAME)
+
+    def test_get(self):
+        self.assertEqual(self.cache.get(1, self.paths[1]), chr(1) * 100)
+        self.assertEqual(len(self._entries()), 1)
+
+        # hits don't decompress again (the modification time is kept, so the
+        # new content goes unnoticed)
+        mtime = os.path.getmtime(self.paths[1])
+        with lzma.open(self.paths[1], 'wb') as f:
+            f.write('new content')
+        os.utime(self.paths[1], (mtime, mtime))
+        self.assertEqual(self.cache.get(1, self.paths[1]), chr(1) * 100)
+
+    def test_put_from_raw_file(self):
+        raw_path = os.path.join(self.tmp_dir, 'raw')
+        with open(raw_path, 'wb') as f:
+            f.write('raw content')
+        self.cache.put(0, self.paths[0], raw_path)
+        self.assertEqual(self.cache.get(0, self.paths[0]), 'raw content')
+
+    def test_modified_file_invalidates_entry(self):
+        self.cache.get(0, self.paths[0])
+        with lzma.open(self.paths[0], 'wb') as f:
+            f.write('new content')
+        mtime = os.path.getmtime(self.paths[0]) + 10
+        os.utime(self.paths[0], (mtime, mtime))
+
+        self.assertEqual(self.cache.get(0, self.paths[0]), 'new content')
+        # the stale entry is left to the eviction
+        self.assertEqual(len(self._entries()), 2)
+
+    def test_lru_eviction(self):
+        self.cache.get(0, self.paths[0])
+        self.cache.get(1, self.paths[1])
+        # make the entry of assignment 1 the least recently used
+        os.utime(os.path.join(self.cache.root, self._entries()[1]), (0, 0))
+        self.cache.get(0, self.paths[0])
+
+        self.cache.get(2, self.paths[2])
+        self.assertEqual([e.split('-')[0] for e in self._entries()],
+            ['0', '2'])
+
+    def test_put_wo_eviction(self):
+        for i, path in enumerate(self.paths):
+            self.cache.put(i, path, evict=False)
+        self.assertEqual(len(self._entries()), 3)
+
+        self.cache.evict()
+        self.assertEqual(len(self._entries()), 2)
+
+    def test_eviction_interval(self):
+        cache = PreprocessCache(self.cache.root, max_size=100,
+            eviction_interval=60)
+        cache.get(0, self.paths[0])
+        cache.get(1, self.paths[1])
+        # evicted along with the first miss only
+        self.assertEqual(len(self._entries()), 2)
+
+        marker_path = os.path.join(cache.root,
+            PreprocessCache.EVICTION_MARKER_NAME)
+        os.utime(marker_path, (0, 0))
+        cache.get(2, self.paths[2])
+        self.assertEqual(len(self._entries()), 1)
@@ -0,0 +1,127 @@
+###############################################################################
+## Center for Advanced Computing Research
+## California Institute of Technology
+##
+## Tests for the processing of worker results in crowd app.
+##
+## Copyright 2012 Rafael Barreto <barreto@cacr.caltech.edu>
+###############################################################################
+
+
+# =============
+# Python stdlib
+# =============
+
+import base64
+
+try:
+    from cStringIO import StringIO
+except:
+    from StringIO import StringIO
+
+# ==============
+# Django imports
+# ==============
+
+from django.test import SimpleTestCase
+
+# ================
+# external imports
+# ================
+
+import numpy
+from PIL import Image
+
+# ===============
+# project imports
+# ===============
+
+from crowd.processing.results import PNG_CONTENT_TYPE, RLE_CONTENT_TYPE
+from crowd.processing.results import RLE_HEADER
+from crowd.processing.results import decode_data_url, decode_rle, encode_rle
+from crowd.processing.results import process_result, read_result
+
+
+def _legacy_process_result(result, dim):
+    output = StringIO()
+    Image.open(result).resize((dim, dim)).split()[-1].point(
+        lambda u: 255 if u > 0 else 0).save(output, format='PNG')
+    return output.getvalue()
+
+
+class ProcessResultTest(SimpleTestCase):
+    def setUp(self):
+        img = Image.new('RGBA', (300, 300), (0, 0, 0, 0))
+        for x in xrange(50, 120):
+            img.putpixel((x, x), (255, 0, 0, 200))
+            img.putpixel((x, 299 - x), (255, 0, 0, 1))
+        output = StringIO()
+        img.save(output, format='PNG')
+        self.content = output.getvalue()
+
+    def test_decode_data_url(self):
+        url = 'data:image/png;base64,' + base64.b64encode(self.content)
+        self.assertEqual(decode_data_url(url), self.content)
+        self.assertEqual(decode_data_url('data:,a%20b'), 'a b')
+        self.assertRaises(ValueError, decode_data_url, 'http://a/b.png')
+        self.assertRaises(ValueError, decode_data_url,
+            'data:image/png;base64,abc')
+
+    def test_matches_legacy_pipeline(self):
+        png, _, _ = process_result(StringIO(self.content), 100)
+        self.assertEqual(png,
+            _legacy_process_result(StringIO(self.content), 100))
+
+    def test_mileage(self):
+        png, mileage, _ = process_result(StringIO(self.content), 100)
+        mask = numpy.asarray(Image.open(StringIO(png)))
+        self.assertEqual(mileage, numpy.count_nonzero(mask))
+        self.assertGreater(mileage, 0)
+        self.assertEqual(set(numpy.unique(mask)), set([0, 255]))
+
+
+class RunLengthEncodingTest(SimpleTestCase):
+    def test_round_trip(self):
+        # the last one has runs that don't fit in an uint16
+        for shape in ((7, 5), (64, 48), (3, 40000)):
+            for p in (0, 0.3, 1):
+                mask = numpy.where(numpy.random.rand(*shape) < p, 255,
+                    0).astype(numpy.uint8)
+                self.assertTrue(numpy.array_equal(
+                    decode_rle(encode_rle(mask)), mask))
+
+    def test_malformed(self):
+        data = encode_rle(numpy.zeros((4, 4), dtype=numpy.uint8))
+        self.assertRaises(ValueError, decode_rle, data[:3])
+        self.assertRaises(ValueError, decode_rle, data[:-1])
+        self.assertRaises(ValueError, decode_rle, data + '\x01\x00')
+
+    def test_same_result_as_png(self):
+        mask = numpy.zeros((100, 100), dtype=numpy.uint8)
+        mask[10:20, 30:90] = 255
+
+        # a 1-bit PNG
+        output = StringIO()
+        Image.fromarray(mask).convert('1').save(output, format='PNG')
+        from_png = process_result(read_result(StringIO(output.getvalue()),
+            'image/png', (100, 100)), 100)
+        from_rle = process_result(read_result(StringIO(encode_rle(mask)),
+            RLE_CONTENT_TYPE, (100, 100)), 100)
+        self.assertEqual(from_png[:2], from_rle[:2])
+        self.assertEqual(from_rle[1], 600)
+
+    def test_unsupported_content_type(self):
+        self.assertRaises(ValueError, read_result, StringIO(''), 'image/gif',
+            (100, 100))
+
+    def test_size_mismatch(self):
+        # a small body declaring a huge mask is rejected before decoding it
+        data = RLE_HEADER.pack(0xffff, 0xffff) + '\xff\xff\x00\x00' * 10
+        self.assertRaises(ValueError, decode_rle, data, (100, 100))
+        self.assertRaises(ValueError, read_result, StringIO(data),
+            RLE_CONTENT_TYPE, (100, 100))
+
+        output = StringIO()
+        Image.new('1', (100, 101)).save(output, format='PNG')
+        self.assertRaises(ValueError, read_result,
+            StringIO(output.getvalue()), PNG_CONTENT_TYPE, (100, 100))
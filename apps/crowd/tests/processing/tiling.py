@@ -0,0 +1,137 @@
+###############################################################################
+## Center for Advanced Computing Research
+## California Institute of Technology
+##
+## Tests for the tiling pipeline in crowd app.
+##
+## Copyright 2012 Rafael Barreto <barreto@cacr.caltech.edu>
+###############################################################################
+
+
+# =============
+# Python stdlib
+# =============
+
+import os
+import tempfile
+
+# ==============
+# Django imports
+# ==============
+
+from django.core.files.storage import FileSystemStorage
+from django.test import SimpleTestCase
+
+# ================
+# external imports
+# ================
+
+from PIL import Image
+
+# ===============
+# project imports
+# ===============
+
+from crowd.processing.tiling import TilingEngine, tile_boxes, get_thumb_name
+from helpers import filesystem as h_fs
+
+
+class TileBoxesTest(SimpleTestCase):
+    def test_tiles_cover_image(self):
+        boxes = tile_boxes((250, 130), 100, 0.2)
+        self.assertEqual(boxes[0], (0, 0, 100, 100))
+        self.assertEqual(max(b[2] for b in boxes), 250)
+        self.assertEqual(max(b[3] for b in boxes), 130)
+        for b in boxes:
+            self.assertEqual((b[2] - b[0], b[3] - b[1]), (100, 100))
+
+    def test_tiles_overlap(self):
+        xs = sorted(set(b[0] for b in tile_boxes((400, 100), 100, 0.25)))
+        self.assertEqual(xs, [0, 75, 150, 225, 300])
+
+
+class TilingEngineTest(SimpleTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.storage = FileSystemStorage(location=self.tmp_dir)
+        self.img_path = os.path.join(self.tmp_dir, 'image.png')
+        img = Image.new('L', (230, 170))
+        img.putdata([(x * y) % 256 for y in xrange(170) for x in xrange(230)])
+        img.save(self.img_path)
+
+    def tearDown(self):
+        h_fs.rm(self.tmp_dir, ignore_errors=True)
+
+    def _generate(self, n_workers, prefix, **kwargs):
+        progress = []
+        engine = TilingEngine(80, 0.15, 0.25, n_workers=n_workers,
+            progress=lambda *args: progress.append(args))
+        tiles = engine.generate(self.img_path, self.storage,
+            lambda idx: '%s/tile_%d.png' % (prefix, idx), **kwargs)
+        return tiles, progress
+
+    def test_generate_inline(self):
+        tiles, progress = self._generate(1, 'inline', thumb_sizes=[(20, 20)])
+
+        self.assertEqual([t['index'] for t in tiles], range(len(tiles)))
+        self.assertEqual(progress[-1], ('tiling', len(tiles), len(tiles)))
+        for t in tiles:
+            self.assertTrue(self.storage.exists(t['name']))
+            self.assertTrue(self.storage.exists(
+                get_thumb_name(t['name'], (20, 20))))
+            self.assertEqual(Image.open(self.storage.path(t['name'])).size,
+                (80, 80))
+
+    def test_generate_w_border_crop(self):
+        tiles, _ = self._generate(1, 'cropped', crop_border=True)
+        for t in tiles:
+            self.assertEqual(Image.open(self.storage.path(t['name'])).size,
+                (40, 40))
+
+    def test_generate_layout(self):
+        img = Image.open(self.img_path)
+        tiles, _ = self._generate(1, 'full')
+        cropped_tiles, _ = self._generate(1, 'cropped', crop_border=True)
+
+        # 80 * 0.25 = 20 pixels of border
+        self.assertEqual(tiles[0]['bbox'], (0, 0, 80, 80))
+        self.assertEqual(tiles[0]['cropped_bbox'], (20, 20, 60, 60))
+        for t, cropped in zip(tiles, cropped_tiles):
+            x0, y0, x1, y1 = t['bbox']
+            self.assertEqual(t['cropped_bbox'],
+                (x0 + 20, y0 + 20, x1 - 20, y1 - 20))
+            self.assertEqual(cropped['cropped_bbox'], t['cropped_bbox'])
+            self.assertEqual(
+                list(Image.open(self.storage.path(t['name'])).getdata()),
+                list(img.crop(t['bbox']).getdata()))
+            self.assertEqual(
+                list(Image.open(self.storage.path(cropped['name'])).getdata()),
+                list(img.crop(t['cropped_bbox']).getdata()))
+
+    def test_generate_pool_matches_inline(self):
+        inline_tiles, _ = self._generate(1, 'inline')
+        pool_tiles, progress = self._generate(3, 'pool')
+
+        self.assertEqual([t['bbox'] for t in inline_tiles],
+            [t['bbox'] for t in pool_tiles])
+        self.assertEqual(len(progress), len(pool_tiles))
+        for a, b in zip(inline_tiles, pool_tiles):
+            self.assertEqual(
+                list(Image.open(self.storage.path(a['name'])).getdata()),
+                list(Image.open(self.storage.path(b['name'])).getdata()))
+
+    def test_generate_resume(self):
+        tiles, _ = self._generate(1, 'full')
+
+        generated = []
+        done = dict((t['index'], t) for t in tiles[:3])
+        resumed, progress = self._generate(2, 'full', done=done,
+            on_result=generated.append)
+
+        self.assertEqual(resumed, tiles)
+        self.assertEqual(sorted(t['index'] for t in generated),
+            range(3, len(tiles)))
+        self.assertEqual(progress[-1], ('tiling', len(tiles), len(tiles)))
+        # tiles generated again overwrite the previous ones
+        self.assertEqual(sorted(os.listdir(self.storage.path('full'))),
+            sorted(os.path.basename(t['name']) for t in tiles))
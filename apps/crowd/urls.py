@@ -32,6 +32,10 @@ urlpatterns += patterns('crowd.views.requesters',
 urlpatterns += patterns('crowd.views.workers',
     url('^workers/$', 'index', name='workers_index'),
     url('^workers/session$', 'assignment_session_data'),
+    url('^workers/session/(?P<session_id>\d+)/result$',
+        'assignment_session_result', name='assignment_session_result'),
+    url('^workers/preprocess/(?P<assignment_id>\d+)$',
+        'assignment_preprocess_data', name='assignment_preprocess_data'),
     url('^workers/rank/$', 'ranking_index', name='ranking_index'),
     url('^workers/rank/(\d+)$', 'top_k', name='ranking_view'),
     url('^workers/profile$','profile',name='profile_index') #definindo a pagina de profile
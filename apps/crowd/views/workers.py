@@ -12,10 +12,10 @@
 # Python stdlib imports
 # =====================
 
-import urllib
+import hashlib
+import os
 
 from collections import OrderedDict
-from apps.crowd.models.segprob import SegmentationProblem
 
 
 try:
@@ -27,21 +27,36 @@ except:
 # Django imports
 # ==============
 
+from django.conf import settings
 from django.contrib.auth.decorators import login_required, user_passes_test
 from django.core.context_processors import csrf
-from django.core.cache import cache
+from django.core.cache import cache, get_cache
+from django.core.urlresolvers import reverse
 from django.db import connection
-from django.http import HttpResponse
-from django.shortcuts import render
+from django.http import HttpResponse, Http404
+from django.shortcuts import get_object_or_404, render
 from django.utils import simplejson, timezone
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import etag, require_POST
 
 # ===============
 # project imports
 # ===============
 
+from crowd.models.assignment import Assignment
 from crowd.models.assignment import AssignmentSession, AssignmentSessionStats
+from crowd.models.assignment import AssignmentSlot
+from crowd.models.exceptions import InvalidStateError
+from crowd.processing.preprocess import PreprocessCache
+from crowd.processing.preprocess import parse_preprocess_data
+from crowd.processing.results import RESULT_CONTENT_TYPES
+from crowd.processing.results import decode_data_url, read_result
 from profiles.models import WorkerProfile
-from helpers import dip as h_dip
+
+ASSIGNMENT_PAYLOAD_CACHE_KEY = 'crowd-assignment-payload-%d'
+
+# a cache of its own (see settings.CACHES), as the default one may be a dummy
+_payload_cache = get_cache('assignment_payload')
 
 def _check_if_worker(user):
     try:
@@ -49,85 +64,211 @@ def _check_if_worker(user):
     except:
         return False
 
-@login_required
-@user_passes_test(_check_if_worker)
-def assignment_session_data(request):
+def _get_assignment_payload(assignment_id):
+    """
+    Returns the part of the session data that only depends on the
+    assignment. It never changes for a given assignment (changing how the
+    tiles are generated recreates the assignments), so it's cached.
+    """
+
+    key = ASSIGNMENT_PAYLOAD_CACHE_KEY % assignment_id
+    ret = _payload_cache.get(key)
+    if ret is not None:
+        return ret
+
+    assignment = Assignment.objects.select_related('seg_prob__details').get(
+        pk=assignment_id)
+    details = assignment.seg_prob.details
     ret = {
-        'csrfToken': str(csrf(request)['csrf_token'])
+        'assignmentId': assignment.pk,
+        'tileUrl': assignment.tile.url,
+        'tileBorder': details.tiles_border,
+        'algorithm': details.algorithm
     }
-    
-    user = request.user
+    if assignment.pre_seg:
+        ret['preSegUrl'] = assignment.pre_seg.url
+    if assignment.preprocess_file:
+        # the preprocess data is fetched apart, as a binary resource
+        ret['preprocessUrl'] = reverse('assignment_preprocess_data',
+            args=(assignment.pk,))
+
+    _payload_cache.set(key, ret, getattr(settings,
+        'CROWD_ASSIGNMENT_PAYLOAD_CACHE_TIMEOUT', 24 * 60 * 60))
+    return ret
+
+def _get_session_payload(session):
+    ret = {'sessionId': session.pk}
+    ret.update(_get_assignment_payload(session.assignment_id))
+    if 'preprocessUrl' in ret and getattr(settings,
+            'CROWD_INLINE_PREPROCESS_DATA', True):
+        # the tile UI still reads it from here. It's large, so it isn't
+        # cached along with the rest
+        preprocess = Assignment.objects.only('preprocess_file').get(
+            pk=session.assignment_id).preprocess_file
+        ret['preprocessData'] = dict(parse_preprocess_data(
+            PreprocessCache().get(session.assignment_id, preprocess.path)))
+    return ret
+
+def _get_worker_session(user):
+    """Returns the open session of 'user', if any, closing it first if it
+    expired."""
+
     session = AssignmentSession.objects.get_by_worker(user)
-    wp = WorkerProfile.objects.get(user=user)
 
     if session is not None and session.expired:
         session.close()
-        session.save()
+        try:
+            session.save()
+        except InvalidStateError:
+            # closed meanwhile, e.g. by the sweeper
+            pass
         
         session = AssignmentSession.objects.get_by_worker(user)
+    return session
+
+def _close_session(user, session, read_result):
+    """
+    Closes 'session' with the result returned by read_result(), crediting
+    its mileage to 'user'. If the result can't be read, the session is
+    closed without it (i.e. skipped).
+    """
+
+    try:
+        # the mileage is counted from the mask before it's stored. It's None
+        # if the session expired, as the result isn't taken then
+        mileage = session.close(read_result())
+    except (IOError, ValueError):
+        mileage = None
+        session.close()
+
+    # stored before the session is closed, so that it's there to be scored
+    asstats, created = AssignmentSessionStats.objects.get_or_create(
+        assignment_session=session, defaults={'mileage': None,
+                                              'accuracy': None})
+    asstats.mileage = mileage
+    asstats.save()
+
+    # concluding the assignment, if that's the case, is done in
+    # background (see crowd.tasks.ConcludeAssignmentTask), so the
+    # accuracy of this session is accounted for later
+    try:
+        session.save()
+    except InvalidStateError:
+        # closed meanwhile (e.g. by the sweeper, as it expired), so nothing is
+        # credited
+        if created:
+            asstats.delete()
+        return
+
+    if mileage is not None:
+        wp = WorkerProfile.objects.get(user=user)
+        wp.mileage_sum += mileage
+
+        # Assign the score as if the accuracy were 1.0
+        # The actual accuracy is accounted when the assignment is concluded.
+        wp.score += mileage
+
+        wp.save()
+
+def _session_response(request, session):
+    ret = {
+        'csrfToken': str(csrf(request)['csrf_token'])
+    }
+    if session is not None:
+        ret.update(_get_session_payload(session))
+
+        # the assignment to work on next, so that the client fetches its
+        # data while the worker works on this one
+        if request.REQUEST.get('prefetch'):
+            slot = AssignmentSlot.objects.reserve_next_for(session)
+            if slot is not None:
+                ret['next'] = _get_assignment_payload(slot.assignment_id)
+
+    return HttpResponse(simplejson.dumps(ret), mimetype='application/json')
+
+@login_required
+@user_passes_test(_check_if_worker)
+def assignment_session_data(request):
+    user = request.user
+    session = _get_worker_session(user)
 
     posted_session_id = request.POST.get('sessionId', None)
     result = request.POST.get('result', '')
 
     if session is not None and posted_session_id is not None:
         if unicode(session.pk) == posted_session_id:
-            try:
-                asstats, created = AssignmentSessionStats.objects.get_or_create(assignment_session=session,
-                                mileage=None,
-                                accuracy=None)
-
-                session.close(StringIO(urllib.urlopen(result).read()))
-                asstats.mileage = h_dip.count_foreground_pixels(session.result.path)
-
-                asstats.save()
-                
-                wp.mileage_sum += asstats.mileage
-
-                # Assign the score as if the accuracy were 1.0
-                # The actual accuracy is accounted when the assignment is concluded.
-                wp.score += asstats.mileage
-
-                wp.save()
-                
-            except IOError:
-                session.close()
-                
-            session.save()
+            _close_session(user, session,
+                lambda: StringIO(decode_data_url(result)))
 
-            # If an assignment is concluded the accuracies of the sessions (workers)
-            # must be computed using the assignment's merge image.
-            # Hence, the users' score must be updated as well. 
-            assignment = session.assignment
-            if assignment.concluded:
-                a_sessions = AssignmentSession.objects.get_w_result().filter(assignment=assignment)
-                for a_session in a_sessions:
-                    a_session.stats.update_accuracy()
-                    a_session.stats.save()
+            session = AssignmentSession.objects.get_by_worker(user)
 
-                    wp = WorkerProfile.objects.get(user=a_session.worker)
+    return _session_response(request, session)
 
-                    # Score correction
-                    wp.score -= a_session.stats.mileage
-                    wp.score += a_session.stats.mileage*a_session.stats.accuracy
+@login_required
+@user_passes_test(_check_if_worker)
+@require_POST
+def assignment_session_result(request, session_id):
+    """
+    Closes the session 'session_id' with the result posted as the raw body
+    of the request, either a PNG (e.g. 1-bit) or a run-length encoded mask
+    (see crowd.processing.results), according to its content type. It's
+    cheaper than posting the result as a data URL to assignment_session_data,
+    whose response it mirrors.
+
+    The body can't be larger than settings.CROWD_MAX_RESULT_SIZE bytes and
+    the mask must be as large as the tiles, otherwise it isn't decoded.
+    """
+
+    content_type = request.META.get('CONTENT_TYPE', '').split(';')[0].strip()
+    if content_type not in RESULT_CONTENT_TYPES:
+        return HttpResponse(status=415)
+    try:
+        content_length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        return HttpResponse(status=400)
+    if content_length > getattr(settings, 'CROWD_MAX_RESULT_SIZE', 1048576):
+        return HttpResponse(status=413)
 
-            session = AssignmentSession.objects.get_by_worker(user)
+    user = request.user
+    session = _get_worker_session(user)
 
-    if session is not None:
-        assignment = session.assignment
-        ret['sessionId'] = session.pk
-        ret['assignmentId'] = assignment.pk
-        ret['tileUrl'] = assignment.tile.url
-        pre_seg = assignment.pre_seg
-        if pre_seg:
-            ret['preSegUrl'] = pre_seg.url
-        preprocess = assignment.preprocess_file
+    if session is not None and session.pk == int(session_id):
+        dim = session.assignment.seg_prob.details.tiles_dimension
+        _close_session(user, session,
+            lambda: read_result(request, content_type, (dim, dim)))
+
+        session = AssignmentSession.objects.get_by_worker(user)
+
+    return _session_response(request, session)
+
+def _preprocess_data_etag(request, assignment_id):
+    try:
+        preprocess = Assignment.objects.get(pk=assignment_id).preprocess_file
         if preprocess:
-            preprocess_data = SegmentationProblem.read_file(preprocess.path)
-            ret['preprocessData'] = preprocess_data
-        ret['tileBorder'] = session.assignment.seg_prob.details.tiles_border
-        ret['algorithm'] = session.assignment.seg_prob.details.algorithm
+            return hashlib.md5('%s:%s:%d' % (assignment_id, preprocess.name,
+                os.path.getmtime(preprocess.path))).hexdigest()
+    except (Assignment.DoesNotExist, OSError):
+        pass
+    return None
 
-    return HttpResponse(simplejson.dumps(ret), mimetype='application/json')
+@login_required
+@user_passes_test(_check_if_worker)
+@etag(_preprocess_data_etag)
+def assignment_preprocess_data(request, assignment_id):
+    """
+    Serves the decompressed preprocess file of an assignment (see
+    crowd.processing.preprocess for its layout). It never changes for a given
+    assignment, so clients may cache it.
+    """
+
+    assignment = get_object_or_404(Assignment, pk=assignment_id)
+    if not assignment.preprocess_file:
+        raise Http404
+
+    response = HttpResponse(PreprocessCache().get(assignment.pk,
+        assignment.preprocess_file.path), mimetype='application/octet-stream')
+    patch_cache_control(response, private=True, max_age=24 * 60 * 60)
+    return response
 
 @login_required
 @user_passes_test(_check_if_worker)
@@ -266,12 +266,119 @@ TEST_RUNNER = 'planta.test_runner.TestRunner'
 
 INTERNAL_IPS = ('127.0.0.1',)
 
+# ===========================
+# crowd app configuration
+# ===========================
+
+# number of processes used to generate the tiles of a segmentation problem
+# (None means one per CPU)
+CROWD_TILING_WORKERS = None
+
+# for how long (in seconds) at most the creation of the assignments of a
+# segmentation problem, queued or running, keeps it from being scheduled
+# again or its assignments from being cleared. The lock is kept in the
+# database (see crowd.models.segprob.SegmentationProblemManager.lock)
+CROWD_ASSIGNMENTS_CREATION_LOCK_TIMEOUT = 6 * 60 * 60
+
+# implementation of the LiveVessel preprocessing (see
+# crowd.processing.livevessel.PREPROCESSORS): only 'matlab' (the 'offline'
+# script) for now
+CROWD_LIVEVESSEL_BACKEND = 'matlab'
+# scales the experimental NumPy costs are computed for by the
+# livevessel_benchmark command, unless a MATLAB preprocess file is given
+CROWD_LIVEVESSEL_SCALES = (1.0, 2.0, 3.0)
+
+# lzma preset (0-9, the higher the smaller and slower) of the LiveVessel
+# preprocess files and number of threads compressing them
+CROWD_PREPROCESS_XZ_PRESET = 6
+CROWD_PREPROCESS_COMPRESSION_THREADS = 4
+
+# where the decompressed LiveVessel preprocess files are cached, the maximum
+# size (in bytes) of that cache and how often (in seconds) at most it's
+# evicted on cache misses
+CROWD_PREPROCESS_CACHE_ROOT = h_fs.get_absolute_path('../cache/preprocess/',
+    __file__)
+CROWD_PREPROCESS_CACHE_MAX_SIZE = 1024 ** 3
+CROWD_PREPROCESS_CACHE_EVICTION_INTERVAL = 60
+
+# LiveVessel preprocessing: executable of MATLAB, maximum number of processes
+# running at once, number of tiles per process (None means the tiles are split
+# evenly among the processes), timeout (in seconds) without any tile being
+# finished and number of retries per tile
+CROWD_LIVEVESSEL_MATLAB = '/usr/local/bin/matlab'
+CROWD_LIVEVESSEL_PROCESSES = 4
+CROWD_LIVEVESSEL_BATCH_SIZE = None
+CROWD_LIVEVESSEL_TIMEOUT = 600
+CROWD_LIVEVESSEL_RETRIES = 1
+
+# replaces the MATLAB invocation by any other executable (e.g. a stub for
+# testing). It's a list of arguments in which '%(manifest)s' is substituted by
+# the path of a file listing, one per line, the tab separated paths of a tile
+# and of its preprocess file. Each preprocess file must be written under its
+# path plus '.part' and renamed once complete.
+CROWD_LIVEVESSEL_COMMAND = None
+
+# how often (in seconds) the sessions that expired while open are closed and
+# how many of them are closed per UPDATE
+CROWD_SESSIONS_SWEEP_INTERVAL = 60
+CROWD_SESSIONS_SWEEP_BATCH_SIZE = 500
+
+# retries (and the delay, in seconds, between them) of the merge and scoring
+# of a concluded assignment, and how often (in seconds) the concluded
+# assignments not scored yet are looked for
+CROWD_CONCLUSION_MAX_RETRIES = 5
+CROWD_CONCLUSION_RETRY_DELAY = 30
+CROWD_CONCLUSION_SWEEP_INTERVAL = 10 * 60
+
+# the alpha of the merge of the results of an assignment: a pixel is merged if
+# at least 1/alpha of them mark it (see helpers.dip.merge_masks)
+CROWD_MERGE_ALPHA = 2.0
+
+# how many rows of the merge of the assignments of a segmentation problem are
+# built at a time
+CROWD_MERGE_STRIP_HEIGHT = 1024
+
+# number of processes merging the results of the assignments of a
+# segmentation problem
+CROWD_MERGE_PROCESSES = 4
+
+# for how long (in seconds) at most the merge of the assignments of a
+# segmentation problem, queued or running, keeps it from being scheduled again
+# (see crowd.tasks.MergeAssignmentsTask). As the lock of the creation of the
+# assignments, it's kept in the database
+CROWD_MERGE_LOCK_TIMEOUT = 60 * 60
+
+# for how long (in seconds) the session data that only depends on the
+# assignment is cached (see CACHES)
+CROWD_ASSIGNMENT_PAYLOAD_CACHE_TIMEOUT = 24 * 60 * 60
+
+# whether the session data includes the LiveVessel preprocess data as
+# 'preprocessData', as the tile UI reads it, besides the URL it's served from
+# ('preprocessUrl'). To be turned off once the tile UI fetches it from there
+CROWD_INLINE_PREPROCESS_DATA = True
+
+# maximum size (in bytes) of a result posted as the raw body of a request
+CROWD_MAX_RESULT_SIZE = 1048576
+
+# for how long (in seconds) after a session expires the assignment reserved
+# to be worked on next by its worker is held
+CROWD_NEXT_ASSIGNMENT_RESERVATION_GRACE = 60
+
 # ===========================
 # Cache configuration
 # ===========================
 CACHES = {
     "default": {
         'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    },
+    # the session data that only depends on the assignment, which never
+    # changes, so it can be cached by each process apart
+    'assignment_payload': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'assignment-payload',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000
+        }
     }
 }
 
@@ -281,3 +388,11 @@ CACHES = {
 BROKER_URL = 'redis://localhost:6379/0'
 BROKER_TRANSPORT_OPTIONS = {'visibility_timeout': 100}
 CELERY_RESULT_BACKEND = 'redis://localhost:6379/0'
+CELERY_ROUTES = {
+    # the tiling engine forks its own pool of processes, so this queue must be
+    # consumed by non-daemonic workers (e.g. celery worker -Q assignments
+    # --pool=solo)
+    'crowd.create_assignments': {'queue': 'assignments'},
+    # the merge of the assignments forks its own pool as well
+    'crowd.merge_assignments': {'queue': 'assignments'},
+}